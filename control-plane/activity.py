@@ -0,0 +1,240 @@
+import os
+import time
+import struct
+import asyncio
+from collections import namedtuple
+from mmap_table import MmapTable, user_hash, USED, DELETED, MAX_LOAD
+
+# Per user activity seen by the proxy: last request or websocket traffic, open websockets and bytes in/out.
+# Every proxy worker keeps it in memory and flushes it every ACTIVITY_FLUSH_SECONDS into its own memory
+# mapped file in ACTIVITY_DIR(one writer per file), the monitor reads and merges the files of all workers
+# to tell idle containers without reading their logs.
+ACTIVITY_DIR = os.environ.get("ACTIVITY_DIR", "activity")
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get("ACTIVITY_FLUSH_SECONDS", 5))
+# power of two, a few times the number of users an instance sees in ACTIVITY_RETENTION_SECONDS
+ACTIVITY_TABLE_SLOTS = int(os.environ.get("ACTIVITY_TABLE_SLOTS", 4096))
+# users without traffic for this long are dropped when the table fills up
+ACTIVITY_RETENTION_SECONDS = 24 * 60 * 60
+# open websockets of a worker that hasn't flushed for this long are not counted, it died
+ACTIVITY_STALE_SECONDS = max(30.0, ACTIVITY_FLUSH_SECONDS * 3)
+
+Activity = namedtuple("Activity", ["last_active", "websockets", "bytes_in", "bytes_out"])
+
+
+def worker_path(worker: str, directory: str = ACTIVITY_DIR) -> str:
+    return os.path.join(directory, f"worker-{worker}.bin")
+
+
+class ActivityTable(MmapTable):
+    """
+    The file of one proxy worker, user hash => (last active, websockets, state, bytes in, bytes out)
+    records(mmap_table.py). Readers notice a swapped in table by its inode.
+    """
+
+    NAME = "activity table"
+    MAGIC = b"CSAT"
+    # magic, slots, flushed at
+    HEADER = struct.Struct("<4sId")
+    FLUSHED_AT_OFFSET = 8
+    # seq, user hash, last active, open websockets, state, bytes in, bytes out
+    RECORD = struct.Struct("<IQdIIQQ")
+    STATE_FIELD = 3
+
+    def __init__(self, path: str, slots: int = ACTIVITY_TABLE_SLOTS):
+        super().__init__(path, slots)
+
+    def open(self):
+        if self._map is not None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            current_size = os.path.getsize(self.path)
+        except OSError:
+            current_size = None
+        if current_size != self.size:
+            self._swap_in([])
+            return
+        self._map_writable()
+        # the websockets of the previous process of this worker are gone
+        self._swap_in([(key, last_active, 0, bytes_in, bytes_out) for key, last_active, _, _, bytes_in, bytes_out in self._live_records()])
+
+    def _swap_in(self, records: list[tuple[int, float, int, int, int]]):
+        """Writes a new table with the (user hash, last active, websockets, bytes in, bytes out) records"""
+        self._write_table([
+            (key, last_active, websockets, USED, bytes_in, bytes_out)
+            for key, last_active, websockets, bytes_in, bytes_out in records
+        ], (time.time(),))
+
+    def update(self, user_id: str, last_active: float, websockets: int, bytes_in: int, bytes_out: int):
+        """last_active and websockets replace the stored ones(last_active only if later), bytes are added"""
+        self.open()
+        key = user_hash(user_id)
+        slot, free = self._find(key)
+        if slot is None:
+            if self.used + self.tombstones + 1 > self.slots * MAX_LOAD:
+                self.compact()
+                slot, free = self._find(key)
+            if free is None:
+                print("Activity table is full, increase ACTIVITY_TABLE_SLOTS")
+                return
+            self.tombstones -= self._read_record(free)[3] == DELETED
+            self.used += 1
+            self._write_record(free, key, last_active, websockets, USED, bytes_in, bytes_out)
+            return
+        _, stored_last_active, _, _, stored_in, stored_out = self._read_record(slot)
+        self._write_record(slot, key, max(last_active, stored_last_active), websockets, USED,
+                           stored_in + bytes_in, stored_out + bytes_out)
+
+    def mark_flushed(self):
+        struct.pack_into("<d", self._map, self.FLUSHED_AT_OFFSET, time.time())
+
+    def flushed_at(self) -> float:
+        return struct.unpack_from("<d", self._map, self.FLUSHED_AT_OFFSET)[0]
+
+    def read(self, user_id: str) -> Activity | None:
+        """Reader side, the activity of the user as this worker flushed it"""
+        key = user_hash(user_id)
+        slot, _ = self._find(key)
+        if slot is None:
+            return None
+        _, last_active, websockets, _, bytes_in, bytes_out = self._read_record(slot)
+        return Activity(last_active, websockets, bytes_in, bytes_out)
+
+    def compact(self):
+        """Drops the deleted records and the users without traffic for ACTIVITY_RETENTION_SECONDS"""
+        oldest = time.time() - ACTIVITY_RETENTION_SECONDS
+        self._swap_in([
+            (key, last_active, websockets, bytes_in, bytes_out)
+            for key, last_active, websockets, _, bytes_in, bytes_out in self._live_records()
+            if last_active >= oldest or websockets
+        ])
+
+
+class PendingActivity:
+    __slots__ = ("last_active", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.last_active = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class ActivityRecorder:
+    """
+    The proxy side: requests only update a dict, `run()` writes what changed into the worker's table
+    every ACTIVITY_FLUSH_SECONDS. A user with an open websocket counts as active at every flush,
+    code-server keeps one open for as long as the editor is open in the browser.
+    """
+
+    def __init__(self, table: ActivityTable):
+        self.table = table
+        self.pending: dict[str, PendingActivity] = {}
+        # user_id => open websockets through this worker
+        self.websockets: dict[str, int] = {}
+
+    def _pending(self, user_id: str) -> PendingActivity:
+        pending = self.pending.get(user_id)
+        if pending is None:
+            pending = self.pending[user_id] = PendingActivity()
+        return pending
+
+    def touch(self, user_id: str):
+        self._pending(user_id).last_active = time.time()
+
+    def received(self, user_id: str, size: int):
+        """bytes from the client to the container"""
+        self._pending(user_id).bytes_in += size
+
+    def sent(self, user_id: str, size: int):
+        """bytes from the container to the client"""
+        self._pending(user_id).bytes_out += size
+
+    def websocket_opened(self, user_id: str):
+        self.websockets[user_id] = self.websockets.get(user_id, 0) + 1
+        self.touch(user_id)
+
+    def websocket_closed(self, user_id: str):
+        count = self.websockets.get(user_id, 0) - 1
+        if count > 0:
+            self.websockets[user_id] = count
+        else:
+            self.websockets.pop(user_id, None)
+        # written with the count dropped to 0 on the next flush
+        self.touch(user_id)
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.time()
+        for user_id in self.websockets.keys() - pending.keys():
+            pending[user_id] = PendingActivity()
+        for user_id, activity in pending.items():
+            websockets = self.websockets.get(user_id, 0)
+            last_active = now if websockets else activity.last_active
+            self.table.update(user_id, last_active, websockets, activity.bytes_in, activity.bytes_out)
+        self.table.mark_flushed()
+
+    async def run(self):
+        self.table.open()
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing proxy activity: {e}")
+
+
+class ActivityReader:
+    """The control plane side, `refresh()` maps the tables of the workers, `lookup()` merges them"""
+
+    def __init__(self, directory: str = ACTIVITY_DIR):
+        self.directory = directory
+        # path => (inode, table mapped read only)
+        self.tables: dict[str, tuple[int, ActivityTable]] = {}
+
+    def refresh(self):
+        """Picks up new workers and tables a worker swapped in, once per sweep is enough"""
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith(".bin")]
+        except OSError:
+            names = []
+        paths = {os.path.join(self.directory, name) for name in names}
+        for path in self.tables.keys() - paths:
+            self.tables.pop(path)[1].close()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                inode = os.fstat(fd).st_ino
+                current = self.tables.get(path)
+                if current and current[0] == inode:
+                    continue
+                table = ActivityTable(path)
+                if not table.map_readonly(fd):
+                    continue
+            finally:
+                os.close(fd)
+            if current:
+                current[1].close()
+            self.tables[path] = (inode, table)
+
+    def lookup(self, user_id: str) -> Activity | None:
+        """Latest activity and the sums of websockets and bytes over every worker, None if no worker saw the user"""
+        now = time.time()
+        merged = None
+        for _, table in self.tables.values():
+            activity = table.read(user_id)
+            if activity is None:
+                continue
+            if now - table.flushed_at() > ACTIVITY_STALE_SECONDS:
+                activity = activity._replace(websockets=0)
+            if merged is None:
+                merged = activity
+            else:
+                merged = Activity(max(merged.last_active, activity.last_active), merged.websockets + activity.websockets,
+                                  merged.bytes_in + activity.bytes_in, merged.bytes_out + activity.bytes_out)
+        return merged
+
+
+activity_reader = ActivityReader()
@@ -0,0 +1,82 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from metrics import start_queue_depth, start_queue_wait_seconds, start_requests_rejected_total
+
+MAX_CONCURRENT_LAUNCHES = int(os.environ.get("MAX_CONCURRENT_LAUNCHES", 4))
+LAUNCH_QUEUE_SIZE = int(os.environ.get("LAUNCH_QUEUE_SIZE", 20))
+# used for Retry-After till a launch has been timed
+DEFAULT_LAUNCH_SECONDS = 5.0
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight call and its result(or exception)
+    """
+
+    def __init__(self):
+        self.calls: dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        # one caller going away shouldn't cancel the launch for the others
+        return await asyncio.shield(task)
+
+
+class LaunchQueueFullError(Exception):
+    def __init__(self, position: int, retry_after: int):
+        super().__init__(f"launch queue is full, position {position}")
+        self.position = position
+        self.retry_after = retry_after
+
+
+class LaunchGate:
+    """
+    At most `concurrency` launches run at once, at most `max_queue` wait for a slot.
+    Anything beyond that is rejected right away with an estimate of when to retry.
+    """
+
+    def __init__(self, concurrency: int = MAX_CONCURRENT_LAUNCHES, max_queue: int = LAUNCH_QUEUE_SIZE):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        # moving average of how long a launch holds a slot
+        self.launch_seconds = DEFAULT_LAUNCH_SECONDS
+
+    def retry_after(self, position: int) -> int:
+        return max(1, round(self.launch_seconds * position / self.concurrency))
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            position = self.waiting + 1
+            start_requests_rejected_total.inc()
+            raise LaunchQueueFullError(position, self.retry_after(position))
+
+        self.waiting += 1
+        start_queue_depth.set(self.waiting)
+        queued_at = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            start_queue_depth.set(self.waiting)
+            start_queue_wait_seconds.observe(time.monotonic() - queued_at)
+
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+            self.launch_seconds = 0.8 * self.launch_seconds + 0.2 * (time.monotonic() - started_at)
+
+
+start_flights = SingleFlight()
+resume_flights = SingleFlight()
+launch_gate = LaunchGate()
@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+ASSET_CACHE_DIR = os.environ.get("ASSET_CACHE_DIR", ".asset-cache")
+ASSET_CACHE_MEMORY_BYTES = int(os.environ.get("ASSET_CACHE_MEMORY_MB", 256)) * 1024 * 1024
+ASSET_CACHE_DISK_BYTES = int(os.environ.get("ASSET_CACHE_DISK_MB", 1024)) * 1024 * 1024
+# bigger bodies are always proxied
+ASSET_CACHE_MAX_ENTRY_BYTES = 32 * 1024 * 1024
+# unversioned paths can change with a redeploy, they are fetched from the static container again after this,
+# 0 never caches them
+ASSET_CACHE_UNVERSIONED_TTL_SECONDS = float(os.environ.get("ASSET_CACHE_UNVERSIONED_TTL_SECONDS", 60))
+
+# /stable-<commit>/... is versioned by the vscode build, it never changes for the same path
+BUILD_PATTERN = re.compile(r"^/stable-([0-9a-f]+)/")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# hop by hop or recomputed for the cached body
+SKIPPED_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "set-cookie", "date"}
+
+
+def get_build(path: str) -> str | None:
+    match = BUILD_PATTERN.match(path)
+    return match.group(1) if match else None
+
+
+def cache_key(path: str, encoding: str = "identity") -> str:
+    """
+    build hash + path + content encoding of the body, without the user's token so every user shares the same entry.
+    Every encoding the container answered with is a separate entry.
+    """
+    parsed = urlparse(path)
+    query = urlencode([(k, v) for k, v in parse_qsl(parsed.query) if k != "token"])
+    return f"{get_build(parsed.path) or 'unversioned'}:{parsed.path}{'?' + query if query else ''}#{encoding.lower()}"
+
+
+def accepted_encodings(accept_encoding: str | None) -> list[str]:
+    """Content encodings of an Accept-Encoding header the client takes, preferred first, identity last"""
+    weighted = []
+    for part in (accept_encoding or "").split(","):
+        encoding, _, params = part.partition(";")
+        encoding = encoding.strip().lower()
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                pass
+        if encoding and encoding != "*" and quality > 0:
+            weighted.append((quality, encoding))
+    encodings = [encoding for _, encoding in sorted(weighted, key=lambda item: -item[0])]
+    if "identity" not in encodings:
+        encodings.append("identity")
+    return encodings
+
+
+def is_cacheable(headers: list[tuple[str, str]]) -> bool:
+    """A body can only be shared if it doesn't vary on anything but its encoding, which is in the key"""
+    vary = {field.strip().lower() for name, value in headers if name.lower() == "vary" for field in value.split(",")}
+    return not vary - {"accept-encoding", ""}
+
+
+class CachedAsset:
+    def __init__(self, body: bytes, headers: list[tuple[str, str]], etag: str, immutable: bool,
+                 expires_at: float | None = None):
+        self.body = body
+        self.headers = headers
+        self.etag = etag
+        self.immutable = immutable
+        # time.monotonic() after which an unversioned asset is fetched again, None for immutable ones
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires_at is None or time.monotonic() < self.expires_at
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    def response_headers(self) -> dict:
+        headers = {name: value for name, value in self.headers}
+        headers["ETag"] = self.etag
+        headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if self.immutable else REVALIDATE_CACHE_CONTROL
+        return headers
+
+    def matches(self, if_none_match: str | None) -> bool:
+        if not if_none_match:
+            return False
+        return if_none_match.strip() == "*" or self.etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+class AssetCache:
+    """
+    Memory LRU of static asset bodies, entries evicted from memory spill to a disk LRU directory.
+    Both tiers are capped in bytes.
+    """
+
+    def __init__(self, memory_bytes: int = ASSET_CACHE_MEMORY_BYTES, disk_bytes: int = ASSET_CACHE_DISK_BYTES,
+                 directory: str = ASSET_CACHE_DIR):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.memory: OrderedDict[str, CachedAsset] = OrderedDict()
+        self.memory_used = 0
+        # key => size of the spilled entries
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_used = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._clear_directory()
+
+    def _clear_directory(self):
+        # index is in memory only, so whatever an earlier run spilled is unknown
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key: str) -> CachedAsset | None:
+        asset = self.memory.get(key)
+        if asset is not None:
+            if not asset.fresh:
+                self.discard(key)
+                return None
+            self.memory.move_to_end(key)
+            return asset
+        if key in self.disk:
+            asset = self._read_disk(key)
+            self._remove_disk(key)
+            if asset is not None and asset.fresh:
+                # promoted back to memory
+                self._put_memory(key, asset)
+                return asset
+        return None
+
+    def put(self, key: str, body: bytes, headers: list[tuple[str, str]], etag: str | None = None) -> CachedAsset | None:
+        if len(body) > ASSET_CACHE_MAX_ENTRY_BYTES or not is_cacheable(headers):
+            return None
+        headers = [(name, value) for name, value in headers if name.lower() not in SKIPPED_HEADERS | {"etag", "cache-control"}]
+        immutable = not key.startswith("unversioned:")
+        if not immutable and ASSET_CACHE_UNVERSIONED_TTL_SECONDS <= 0:
+            return None
+        etag = etag or f'"{hashlib.sha1(body).hexdigest()}"'
+        expires_at = None if immutable else time.monotonic() + ASSET_CACHE_UNVERSIONED_TTL_SECONDS
+        asset = CachedAsset(body, headers, etag, immutable, expires_at)
+        self.discard(key)
+        self._put_memory(key, asset)
+        return asset
+
+    def discard(self, key: str):
+        asset = self.memory.pop(key, None)
+        if asset is not None:
+            self.memory_used -= asset.size
+        if key in self.disk:
+            self._remove_disk(key)
+
+    def _put_memory(self, key: str, asset: CachedAsset):
+        self.memory[key] = asset
+        self.memory_used += asset.size
+        while self.memory_used > self.memory_bytes and self.memory:
+            evicted_key, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.size
+            self._spill(evicted_key, evicted)
+
+    def _spill(self, key: str, asset: CachedAsset):
+        if asset.size > self.disk_bytes:
+            self.evictions += 1
+            return
+        try:
+            with open(self._file(key), "wb") as file:
+                meta = json.dumps({"headers": asset.headers, "etag": asset.etag, "immutable": asset.immutable,
+                                   "expires_at": asset.expires_at}).encode()
+                file.write(len(meta).to_bytes(4, "big") + meta + asset.body)
+        except OSError as e:
+            print(f"Could not spill {key} to disk: {e}")
+            self.evictions += 1
+            return
+        self.disk[key] = asset.size
+        self.disk_used += asset.size
+        while self.disk_used > self.disk_bytes and self.disk:
+            evicted_key = next(iter(self.disk))
+            self._remove_disk(evicted_key)
+            self.evictions += 1
+
+    def _read_disk(self, key: str) -> CachedAsset | None:
+        try:
+            with open(self._file(key), "rb") as file:
+                data = file.read()
+        except OSError:
+            self._remove_disk(key)
+            return None
+        meta_size = int.from_bytes(data[:4], "big")
+        meta = json.loads(data[4:4 + meta_size])
+        return CachedAsset(data[4 + meta_size:], [tuple(h) for h in meta["headers"]], meta["etag"], meta["immutable"],
+                           meta["expires_at"])
+
+    def _remove_disk(self, key: str):
+        size = self.disk.pop(key, None)
+        if size is None:
+            return
+        self.disk_used -= size
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
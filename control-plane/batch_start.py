@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+from contextlib import ExitStack
+from admission import start_flights, resume_flights, launch_gate, MAX_CONCURRENT_LAUNCHES
+from cache import get_container_id_by_user, set_user_containers
+from codermon import run_container, resume_container
+from docker_client import get_docker_client
+from ports import port_allocator
+from volumes import workspace_volumes
+from warm_pool import warm_pool
+from capacity import workspace_capacity
+from outbox import outbox
+from metrics import (
+    containers_started_total,
+    container_start_duration_seconds,
+    start_requests_refused_total,
+    batch_start_containers_per_second,
+)
+
+BATCH_START_MAX_USERS = int(os.environ.get("BATCH_START_MAX_USERS", 100))
+# launches of one batch waiting on the launch gate at once, the gate bounds the docker runs of /start and batches
+# together and turns away what doesn't fit in its queue
+BATCH_START_CONCURRENCY = int(os.environ.get("BATCH_START_CONCURRENCY", MAX_CONCURRENT_LAUNCHES))
+
+
+class BatchStart:
+    """
+    /start for many users at once(a classroom). The ports of every new container are reserved in one transaction,
+    the containers are launched through the launch gate by BATCH_START_CONCURRENCY workers and the mappings of the
+    ones that are up are written together(everything that came up while the previous write ran).
+    `results` gets {user_id, status, ...} per user as soon as it is known, then None.
+    `run()` is a task of its own, a client going away doesn't leave containers without their mapping.
+    If it fails half way every user without a result gets an error.
+    """
+
+    def __init__(self, user_ids: list[str]):
+        self.user_ids = list(dict.fromkeys(user_ids))
+        self.results: asyncio.Queue[dict | None] = asyncio.Queue()
+        # (user_id, container_id, port, resolved once the mapping is written) of the containers that are up, then None
+        self.launched: asyncio.Queue[tuple[str, str, int, asyncio.Future] | None] = asyncio.Queue()
+        self.started = 0
+        # users that got their result
+        self.answered: set[str] = set()
+        self.queue: asyncio.Queue[tuple[str, int]] = asyncio.Queue()
+
+    def result(self, user_id: str, status: str, **fields):
+        self.answered.add(user_id)
+        self.results.put_nowait({"user_id": user_id, "status": status, **fields})
+
+    async def existing(self, user_id: str) -> bool:
+        """Answers users that have a container(resumed if paused) or get a warm one, False if one has to be launched"""
+        container_id = await get_container_id_by_user(user_id)
+        if container_id:
+            await resume_flights.do(container_id, lambda: resume_container(container_id))
+            self.result(user_id, "running", container_id=container_id)
+            return True
+        if not await workspace_volumes.has_volumes(user_id):
+            warm = await warm_pool.acquire(user_id)
+            if warm:
+                containers_started_total.inc()
+                self.started += 1
+                self.result(user_id, "started", container_id=warm[0])
+                return True
+        return False
+
+    async def run(self):
+        started_at = time.perf_counter()
+        try:
+            pending = []
+            for user_id in self.user_ids:
+                try:
+                    if not await self.existing(user_id):
+                        pending.append(user_id)
+                except Exception as e:
+                    self.result(user_id, "error", message=str(e))
+
+            # what doesn't fit in the available memory is refused like /start does
+            admissible = workspace_capacity.admissible()
+            if admissible is not None and len(pending) > admissible:
+                start_requests_refused_total.inc(len(pending) - admissible)
+                for user_id in pending[admissible:]:
+                    self.result(user_id, "error", message="Not enough memory for another container")
+                pending = pending[:admissible]
+            ports = port_allocator.allocate_many(pending)
+            for user_id in pending[len(ports):]:
+                self.result(user_id, "error", message="No free port available")
+
+            for user_id, port in zip(pending, ports):
+                self.queue.put_nowait((user_id, port))
+            writer = asyncio.create_task(self.write_mappings())
+            # the leases of the ports waiting their turn aren't reclaimed
+            with ExitStack() as launching:
+                for port in ports:
+                    launching.enter_context(port_allocator.launching(port))
+                await asyncio.gather(*(self.worker() for _ in range(min(BATCH_START_CONCURRENCY, len(ports)))))
+                self.launched.put_nowait(None)
+                await writer
+        except Exception as e:
+            print(f"Error starting a batch of {len(self.user_ids)} users: {e}")
+            # the ports of the launches that never began go back
+            while not self.queue.empty():
+                port_allocator.release(self.queue.get_nowait()[1])
+            for user_id in self.user_ids:
+                if user_id not in self.answered:
+                    self.result(user_id, "error", message="Batch start failed")
+        finally:
+            seconds = time.perf_counter() - started_at
+            if self.started and seconds:
+                batch_start_containers_per_second.observe(self.started / seconds)
+            self.results.put_nowait(None)
+
+    async def worker(self):
+        while not self.queue.empty():
+            await self.start_user(*self.queue.get_nowait())
+
+    async def start_user(self, user_id: str, port: int):
+        # a /start of the same user may be launching already, its launch is shared and the port goes back
+        launched = False
+
+        async def launch() -> str:
+            nonlocal launched
+            # a /start of the user may have finished since the batch looked
+            container_id = await get_container_id_by_user(user_id)
+            if container_id:
+                return container_id
+            async with launch_gate.slot():
+                started_at = time.perf_counter()
+                volumes, cold = await workspace_volumes.for_user(user_id)
+                container_id = await run_container(port, user_id, volumes)
+                container_start_duration_seconds.labels(volumes="cold" if cold else "warm").observe(time.perf_counter() - started_at)
+            launched = True
+            written = asyncio.get_running_loop().create_future()
+            self.launched.put_nowait((user_id, container_id, port, written))
+            await written
+            return container_id
+
+        try:
+            container_id = await start_flights.do(user_id, launch)
+        except Exception as e:
+            if not launched:
+                port_allocator.release(port)
+            self.result(user_id, "error", message=str(e))
+            return
+        if not launched:
+            port_allocator.release(port)
+        self.result(user_id, "started", container_id=container_id)
+
+    async def write_mappings(self):
+        done = False
+        while not done:
+            batch = [await self.launched.get()]
+            while not self.launched.empty():
+                batch.append(self.launched.get_nowait())
+            # None comes after every launch has finished
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                # confirmed first like /start does, a failed write leaves no mapping behind
+                port_allocator.lease_many({port: container_id for _, container_id, port, _ in batch})
+                await set_user_containers([(user_id, container_id, port) for user_id, container_id, port, _ in batch])
+            except Exception as e:
+                print(f"Error writing the mappings of {len(batch)} started containers: {e}")
+                # nothing routes to them, they would hold their ports till the next restart
+                await asyncio.gather(*(self.discard(container_id, port) for _, container_id, port, _ in batch))
+                for *_, written in batch:
+                    written.set_exception(e)
+                continue
+            for user_id, container_id, port, written in batch:
+                outbox.publish("started", container_id, user_id=user_id, port=port)
+                containers_started_total.inc()
+                self.started += 1
+                written.set_result(None)
+
+    async def discard(self, container_id: str, port: int):
+        """Stops a container whose mapping couldn't be written, its port goes back once it is stopped"""
+        try:
+            await get_docker_client().stop(container_id)
+        except Exception as e:
+            print(f"Error stopping container {container_id} without a mapping, it keeps port {port}: {e}")
+            return
+        port_allocator.release(port)
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import base64
+import struct
+import asyncio
+import hashlib
+from proxy_server import Message, read_head, copy_body
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_CLOSE = 0x8
+
+
+class NullWriter:
+    """Sink for response bodies"""
+
+    def write(self, data: bytes):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class BufferWriter(NullWriter):
+    """Keeps response bodies that are looked at"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes):
+        self.chunks.append(data)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+def percentile(samples: list[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarise(name: str, latencies: list[float], seconds: float, errors: int = 0, **extra) -> dict:
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        **extra,
+    }
+
+
+def write_results(results: list[dict], output: str | None):
+    data = json.dumps({"at": time.time(), "results": results}, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(data)
+    print(data)
+
+
+def websocket_accept(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def websocket_frame(opcode: int, payload: bytes, mask: bool) -> bytes:
+    """One final frame, clients mask what they send and servers don't"""
+    head = bytes([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        head += bytes([mask_bit | len(payload)])
+    elif len(payload) < 65536:
+        head += bytes([mask_bit | 126]) + struct.pack("!H", len(payload))
+    else:
+        head += bytes([mask_bit | 127]) + struct.pack("!Q", len(payload))
+    if not mask:
+        return head + payload
+    key = os.urandom(4)
+    return head + key + bytes(byte ^ key[index % 4] for index, byte in enumerate(payload))
+
+
+async def read_websocket_frame(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if key:
+        payload = bytes(byte ^ key[index % 4] for index, byte in enumerate(payload))
+    return first & 0x0f, payload
+
+
+async def echo_websocket(request: Message, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    writer.write(
+        b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: " + websocket_accept(request.get("sec-websocket-key") or "").encode() + b"\r\n\r\n"
+    )
+    await writer.drain()
+    while True:
+        opcode, payload = await read_websocket_frame(reader)
+        writer.write(websocket_frame(opcode, payload, mask=False))
+        await writer.drain()
+        if opcode == WEBSOCKET_CLOSE:
+            break
+
+
+async def echo_upstream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, body: bytes = b"ok"):
+    """
+    Keep-alive http server answering every request with the same body, and echoing websocket messages
+    after an upgrade, stands in for code-server
+    """
+    try:
+        while True:
+            request = await read_head(reader)
+            if request is None:
+                break
+            if "websocket" in request.tokens("upgrade"):
+                await echo_websocket(request, reader, writer)
+                break
+            await copy_body(request.framing(), reader, NullWriter())
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, target: str,
+                       headers: dict | None = None, body: bytes = b"") -> tuple[Message | None, bytes]:
+    """One request on a keep-alive connection, the response head(None if the server closed) and body"""
+    lines = [f"{method} {target} HTTP/1.1", "Host: bench", *(f"{name}: {value}" for name, value in (headers or {}).items())]
+    if body or method in ("POST", "PUT", "PATCH"):
+        lines.append(f"Content-Length: {len(body)}")
+    writer.write("\r\n".join(lines).encode() + b"\r\n\r\n" + body)
+    await writer.drain()
+    response = await read_head(reader)
+    if response is None:
+        return None, b""
+    content = BufferWriter()
+    await copy_body(response.framing(), reader, content)
+    return response, content.getvalue()
+
+
+def status_of(response: Message | None) -> int:
+    return int(response.start_line.split(" ", 2)[1]) if response else 0
+
+
+async def http_client(host: str, port: int, target: str, requests: int, latencies: list[float]) -> int:
+    """One keep-alive connection sending `requests` GETs, returns the number of errors"""
+    errors = 0
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(requests):
+            started = time.perf_counter()
+            response, _ = await http_request(reader, writer, "GET", target)
+            if response is None:
+                errors += 1
+                break
+            if status_of(response) != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+    return errors
+
+
+async def websocket_client(host: str, port: int, target: str, messages: int, latencies: list[float], payload: bytes) -> int:
+    """One websocket sending `messages` messages and waiting for each echo, returns the number of errors"""
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    try:
+        writer.write(
+            f"GET {target} HTTP/1.1\r\nHost: {host}:{port}\r\nConnection: Upgrade\r\nUpgrade: websocket\r\n"
+            f"Sec-WebSocket-Version: 13\r\nSec-WebSocket-Key: {key}\r\n\r\n".encode()
+        )
+        await writer.drain()
+        response = await read_head(reader)
+        if status_of(response) != 101 or response.get("sec-websocket-accept") != websocket_accept(key):
+            return messages
+        for sent in range(messages):
+            started = time.perf_counter()
+            writer.write(websocket_frame(WEBSOCKET_TEXT, payload, mask=True))
+            await writer.drain()
+            _, echoed = await read_websocket_frame(reader)
+            if echoed != payload:
+                return messages - sent
+            latencies.append(time.perf_counter() - started)
+        writer.write(websocket_frame(WEBSOCKET_CLOSE, b"", mask=True))
+        await writer.drain()
+        await read_websocket_frame(reader)
+        return 0
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return 1
+    finally:
+        writer.close()
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from benchmarks.fake_docker import FakeEngine, install_cli
+from benchmarks.common import http_request, status_of, summarise, write_results
+
+# The control plane(under uvicorn) against the fake docker engine:
+# login_storm: /start for many users at once, every start a cold one(new volumes) unless the warm pool has one
+# report_full / report_delta: orchestrators polling /report while the containers exist, the delta ones
+#   with ?since and If-None-Match like machine-orchastrator does
+# monitor sweeps run in their own process(monitor_bench.py) so they get a fresh environment too.
+# Run from control-plane/: python -m benchmarks.control_plane_bench --users 200 --backend api
+
+BENCH_KEY = "control-plane-bench-key"
+BENCH_PORT_START = 21000
+
+
+def control_plane_env(workdir: str, socket_path: str, args) -> dict:
+    return {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])),
+        "DOCKER_SOCKET": socket_path,
+        "DOCKER_BACKEND": args.backend,
+        "PATH": f"{install_cli(os.path.join(workdir, 'bin'), socket_path)}:{os.environ['PATH']}",
+        "ROUTE_TABLE_PATH": os.path.join(workdir, "routes.bin"),
+        "X_ORCHASTRATOR_KEY": BENCH_KEY,
+        "PORT_POOL_START": str(BENCH_PORT_START),
+        "PORT_POOL_SIZE": str(args.users + args.warm_pool + 10),
+        "WARM_POOL_SIZE": str(args.warm_pool),
+        # the host's memory isn't what is measured
+        "MEMORY_OVERCOMMIT": "1000",
+        "RESERVED_MEMORY_MB": "0",
+    }
+
+
+async def wait_until_ready(port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            response, _ = await http_request(reader, writer, "GET", "/health")
+            writer.close()
+            if status_of(response) == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"control plane on {port} not ready")
+
+
+async def start_users(port: int, user_ids: list[str], latencies: list[float]) -> int:
+    """/start for each user in turn on one keep-alive connection, returns the number of errors"""
+    errors = 0
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = {"X-ORCHASTRATOR_KEY": BENCH_KEY, "Content-Type": "application/json"}
+    try:
+        for user_id in user_ids:
+            started = time.perf_counter()
+            response, _ = await http_request(reader, writer, "POST", "/start", headers, json.dumps({"user_id": user_id}).encode())
+            if status_of(response) != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+    return errors
+
+
+async def bench_login_storm(port: int, users: int, concurrency: int) -> dict:
+    user_ids = [f"bench-user-{index}" for index in range(users)]
+    latencies = []
+    started = time.perf_counter()
+    errors = await asyncio.gather(*(start_users(port, user_ids[index::concurrency], latencies) for index in range(concurrency)))
+    seconds = time.perf_counter() - started
+    return summarise("login_storm", latencies, seconds, sum(errors), users=users, concurrency=concurrency,
+                     containers_per_second=round((users - sum(errors)) / seconds, 1) if seconds else 0)
+
+
+async def poll_report(port: int, polls: int, delta: bool, latencies: list[float]) -> int:
+    errors = 0
+    version = etag = None
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for _ in range(polls):
+            headers = {"X-ORCHASTRATOR_KEY": BENCH_KEY}
+            target = "/report"
+            if delta and version:
+                headers["If-None-Match"] = etag
+                target = f"/report?since={version}"
+            started = time.perf_counter()
+            response, body = await http_request(reader, writer, "GET", target, headers)
+            status = status_of(response)
+            if status == 200:
+                version = json.loads(body)["version"]
+                etag = response.get("etag")
+            elif status != 304:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+    return errors
+
+
+async def bench_report(port: int, pollers: int, polls: int, delta: bool) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    errors = await asyncio.gather(*(poll_report(port, polls, delta, latencies) for _ in range(pollers)))
+    return summarise(f"report_{'delta' if delta else 'full'}", latencies, time.perf_counter() - started, sum(errors), pollers=pollers)
+
+
+async def bench_monitor(workdir: str, args) -> list[dict]:
+    output = os.path.join(workdir, "monitor.json")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.monitor_bench", "--sizes", *map(str, args.monitor_sizes),
+        "--backend", args.backend, "--latency-ms", str(args.latency_ms),
+        "--output", output, stdout=asyncio.subprocess.DEVNULL,
+    )
+    await process.wait()
+    with open(output) as file:
+        return json.load(file)["results"]
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="codespaces-control-plane-bench-")
+    socket_path = os.path.join(workdir, "docker.sock")
+    engine = FakeEngine(args.latency_ms / 1000, args.log_lines, serve_ports=args.serve_ports)
+    server = await engine.serve(socket_path)
+    results = []
+    async with server:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "control_plane:control_plane", "--host", "127.0.0.1", "--port", str(args.port),
+            "--log-level", "warning", cwd=workdir, env=control_plane_env(workdir, socket_path, args),
+            stdout=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            await wait_until_ready(args.port)
+            results.append(await bench_login_storm(args.port, args.users, args.concurrency))
+            results[-1]["docker_calls"] = engine.calls
+            for delta in (False, True):
+                results.append(await bench_report(args.port, args.pollers, args.polls, delta))
+        finally:
+            process.terminate()
+            await process.wait()
+    if args.monitor_sizes:
+        results += await bench_monitor(workdir, args)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control plane benchmark against a fake docker engine")
+    parser.add_argument("--port", type=int, default=16000)
+    parser.add_argument("--backend", default="api", choices=["api", "cli"])
+    parser.add_argument("--latency-ms", type=float, default=2, help="added to every docker call")
+    parser.add_argument("--log-lines", type=int, default=1000, help="log lines of every container")
+    parser.add_argument("--serve-ports", action="store_true", help="run an echo upstream on every container port")
+    parser.add_argument("--users", type=int, default=200, help="users in the login storm")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warm-pool", type=int, default=0)
+    parser.add_argument("--pollers", type=int, default=10)
+    parser.add_argument("--polls", type=int, default=100, help="/report requests per poller")
+    parser.add_argument("--monitor-sizes", nargs="*", type=int, default=[20, 100, 500], help="none to skip the sweeps")
+    parser.add_argument("--output", help="json file for the results")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,375 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import stat
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# Stand-in for the docker daemon: the engine api endpoints the control plane uses over a unix socket,
+# with a fixed latency per call and generated code-server logs. `install_cli` writes a fake `docker`
+# executable(fake_docker_cli.py) that talks to the same socket, so the cli backend shares the state.
+# With serve_ports every started container gets an http/websocket echo upstream on its port.
+# Run on its own: python -m benchmarks.fake_docker --socket /tmp/docker.sock --latency-ms 5
+
+CODE_SERVER_PORT = 8080
+ESTABLISHED_LINE = "New connection established"
+CLOSED_LINE = "The client has disconnected gracefully"
+NOISE_LINE = "[IPC Library: Pty Host] INFO Persistent process reconnection"
+STATS_INTERVAL_SECONDS = 1
+CLI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_docker_cli.py")
+
+
+def docker_timestamp(at: float) -> str:
+    return datetime.fromtimestamp(at, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f") + "000Z"
+
+
+class FakeContainer:
+    def __init__(self, image: str, name: str, port: int | None, labels: dict, created: float, args: list[str]):
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.image = image
+        self.name = name
+        self.port = port
+        self.labels = labels
+        self.created = created
+        self.args = args
+        self.state = "created"
+        self.auto_remove = False
+        # (unix seconds, line)
+        self.logs: list[tuple[float, str]] = []
+        self.upstream: asyncio.AbstractServer | None = None
+
+    def api(self) -> dict:
+        ports = [{"PrivatePort": CODE_SERVER_PORT, "PublicPort": self.port, "Type": "tcp", "IP": "0.0.0.0"}] if self.port else []
+        return {
+            "Id": self.id,
+            "Names": [f"/{self.name}"],
+            "Image": self.image,
+            "State": self.state,
+            "Ports": ports,
+            "Created": int(self.created),
+            "Labels": self.labels,
+        }
+
+
+class FakeEngine:
+    def __init__(self, latency: float = 0.0, log_lines: int = 100, serve_ports: bool = False):
+        self.latency = latency
+        self.log_lines = log_lines
+        self.serve_ports = serve_ports
+        self.containers: dict[str, FakeContainer] = {}
+        self.volumes: dict[str, dict] = {}
+        self.calls = 0
+
+    def add(self, image: str, port: int | None, name: str | None = None, labels: dict | None = None,
+            created: float | None = None, active: bool = True, args: list[str] | None = None) -> FakeContainer:
+        """A running container with `log_lines` lines of logs, ending connected(active) or disconnected long ago"""
+        created = created or time.time()
+        container = FakeContainer(image, name or f"fake_{port}_{len(self.containers)}", port, labels or {}, created, args or [])
+        container.state = "running"
+        self.write_logs(container, active)
+        self.containers[container.id] = container
+        return container
+
+    def write_logs(self, container: FakeContainer, active: bool):
+        now = time.time()
+        step = (now - container.created) / max(1, self.log_lines)
+        container.logs = [(container.created + step * index, NOISE_LINE) for index in range(self.log_lines)]
+        if active:
+            container.logs.append((now - 1, ESTABLISHED_LINE))
+        elif container.logs:
+            middle = container.logs[len(container.logs) // 2][0]
+            container.logs += [(middle, ESTABLISHED_LINE), (middle + step / 2, CLOSED_LINE)]
+
+    def find(self, container_id: str) -> FakeContainer | None:
+        container = self.containers.get(container_id)
+        if container:
+            return container
+        # like docker, a unique prefix or the name works too
+        matches = [c for c in self.containers.values() if c.id.startswith(container_id) or c.name == container_id]
+        return matches[0] if len(matches) == 1 else None
+
+    def matches(self, container: FakeContainer, filters: dict) -> bool:
+        for key, values in filters.items():
+            for value in values:
+                if key == "ancestor" and not container.image.startswith(value):
+                    return False
+                if key == "publish" and str(container.port) != value.split("/")[0]:
+                    return False
+                if key == "label":
+                    name, _, expected = value.partition("=")
+                    if name not in container.labels or (expected and container.labels[name] != expected):
+                        return False
+                if key == "status" and container.state != value:
+                    return False
+        return True
+
+    async def start_upstream(self, container: FakeContainer):
+        if self.serve_ports and container.port:
+            from benchmarks.common import echo_upstream
+            container.upstream = await asyncio.start_server(echo_upstream, "127.0.0.1", container.port)
+
+    def remove(self, container: FakeContainer):
+        self.containers.pop(container.id, None)
+        if container.upstream:
+            container.upstream.close()
+
+    def stats(self, container: FakeContainer) -> dict:
+        usage = 150 * 1024 ** 2 + len(container.logs) * 1024
+        total = int(time.time() * 1e9)
+        return {
+            "read": docker_timestamp(time.time()),
+            "cpu_stats": {"cpu_usage": {"total_usage": total // 100}, "system_cpu_usage": total, "online_cpus": os.cpu_count() or 1},
+            "precpu_stats": {"cpu_usage": {"total_usage": (total - 10 ** 9) // 100}, "system_cpu_usage": total - 10 ** 9},
+            "memory_stats": {"usage": usage, "stats": {"inactive_file": 0}, "limit": 8 * 1024 ** 3},
+        }
+
+    # (method, path pattern) => handler(match, query, body) -> (status, payload)
+    def routes(self):
+        return [
+            ("GET", r"/_ping", self.ping),
+            ("GET", r"/containers/json", self.list_containers),
+            ("POST", r"/containers/create", self.create),
+            ("GET", r"/containers/([^/]+)/json", self.inspect),
+            ("POST", r"/containers/([^/]+)/start", self.start),
+            ("POST", r"/containers/([^/]+)/stop", self.stop),
+            ("POST", r"/containers/([^/]+)/pause", self.pause),
+            ("POST", r"/containers/([^/]+)/unpause", self.unpause),
+            ("POST", r"/containers/([^/]+)/wait", self.wait),
+            ("DELETE", r"/containers/([^/]+)", self.delete),
+            ("GET", r"/containers/([^/]+)/logs", self.logs),
+            ("GET", r"/containers/([^/]+)/stats", self.stats_once),
+            ("GET", r"/images/(.+)/json", self.image),
+            ("POST", r"/images/create", self.pull),
+            ("POST", r"/volumes/create", self.create_volume),
+            ("GET", r"/volumes", self.list_volumes),
+            ("DELETE", r"/volumes/([^/]+)", self.delete_volume),
+            ("GET", r"/system/df", self.system_df),
+        ]
+
+    async def ping(self, match, query, body):
+        return 200, "OK"
+
+    async def list_containers(self, match, query, body):
+        filters = json.loads(query.get("filters", "{}"))
+        running = [c for c in self.containers.values() if c.state in ("running", "paused")]
+        return 200, [c.api() for c in running if self.matches(c, filters)]
+
+    async def create(self, match, query, body):
+        host_config = body.get("HostConfig") or {}
+        bindings = (host_config.get("PortBindings") or {}).get(f"{CODE_SERVER_PORT}/tcp") or []
+        port = int(bindings[0]["HostPort"]) if bindings else None
+        name = query.get("name") or f"fake_{uuid.uuid4().hex[:8]}"
+        if any(c.name == name for c in self.containers.values()):
+            return 409, {"message": f"Conflict. The container name \"/{name}\" is already in use"}
+        container = FakeContainer(body["Image"], name, port, body.get("Labels") or {}, time.time(), body.get("Cmd") or [])
+        container.auto_remove = bool(host_config.get("AutoRemove"))
+        self.containers[container.id] = container
+        return 201, {"Id": container.id, "Warnings": []}
+
+    async def inspect(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": f"No such container: {match.group(1)}"}
+        return 200, {
+            "Id": container.id,
+            "Name": f"/{container.name}",
+            "Created": docker_timestamp(container.created),
+            "State": {"Status": container.state, "Running": container.state == "running", "Paused": container.state == "paused"},
+            "Config": {"Image": container.image, "Labels": container.labels},
+        }
+
+    async def start(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        container.state = "running"
+        container.created = time.time()
+        self.write_logs(container, active=True)
+        await self.start_upstream(container)
+        return 204, None
+
+    async def stop(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        if container.state == "exited":
+            return 304, None
+        container.state = "exited"
+        if container.auto_remove:
+            self.remove(container)
+        return 204, None
+
+    async def pause(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container or container.state != "running":
+            return 409 if container else 404, {"message": "not running"}
+        container.state = "paused"
+        return 204, None
+
+    async def unpause(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container or container.state != "paused":
+            return 409 if container else 404, {"message": "not paused"}
+        container.state = "running"
+        return 204, None
+
+    async def wait(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        container.state = "exited"
+        return 200, {"StatusCode": 0}
+
+    async def delete(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        self.remove(container)
+        return 204, None
+
+    async def logs(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        since = float(query.get("since", 0) or 0)
+        timestamps = query.get("timestamps") in ("1", "true")
+        lines = [
+            f"{docker_timestamp(at)} {line}" if timestamps else line
+            for at, line in container.logs if at > since
+        ]
+        # tty containers send plain text
+        return 200, ("\n".join(lines) + "\n" if lines else "").encode()
+
+    async def stats_once(self, match, query, body):
+        container = self.find(match.group(1))
+        if not container:
+            return 404, {"message": "No such container"}
+        return 200, self.stats(container)
+
+    async def image(self, match, query, body):
+        return 200, {"Id": f"sha256:{uuid.uuid5(uuid.NAMESPACE_URL, match.group(1)).hex}", "RepoTags": [match.group(1)]}
+
+    async def pull(self, match, query, body):
+        return 200, b'{"status":"Status: Image is up to date"}\n'
+
+    async def create_volume(self, match, query, body):
+        self.volumes[body["Name"]] = body.get("Labels") or {}
+        return 201, {"Name": body["Name"], "Labels": self.volumes[body["Name"]]}
+
+    async def list_volumes(self, match, query, body):
+        filters = json.loads(query.get("filters", "{}"))
+        volumes = []
+        for name, labels in self.volumes.items():
+            wanted = [value.partition("=") for value in filters.get("label", [])]
+            if all(key in labels and (not value or labels[key] == value) for key, _, value in wanted):
+                volumes.append({"Name": name, "Labels": labels})
+        return 200, {"Volumes": volumes}
+
+    async def delete_volume(self, match, query, body):
+        if self.volumes.pop(unquote(match.group(1)), None) is None:
+            return 404, {"message": "no such volume"}
+        return 204, None
+
+    async def system_df(self, match, query, body):
+        return 200, {"Volumes": [{"Name": name, "UsageData": {"Size": 0, "RefCount": 0}} for name in self.volumes]}
+
+    async def stream_stats(self, writer: asyncio.StreamWriter, container_id: str):
+        """stats with stream=true, one chunk a second till the container is gone or the client leaves"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+        while (container := self.find(container_id)) and container.state in ("running", "paused"):
+            chunk = json.dumps(self.stats(container)).encode() + b"\n"
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def dispatch(self, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        payload = json.loads(body) if body else {}
+        for route_method, pattern, handler in self.routes():
+            match = re.fullmatch(pattern, url.path)
+            if match and method == route_method:
+                return await handler(match, query, payload)
+        return 404, {"message": f"page not found: {method} {url.path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in lines[1:] if line)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.calls += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                url = urlsplit(target)
+                stats = re.fullmatch(r"/containers/([^/]+)/stats", url.path)
+                if stats and parse_qs(url.query).get("stream", ["true"])[-1] in ("1", "true"):
+                    await self.stream_stats(writer, stats.group(1))
+                    continue
+
+                status, payload = await self.dispatch(method, target, body)
+                if payload is None:
+                    data = b""
+                elif isinstance(payload, bytes):
+                    data = payload
+                else:
+                    data = json.dumps(payload).encode() if not isinstance(payload, str) else payload.encode()
+                writer.write(f"HTTP/1.1 {status} Fake\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str) -> asyncio.AbstractServer:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return await asyncio.start_unix_server(self.handle, socket_path)
+
+
+def install_cli(bin_dir: str, socket_path: str) -> str:
+    """Writes a `docker` executable into bin_dir that drives the fake engine on socket_path, returns bin_dir for PATH"""
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "docker")
+    with open(path, "w") as script:
+        script.write(f'#!/bin/sh\nFAKE_DOCKER_SOCKET="{socket_path}" exec "{sys.executable}" "{CLI_SCRIPT}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+async def main(args):
+    engine = FakeEngine(args.latency_ms / 1000, args.log_lines, args.serve_ports)
+    for index in range(args.containers):
+        engine.add("codercom/code-server", args.port_start + index, created=time.time() - 3600)
+    server = await engine.serve(args.socket)
+    if args.cli_dir:
+        install_cli(args.cli_dir, args.socket)
+        print(f"Fake docker cli in {args.cli_dir}, prepend it to PATH")
+    print(f"Fake docker engine on {args.socket} with {args.containers} containers")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake docker engine for the benchmarks")
+    parser.add_argument("--socket", default="/tmp/codespaces-fake-docker.sock")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--log-lines", type=int, default=100)
+    parser.add_argument("--containers", type=int, default=0, help="running code-server containers to start with")
+    parser.add_argument("--port-start", type=int, default=3001)
+    parser.add_argument("--serve-ports", action="store_true", help="run an echo upstream on every container port")
+    parser.add_argument("--cli-dir", help="also write a fake docker executable here")
+    asyncio.run(main(parser.parse_args()))
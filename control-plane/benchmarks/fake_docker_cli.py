@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import socket
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import urlencode, quote
+
+# The `docker` executable of the benchmarks(installed by fake_docker.install_cli): the subset of the cli the
+# control plane's cli backend calls, answered by the fake engine on FAKE_DOCKER_SOCKET in the cli's output formats.
+
+SOCKET_PATH = os.environ.get("FAKE_DOCKER_SOCKET", "/tmp/codespaces-fake-docker.sock")
+# flags that take a value, everything else is a switch
+VALUE_FLAGS = {"-p", "--name", "--label", "-v", "--cpu-shares", "--memory", "--memory-swap", "--entrypoint",
+               "--user", "--filter", "--format", "-t", "--since"}
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__("docker")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def engine(method: str, path: str, params: dict | None = None, body: dict | None = None):
+    connection = UnixConnection(SOCKET_PATH)
+    target = f"{path}?{urlencode(params)}" if params else path
+    connection.request(method, target, body=json.dumps(body) if body is not None else None,
+                       headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    if response.status >= 400:
+        message = json.loads(data).get("message", "") if data else ""
+        fail(f"Error response from daemon: {message}")
+    return json.loads(data) if data and data[:1] in (b"{", b"[") else data
+
+
+def fail(message: str):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+
+def parse(args: list[str]) -> tuple[dict[str, list[str]], list[str]]:
+    """--flag value pairs and switches until the first positional, the rest is positional"""
+    flags: dict[str, list[str]] = {}
+    index = 0
+    while index < len(args) and args[index].startswith("-"):
+        flag = args[index]
+        if flag in VALUE_FLAGS:
+            flags.setdefault(flag, []).append(args[index + 1])
+            index += 2
+        else:
+            flags.setdefault(flag, []).append("")
+            index += 1
+    return flags, args[index:]
+
+
+def filters(flags: dict) -> dict:
+    result: dict[str, list[str]] = {}
+    for value in flags.get("--filter", []):
+        key, _, value = value.partition("=")
+        result.setdefault(key, []).append(value)
+    return result
+
+
+def cli_size(size: float) -> str:
+    return f"{size / 1024 ** 2:.2f}MiB"
+
+
+def cli_stats(stats: dict) -> dict:
+    cpu = stats["cpu_stats"]
+    precpu = stats["precpu_stats"]
+    system_delta = cpu["system_cpu_usage"] - precpu["system_cpu_usage"]
+    cpu_delta = cpu["cpu_usage"]["total_usage"] - precpu["cpu_usage"]["total_usage"]
+    percent = cpu_delta / system_delta * cpu["online_cpus"] * 100 if system_delta else 0.0
+    memory = stats["memory_stats"]
+    return {"CPUPerc": f"{percent:.2f}%", "MemUsage": f"{cli_size(memory['usage'])} / {cli_size(memory['limit'])}"}
+
+
+def ps(args):
+    flags, _ = parse(args)
+    for container in engine("GET", "/containers/json", {"filters": json.dumps(filters(flags))}):
+        created = datetime.fromtimestamp(container["Created"], tz=timezone.utc)
+        print(json.dumps({
+            "ID": container["Id"],
+            "Names": container["Names"][0].lstrip("/"),
+            "Image": container["Image"],
+            "State": container["State"],
+            "Ports": ", ".join(f"0.0.0.0:{p['PublicPort']}->{p['PrivatePort']}/tcp" for p in container["Ports"]),
+            "CreatedAt": created.strftime("%Y-%m-%d %H:%M:%S +0000 UTC"),
+            "Labels": ",".join(f"{key}={value}" for key, value in container["Labels"].items()),
+        }))
+
+
+def inspect(args):
+    print(json.dumps([engine("GET", f"/containers/{container_id}/json") for container_id in args]))
+
+
+def image(args):
+    if args[0] != "inspect":
+        fail(f"unknown image command {args[0]}")
+    print(json.dumps([engine("GET", f"/images/{name}/json") for name in args[1:]]))
+
+
+def pull(args):
+    engine("POST", "/images/create", {"fromImage": args[-1]})
+    print(f"Status: Image is up to date for {args[-1]}")
+
+
+def create_body(flags: dict, positional: list[str]) -> dict:
+    labels = dict(label.strip('"').split("=", 1) for label in flags.get("--label", []))
+    binds = flags.get("-v", [])
+    host_config = {"AutoRemove": "--rm" in flags, "Binds": binds}
+    if "-p" in flags:
+        host_port, _, container_port = flags["-p"][0].partition(":")
+        host_config["PortBindings"] = {f"{container_port}/tcp": [{"HostPort": host_port}]}
+    body = {"Image": positional[0], "Cmd": positional[1:], "Labels": labels, "HostConfig": host_config}
+    if "--entrypoint" in flags:
+        body["Entrypoint"] = flags["--entrypoint"]
+    return body
+
+
+def create(args):
+    flags, positional = parse(args)
+    params = {"name": flags["--name"][0]} if "--name" in flags else None
+    print(engine("POST", "/containers/create", params, create_body(flags, positional))["Id"])
+
+
+def run(args):
+    flags, positional = parse(args)
+    params = {"name": flags["--name"][0]} if "--name" in flags else None
+    container_id = engine("POST", "/containers/create", params, create_body(flags, positional))["Id"]
+    engine("POST", f"/containers/{container_id}/start")
+    if "-d" in flags:
+        print(container_id)
+        return
+    # attached: runs to completion
+    engine("POST", f"/containers/{container_id}/wait")
+    if "--rm" in flags:
+        engine("DELETE", f"/containers/{container_id}")
+
+
+def container_command(action: str):
+    def command(args):
+        flags, positional = parse(args)
+        for container_id in positional:
+            engine("POST", f"/containers/{container_id}/{action}")
+            print(container_id)
+    return command
+
+
+def rm(args):
+    _, positional = parse(args)
+    for container_id in positional:
+        engine("DELETE", f"/containers/{container_id}", {"force": "true"})
+        print(container_id)
+
+
+def stats(args):
+    flags, positional = parse(args)
+    container_id = positional[0]
+    while True:
+        sample = engine("GET", f"/containers/{container_id}/stats", {"stream": "false"})
+        print(json.dumps(cli_stats(sample)), flush=True)
+        if "--no-stream" in flags:
+            return
+        time.sleep(1)
+
+
+def logs(args):
+    flags, positional = parse(args)
+    params = {"stdout": 1, "timestamps": int("--timestamps" in flags)}
+    if "--since" in flags:
+        params["since"] = flags["--since"][0]
+    sys.stdout.write(engine("GET", f"/containers/{positional[0]}/logs", params).decode())
+
+
+def volume(args):
+    command, args = args[0], args[1:]
+    flags, positional = parse(args)
+    if command == "create":
+        labels = dict(label.split("=", 1) for label in flags.get("--label", []))
+        print(engine("POST", "/volumes/create", body={"Name": positional[0], "Labels": labels})["Name"])
+    elif command == "rm":
+        for name in positional:
+            engine("DELETE", f"/volumes/{quote(name)}")
+            print(name)
+    elif command == "ls":
+        for item in engine("GET", "/volumes", {"filters": json.dumps(filters(flags))})["Volumes"]:
+            labels = ",".join(f"{key}={value}" for key, value in (item["Labels"] or {}).items())
+            print(json.dumps({"Name": item["Name"], "Driver": "local", "Labels": labels}))
+    else:
+        fail(f"unknown volume command {command}")
+
+
+def system(args):
+    if args[0] != "df":
+        fail(f"unknown system command {args[0]}")
+    volumes = engine("GET", "/system/df")["Volumes"]
+    print(json.dumps([{"Name": item["Name"], "Size": f"{item['UsageData']['Size']}B"} for item in volumes]))
+
+
+COMMANDS = {
+    "ps": ps,
+    "inspect": inspect,
+    "image": image,
+    "pull": pull,
+    "create": create,
+    "run": run,
+    "stop": container_command("stop"),
+    "pause": container_command("pause"),
+    "unpause": container_command("unpause"),
+    "rm": rm,
+    "stats": stats,
+    "logs": logs,
+    "volume": volume,
+    "system": system,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        fail(f"fake docker: unsupported command {' '.join(sys.argv[1:])}")
+    try:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from benchmarks.fake_docker import FakeEngine, install_cli
+
+# Duration of the monitor's sweeps over 20 to 500 running containers served by the fake docker engine,
+# with the users' activity written to an activity table like the proxy does.
+# cold: new scheduler, every container is listed and checked
+# steady: every container due again on the same scheduler, no listing
+# Run from control-plane/: python -m benchmarks.monitor_bench --sizes 20 100 500 --backend api
+# The control plane modules read their settings on import, so they are imported once the environment
+# points at the fake engine and a scratch directory.
+
+BENCH_PORT_START = 20000
+
+
+async def bench_size(engine: FakeEngine, size: int, idle_percent: float, repeats: int) -> list[dict]:
+    from cache import set_user_container, remove_containers
+    import codermon
+    from codermon import MonitorScheduler, CODE_SERVER_IMAGE
+    from activity import ActivityTable, worker_path
+    from telemetry import telemetry
+    from benchmarks.common import summarise
+
+    idle = int(size * idle_percent / 100)
+    containers = [
+        engine.add(CODE_SERVER_IMAGE, BENCH_PORT_START + index, created=time.time() - 3600, active=index >= idle)
+        for index in range(size)
+    ]
+    # no grace for the proxy to flush after boot, the activity is written up front
+    codermon.MONITOR_STARTED_AT = 0
+    activity = ActivityTable(worker_path("bench"))
+    for index, container in enumerate(containers):
+        await set_user_container(f"monitor-bench-{index}", container.id, container.port)
+        active = index >= idle
+        activity.update(f"monitor-bench-{index}", time.time() - (0 if active else 3600), int(active), 0, 0)
+    activity.mark_flushed()
+
+    results = []
+    cold, steady = [], []
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(repeats):
+                scheduler = MonitorScheduler()
+                started = time.perf_counter()
+                await scheduler.sweep()
+                cold.append(time.perf_counter() - started)
+
+                for container_id in scheduler.containers:
+                    scheduler.schedule(container_id, 0)
+                started = time.perf_counter()
+                await scheduler.sweep()
+                steady.append(time.perf_counter() - started)
+            telemetry.track(set())
+        for name, latencies in (("cold", cold), ("steady", steady)):
+            seconds = sum(latencies)
+            results.append(summarise(f"monitor_sweep_{name}_{size}", latencies, seconds, containers=size,
+                                     containers_per_second=round(size * len(latencies) / seconds, 1) if seconds else 0))
+    finally:
+        await remove_containers([container.id for container in containers])
+        for container in containers:
+            engine.remove(container)
+    return results
+
+
+async def main(args):
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="codespaces-monitor-bench-")
+    socket_path = os.path.join(workdir, "docker.sock")
+    engine = FakeEngine(args.latency_ms / 1000)
+    server = await engine.serve(socket_path)
+    os.environ.update({
+        "DOCKER_SOCKET": socket_path,
+        "DOCKER_BACKEND": args.backend,
+        "ROUTE_TABLE_PATH": os.path.join(workdir, "routes.bin"),
+        "MONITOR_WORKERS": str(args.workers),
+        "ACTIVITY_DIR": os.path.join(workdir, "activity"),
+        "PATH": f"{install_cli(os.path.join(workdir, 'bin'), socket_path)}:{os.environ['PATH']}",
+    })
+    sys.path.insert(0, os.getcwd())
+    os.chdir(workdir)
+
+    from cache import load_cache
+    from benchmarks.common import write_results
+    load_cache()
+    results = []
+    async with server:
+        for size in args.sizes:
+            results += await bench_size(engine, size, args.idle_percent, args.repeats)
+    write_results(results, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monitor sweep benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[20, 100, 500], help="running containers")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--idle-percent", type=float, default=10, help="containers found idle(and paused) by the first sweep")
+    parser.add_argument("--backend", default="api", choices=["api", "cli"])
+    parser.add_argument("--latency-ms", type=float, default=2, help="added to every docker call")
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--output", help="json file for the results")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+from functools import partial
+from cache import set_user_container, remove_containers
+from utils import get_token
+from benchmarks.common import echo_upstream, http_client, websocket_client, summarise, write_results
+
+# Requests/sec and latency of the proxy engines against a local echo upstream, then message round trips
+# over many websockets at once(code-server's traffic once a workspace is open).
+# Run from control-plane/: python -m benchmarks.proxy_bench --engines native mitm
+
+BENCH_USER_ID = "proxy-bench-user"
+BENCH_CONTAINER_ID = "proxy-bench-container"
+
+
+def engine_command(engine: str, port: int, metrics_port: int) -> list[str]:
+    if engine == "native":
+        return [sys.executable, "proxy_server.py", "--host", "127.0.0.1", "--port", str(port), "--metrics-port", str(metrics_port)]
+    return ["mitmdump", "-q", "-s", "proxy.py", "--mode", "regular", "--listen-host", "127.0.0.1",
+            "--listen-port", str(port), "--set", "block_global=false"]
+
+
+async def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"nothing listening on {port}")
+
+
+async def bench_engine(engine: str, port: int, upstream_port: int, token: str, args) -> list[dict]:
+    metrics_port = port + 1000
+    process = await asyncio.create_subprocess_exec(
+        *engine_command(engine, port, metrics_port),
+        env={**os.environ, "PROXY_METRICS_PORT": str(metrics_port)},
+    )
+    try:
+        await wait_for_port(port)
+        # absolute-form so the same request works for mitmproxy in regular mode
+        target = f"http://127.0.0.1:{upstream_port}/bench?token={token}"
+        # warm up the route cache and the upstream pool
+        await http_client("127.0.0.1", port, target, 10, [])
+
+        latencies = []
+        started = time.perf_counter()
+        errors = await asyncio.gather(*(
+            http_client("127.0.0.1", port, target, args.requests, latencies) for _ in range(args.connections)
+        ))
+        results = [summarise(f"proxy_{engine}", latencies, time.perf_counter() - started, sum(errors), connections=args.connections)]
+
+        if args.ws_connections:
+            payload = b"x" * args.ws_bytes
+            latencies = []
+            started = time.perf_counter()
+            errors = await asyncio.gather(*(
+                websocket_client("127.0.0.1", port, target, args.ws_messages, latencies, payload)
+                for _ in range(args.ws_connections)
+            ))
+            results.append(summarise(f"proxy_{engine}_websocket", latencies, time.perf_counter() - started, sum(errors),
+                                     connections=args.ws_connections))
+        return results
+    finally:
+        process.terminate()
+        await process.wait()
+
+
+async def main(args):
+    upstream = await asyncio.start_server(partial(echo_upstream, body=b"x" * args.body_bytes), "127.0.0.1", 0)
+    upstream_port = upstream.sockets[0].getsockname()[1]
+    await set_user_container(BENCH_USER_ID, BENCH_CONTAINER_ID, upstream_port)
+    token = get_token(BENCH_USER_ID)
+    results = []
+    try:
+        for index, engine in enumerate(args.engines):
+            results += await bench_engine(engine, args.port + index, upstream_port, token, args)
+    finally:
+        await remove_containers([BENCH_CONTAINER_ID])
+        upstream.close()
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proxy engine benchmark")
+    parser.add_argument("--engines", nargs="+", default=["native", "mitm"], choices=["native", "mitm"])
+    parser.add_argument("--port", type=int, default=15000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200, help="requests per connection")
+    parser.add_argument("--body-bytes", type=int, default=1024)
+    parser.add_argument("--ws-connections", type=int, default=200, help="websockets open at once, 0 to skip")
+    parser.add_argument("--ws-messages", type=int, default=50, help="messages per websocket")
+    parser.add_argument("--ws-bytes", type=int, default=128)
+    parser.add_argument("--output", help="json file for the results")
+    asyncio.run(main(parser.parse_args()))
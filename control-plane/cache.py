@@ -1,115 +1,235 @@
-from pycache.py_cache import PyCache
-from pycache.adapters.SQLite import SQLite
-from pycache.datatypes.String import String
-from pycache.datatypes.Map import Map
-from pycache.datatypes.Set import Set
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable
+from kv import KV
+from ports import port_allocator, DB_PATH
+from change_feed import change_feed
+from route_table import route_table
+from routing_tokens import revocations
 
 # user_id => container_id
-user_cache = PyCache(SQLite("containers.db", "users"))
+USERS = "kv_users"
 # container_id => {user_id, port, ...}
-container_cache = PyCache(SQLite("containers.db", "containers_metadata"))
-# ports metadata
-ports_cache = PyCache(SQLite("containers.db", "ports_metadata"))
+CONTAINERS = "kv_containers_metadata"
+# routes version => bumped whenever a user => container mapping changes, the proxy drops its route cache on a change
+META = "kv_meta"
+ROUTES_VERSION_KEY = "routes_version"
+# container_id => {port, volumes} of the pre-started containers not bound to any user yet
+WARM_POOL = "kv_warm_pool"
+# user_id => {volumes: {kind: volume name}, last_used} of the persistent workspace volumes
+VOLUMES = "kv_volumes"
 
-DEFAULT_TTL_SECONDS = 15 * 60  # 15 minutes
-
-
-async def initialize_port_pool():
-    async with ports_cache.session() as session:
-        # 20 ports
-        port_set = Set([p for p in range(3001, 3021)])
-        await session.set("ports_pool", port_set)
-
-async def get_free_port() -> int | None:
-    async with ports_cache.session() as session:
-        port_set = await session.get("ports_pool")
-        if not port_set or len(port_set) == 0:
-            return None
+kv = KV(DB_PATH, [USERS, CONTAINERS, META, WARM_POOL, VOLUMES])
 
-        free_port = next(iter(port_set))
-        port_set.remove(free_port)
-        await session.set("ports_pool", Set(port_set))
-        return int(str(free_port))
-
-async def release_port(port: int):
-    async with ports_cache.session() as session:
-        port_set: Set = await session.get("ports_pool")
-        port_set.add(port)
-        await session.set("ports_pool", Set(port_set))
+DEFAULT_TTL_SECONDS = 15 * 60  # 15 minutes
+KV_SWEEP_INTERVAL_SECONDS = int(os.environ.get("KV_SWEEP_INTERVAL_SECONDS", 30))
+
+
+def load_cache():
+    """Only the control plane calls this, its reads are served from memory after it"""
+    kv.load()
+
+async def sweep_expired(on_expired: Callable[[list[str]], Awaitable]):
+    """
+    Expired mappings are dropped in bulk, the proxy stops routing to them like it did when they expired in the KV.
+    Their containers go to `on_expired`(the teardown), which releases the ports once they are gone
+    """
+    while True:
+        await asyncio.sleep(KV_SWEEP_INTERVAL_SECONDS)
+        try:
+            expired = kv.sweep()
+        except Exception as e:
+            print(f"Error sweeping expired cache entries: {e}")
+            continue
+        revocations.update(revoked=[
+            container_id for container_id, metadata in expired[CONTAINERS].items() if metadata and "user_id" in metadata
+        ])
+        for container_id, metadata in expired[CONTAINERS].items():
+            if metadata and "user_id" in metadata:
+                route_table.remove(str(metadata["user_id"]))
+            change_feed.publish(container_id, "remove")
+        if expired[CONTAINERS]:
+            bump_routes_version()
+            try:
+                await on_expired(list(expired[CONTAINERS]))
+            except Exception as e:
+                print(f"Error tearing down {len(expired[CONTAINERS])} expired containers: {e}")
+
+
+def bump_routes_version():
+    # a timestamp instead of a counter so it is a blind write
+    kv.set(META, ROUTES_VERSION_KEY, str(time.time_ns()))
+
+async def get_routes_version():
+    return kv.get(META, ROUTES_VERSION_KEY)
 
 
 async def set_user_container(user_id: str, container_id: str, port: int, ttl: int = DEFAULT_TTL_SECONDS):
-    async with user_cache.session() as user_session, container_cache.session() as container_session:
-        # user_id => container_id
-        await user_session.set(user_id, String(container_id))
-        await user_session.set_expire(user_id, ttl)
-        
-        # Save container_id => Map(user_id, port)
-        metadata = Map({
-            "user_id": user_id,
-            "port": port,
+    await set_user_containers([(user_id, container_id, port)], ttl)
+
+async def set_user_containers(bindings: list[tuple[str, str, int]], ttl: int = DEFAULT_TTL_SECONDS):
+    """(user_id, container_id, port) mappings of many users in one transaction"""
+    now = time.time()
+    with kv.batch():
+        for user_id, container_id, port in bindings:
+            # user_id => container_id
+            kv.set(USERS, user_id, container_id, ttl)
+            # assigned_at is when the user got the container, warm pool containers are started long before that
+            kv.set(CONTAINERS, container_id, {
+                "user_id": user_id,
+                "port": port,
+                "assigned_at": now,
+            }, ttl)
+        if bindings:
+            bump_routes_version()
+    for user_id, container_id, port in bindings:
+        route_table.set(user_id, int(port))
+        change_feed.publish(container_id, "upsert", {"user_id": user_id, "port": port, "state": "running"})
+
+async def update_containers(updates: dict[str, dict], ttl: int = DEFAULT_TTL_SECONDS):
+    """
+    Merges the fields into the metadata of each container(and resets both ttls) in one transaction.
+    A `state` of paused is mirrored to the route table so the proxy resumes the container first
+    """
+    updated = {}
+    with kv.batch():
+        for container_id, fields in updates.items():
+            metadata = kv.get(CONTAINERS, container_id)
+            # a draining container is never routed to again
+            if not metadata or "user_id" not in metadata or metadata.get("state") == "draining":
+                continue
+            metadata = {**metadata, **fields}
+            kv.set(CONTAINERS, container_id, metadata, ttl)
+            kv.expire(USERS, metadata["user_id"], ttl)
+            updated[container_id] = metadata
+        if updated:
+            bump_routes_version()
+    # the revocation file first, the proxy rereads it once the route table changes
+    revocations.update(paused={container_id: metadata.get("state") == "paused" for container_id, metadata in updated.items()})
+    for container_id, metadata in updated.items():
+        route_table.set(str(metadata["user_id"]), int(str(metadata["port"])), paused=metadata.get("state") == "paused")
+        change_feed.publish(container_id, "upsert", {
+            "user_id": metadata["user_id"],
+            "port": metadata["port"],
+            "state": metadata.get("state", "running"),
         })
-        await container_session.set(container_id, metadata)
-        await container_session.set_expire(container_id, ttl)
-
-async def update_ttl(user_id: str, ttl: int = DEFAULT_TTL_SECONDS):
-    async with user_cache.session() as user_session:
-        container_id = await user_session.get(user_id)
-
-    if container_id:
-        container_id = str(container_id)
-        async with container_cache.session() as container_session:
-            metadata = await container_session.get(container_id)
-
-        if metadata:
-            # Re-set both with updated TTL
-            async with user_cache.session() as user_session, container_cache.session() as container_session:
-                await user_session.set(user_id, String(container_id))
-                await user_session.set_expire(user_id, ttl)
-
-                await container_session.set(container_id, metadata)
-                await container_session.set_expire(container_id, ttl)
-
-async def remove_user_by_id(user_id: str):
-    async with user_cache.session() as user_session:
-        container_id = await user_session.get(user_id)
-
-    if container_id:
-        container_id = str(container_id)
-        async with container_cache.session() as container_session:
-            await container_session.delete(container_id)
-        async with user_cache.session() as user_session:
-            await user_session.delete(user_id)
-
-async def remove_container_by_id(container_id: str):
-    async with container_cache.session() as container_session:
-        metadata = await container_session.get(container_id)
-    if metadata and "user_id" in metadata:
-        user_id = metadata["user_id"]
-        port = metadata["port"]
-        await release_port(port)
-        async with user_cache.session() as user_session:
-            await user_session.delete(user_id)
-
-    async with container_cache.session() as container_session:
-        await container_session.delete(container_id)
+    return updated
+
+def expire_user(user_id: str, ttl: int):
+    container_id = kv.get(USERS, user_id)
+    # only the expiry timestamps are written
+    if container_id and kv.expire(CONTAINERS, container_id, ttl):
+        kv.expire(USERS, user_id, ttl)
+
+async def refresh_ttls(user_ids: list[str], ttl: int = DEFAULT_TTL_SECONDS):
+    """Moves the expiry of the mappings of the users in one transaction"""
+    with kv.batch():
+        for user_id in user_ids:
+            expire_user(user_id, ttl)
+
+def touch_volumes(user_id: str):
+    # the volumes were last used when the container of the user went away
+    record = kv.get(VOLUMES, user_id)
+    if record:
+        kv.set(VOLUMES, user_id, {**record, "last_used": time.time()})
+
+async def mark_draining(container_ids: list[str]) -> dict[str, dict]:
+    """
+    Unbinds the containers from their users in one transaction, the proxy stops routing to them and the users can
+    get new ones right away. The metadata(`state: draining`, no ttl) and the port stay till the container is gone.
+    Returns container_id => metadata of the ones marked now
+    """
+    draining = {}
+    unbound = []
+    now = time.time()
+    with kv.batch():
+        for container_id in container_ids:
+            metadata = kv.get(CONTAINERS, container_id)
+            if not metadata or "user_id" not in metadata or metadata.get("state") == "draining":
+                continue
+            user_id = str(metadata["user_id"])
+            if kv.get(USERS, user_id) == container_id:
+                kv.delete(USERS, user_id)
+                unbound.append(user_id)
+            metadata = {**metadata, "state": "draining", "draining_at": now}
+            kv.set(CONTAINERS, container_id, metadata)
+            draining[container_id] = metadata
+        if draining:
+            bump_routes_version()
+    revocations.update(revoked=list(draining))
+    for user_id in unbound:
+        route_table.remove(user_id)
+    for container_id, metadata in draining.items():
+        change_feed.publish(container_id, "upsert", {"user_id": metadata["user_id"], "port": metadata["port"], "state": "draining"})
+    return draining
+
+def unbind(user_id: str, container_id: str) -> bool:
+    """Deletes user => container if it still points at the container, a drained one's user may have a new one"""
+    if kv.get(USERS, user_id) != container_id:
+        return False
+    kv.delete(USERS, user_id)
+    return True
+
+async def remove_containers(container_ids: list[str]) -> dict[str, str | None]:
+    """
+    Drops the metadata and mappings of the containers in one transaction, revokes their tokens and releases
+    their ports. Returns container_id => user_id it was bound to
+    """
+    removed = {}
+    bound = set()
+    with kv.batch():
+        for container_id in container_ids:
+            metadata = kv.get(CONTAINERS, container_id)
+            removed[container_id] = metadata if metadata and "user_id" in metadata else None
+            if removed[container_id]:
+                if unbind(str(metadata["user_id"]), container_id):
+                    bound.add(container_id)
+                touch_volumes(str(metadata["user_id"]))
+            kv.delete(CONTAINERS, container_id)
+        if removed:
+            bump_routes_version()
+
+    revocations.update(revoked=[container_id for container_id, metadata in removed.items() if metadata])
+    port_allocator.release_owned(list(removed), [int(str(metadata["port"])) for metadata in removed.values() if metadata])
+    for container_id, metadata in removed.items():
+        if container_id in bound:
+            route_table.remove(str(metadata["user_id"]))
+        change_feed.publish(container_id, "remove")
+    return {container_id: str(metadata["user_id"]) if metadata else None for container_id, metadata in removed.items()}
 
 async def get_container_metadata(container_id: str):
-    async with container_cache.session() as container_session:
-        metadata = await container_session.get(container_id)
-        return metadata
+    return kv.get(CONTAINERS, container_id)
 
 async def get_container_id_by_user(user_id: str):
-    async with user_cache.session() as user_session:
-        container_id = await user_session.get(user_id)
-        return str(container_id) if container_id else None
-    
-async def get_user_id_by_container(container_id: str):
-    async with container_cache.session() as session:
-        user_id = await session.get(container_id)
-        return str(user_id) if user_id else None
+    return kv.get(USERS, user_id)
 
 async def get_containers():
-    async with container_cache.session() as session:
-        container_ids = await session.keys()
-        return await session.batch_get(container_ids)
\ No newline at end of file
+    return kv.items(CONTAINERS)
+
+
+async def add_warm_container(container_id: str, port: int, volumes: dict | None = None):
+    kv.set(WARM_POOL, container_id, {"port": port, "volumes": volumes})
+
+async def remove_warm_container(container_id: str):
+    kv.delete(WARM_POOL, container_id)
+
+async def get_warm_containers() -> dict[str, dict]:
+    """container_id => {port, volumes}"""
+    return {
+        container_id: {"port": int(str(warm["port"])), "volumes": warm.get("volumes")}
+        for container_id, warm in kv.items(WARM_POOL).items() if warm
+    }
+
+
+async def get_user_volumes(user_id: str) -> dict | None:
+    return kv.get(VOLUMES, user_id)
+
+async def set_user_volumes(user_id: str, volumes: dict):
+    kv.set(VOLUMES, user_id, {"volumes": volumes, "last_used": time.time()})
+
+async def remove_user_volumes(user_id: str):
+    kv.delete(VOLUMES, user_id)
+
+async def get_all_user_volumes() -> dict[str, dict]:
+    return kv.items(VOLUMES)
@@ -0,0 +1,78 @@
+import os
+from utils import get_meminfo_mb, get_available_memory_mb
+from metrics import instance_capacity_containers
+
+# resources of one workspace container, WORKSPACE_CPUS/WORKSPACE_MEMORY_MB override the profile
+WORKSPACE_PROFILES = {
+    "small": {"cpus": 0.5, "memory_mb": 1024},
+    "medium": {"cpus": 1, "memory_mb": 2048},
+    "large": {"cpus": 2, "memory_mb": 4096},
+}
+WORKSPACE_PROFILE = os.environ.get("WORKSPACE_PROFILE", "small")
+WORKSPACE_CPUS = float(os.environ.get("WORKSPACE_CPUS", 0)) or WORKSPACE_PROFILES[WORKSPACE_PROFILE]["cpus"]
+WORKSPACE_MEMORY_MB = int(os.environ.get("WORKSPACE_MEMORY_MB", 0)) or WORKSPACE_PROFILES[WORKSPACE_PROFILE]["memory_mb"]
+# code-server is idle most of the time and cpu shares are only weights under contention, memory limits are hard
+CPU_OVERCOMMIT = float(os.environ.get("CPU_OVERCOMMIT", 4))
+MEMORY_OVERCOMMIT = float(os.environ.get("MEMORY_OVERCOMMIT", 1))
+# for the os, docker, the control plane, the proxy and the static asset container
+RESERVED_MEMORY_MB = int(os.environ.get("RESERVED_MEMORY_MB", 1024))
+# docker's weight of a container without --cpu-shares
+CPU_SHARES_PER_CPU = 1024
+
+
+class InsufficientMemoryError(Exception):
+    def __init__(self, available_mb: int, required_mb: int):
+        super().__init__(f"{available_mb}MB available, a workspace needs {required_mb}MB")
+        self.available_mb = available_mb
+        self.required_mb = required_mb
+
+
+class WorkspaceCapacity:
+    """
+    How many workspaces an instance takes, from its cores and memory and the per workspace profile.
+    `containers()` sizes the port pool on startup, `admissible()` is what still fits in the memory
+    available right now so starts are refused under memory pressure and not only when ports run out.
+    """
+
+    def __init__(self, cpus: float = WORKSPACE_CPUS, memory_mb: int = WORKSPACE_MEMORY_MB):
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+
+    @property
+    def cpu_shares(self) -> int:
+        return int(CPU_SHARES_PER_CPU * self.cpus)
+
+    def containers(self) -> int:
+        by_cpu = int((os.cpu_count() or 1) * CPU_OVERCOMMIT // self.cpus)
+        memory_total_mb = get_meminfo_mb("MemTotal")
+        if memory_total_mb is None:
+            return max(1, by_cpu)
+        by_memory = int((memory_total_mb - RESERVED_MEMORY_MB) * MEMORY_OVERCOMMIT // self.memory_mb)
+        return max(1, min(by_cpu, by_memory))
+
+    def admissible(self) -> int | None:
+        """More containers that fit in the available memory, None if it can't be read"""
+        available_mb = get_available_memory_mb()
+        if available_mb is None:
+            return None
+        return max(0, int((available_mb - RESERVED_MEMORY_MB) * MEMORY_OVERCOMMIT // self.memory_mb))
+
+    def check(self):
+        if self.admissible() == 0:
+            raise InsufficientMemoryError(get_available_memory_mb() or 0, self.memory_mb + RESERVED_MEMORY_MB)
+
+    def report(self, configured: int, allocated: int) -> dict:
+        """configured is the size of the port pool, effective what can be reached with the memory available now"""
+        admissible = self.admissible()
+        effective = configured if admissible is None else min(configured, allocated + admissible)
+        instance_capacity_containers.labels(kind="configured").set(configured)
+        instance_capacity_containers.labels(kind="effective").set(effective)
+        return {
+            "configured": configured,
+            "effective": effective,
+            "allocated": allocated,
+            "profile": {"name": WORKSPACE_PROFILE, "cpus": self.cpus, "memory_mb": self.memory_mb},
+        }
+
+
+workspace_capacity = WorkspaceCapacity()
@@ -0,0 +1,82 @@
+import os
+import time
+import asyncio
+from collections import deque
+
+# how many changes are kept for /report?since=, older versions get a full report
+CHANGE_FEED_SIZE = int(os.environ.get("CHANGE_FEED_SIZE", 1024))
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+class ChangeFeed:
+    """
+    Monotonically increasing version over container lifecycle changes of this control plane.
+    Versions look like <epoch>-<n>, the epoch changes on every restart so a client
+    holding a version from an older run gets a full report instead of a wrong delta.
+    """
+
+    def __init__(self, size: int = CHANGE_FEED_SIZE):
+        self.epoch = str(time.time_ns())
+        self.version = 0
+        # (version, container_id, op, data)
+        self.changes: deque[tuple[int, str, str, dict]] = deque(maxlen=size)
+        # container_id => data of the running containers
+        self.state: dict[str, dict] = {}
+        self.subscribers: set[asyncio.Queue] = set()
+
+    @property
+    def tag(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+    def seed(self, containers: dict):
+        self.state = {container_id: dict(data) for container_id, data in containers.items()}
+
+    def publish(self, container_id: str, op: str, data: dict | None = None):
+        """op is upsert or remove"""
+        self.version += 1
+        data = data or {}
+        if op == "remove":
+            self.state.pop(container_id, None)
+        else:
+            self.state[container_id] = data
+        change = (self.version, container_id, op, data)
+        self.changes.append(change)
+        for queue in list(self.subscribers):
+            if queue.full():
+                # too slow to keep up, the stream ends and the client reconnects with Last-Event-ID
+                self.subscribers.discard(queue)
+                continue
+            queue.put_nowait(change)
+
+    def parse(self, tag: str | None) -> int | None:
+        """Version number of a tag from this run, None if it is from another run or invalid"""
+        if not tag:
+            return None
+        epoch, _, version = tag.strip('"').rpartition("-")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def since(self, version: int) -> list[tuple[int, str, str, dict]] | None:
+        """Changes after version, coalesced per container. None if they are not retained anymore"""
+        if version > self.version:
+            return None
+        oldest = self.changes[0][0] if self.changes else self.version + 1
+        if version < oldest - 1:
+            return None
+        latest = {}
+        for change in self.changes:
+            if change[0] > version:
+                latest[change[1]] = change
+        return sorted(latest.values())
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+
+change_feed = ChangeFeed()
@@ -1,178 +1,339 @@
 import os
+import heapq
 import asyncio
 from datetime import datetime, timedelta, timezone
-from utils import run_command
-from cache import get_user_id_by_container, update_ttl, set_user_container, remove_container_by_id
-from metrics import active_user_container_max_duration, idle_containers_detected_total, container_stop_duration_seconds
-
-# Docker commands
-GET_ID_COMMAND = 'docker ps --filter "ancestor=codercom/code-server" --format "{{.ID}}"'
-GET_CONTAINER_INSPECT_COMMAND = lambda cid: f'docker inspect --format "{{{{.Id}}}}" {cid}'
-GET_CONNECTION_ESTABLISHED_COMMAND = lambda container_id: f'docker logs {container_id} 2>/dev/null | grep "New connection established" | awk \'{{print $1}}\' '
-GET_CONNECTION_CLOSED_COMMAND = lambda container_id: f'docker logs {container_id} 2>/dev/null | grep "The client has disconnected gracefully" | awk \'{{print $1}}\' '
-GET_STARTED_AT_COMMAND = lambda container_id: f'docker inspect --format "{{{{ .State.StartedAt }}}}" {container_id}'
-START_CONTAINER_COMMAND = lambda port: " ".join([
-            "docker", "run", "-d",
-            "-p", f"{port}:8080",
-            "--name", f"codermon_{port}",
-            "--rm",
-            "codercom/code-server",
-            "--auth", "none"
-        ])
-GET_CONTAINER_BY_PORT_COMMAND = lambda port: f"docker ps --format '{{{{.Names}}}} {{{{.Ports}}}}' | grep ':{port}->' | awk '{{print $1}}'"
-GET_PORT_BY_CONTAINER_ID = lambda cid: f'docker ps --filter "id={cid}" --format "{{{{.Ports}}}}"'
-
-# Time format constants
-LOG_FORMAT = "%H:%M:%S"
-STARTED_AT_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+from docker_client import get_docker_client, CODE_SERVER_IMAGE, CODE_SERVER_ARGS, CONTAINER_NAME
+from activity import activity_reader
+from warm_pool import warm_pool
+from volumes import volume_mounts, volume_set_labels, VOLUME_ARGS
+from telemetry import telemetry
+from capacity import workspace_capacity
+from outbox import outbox
+from teardown import teardown
+from utils import get_available_memory_mb
+from cache import (
+    get_container_metadata,
+    get_containers,
+    update_containers,
+    refresh_ttls,
+)
+from metrics import (
+    active_user_container_max_duration,
+    idle_containers_detected_total,
+    monitor_sweep_duration_seconds,
+    monitor_queue_depth,
+    monitor_checks_skipped_total,
+    monitor_kv_write_duration_seconds,
+    container_resume_duration_seconds,
+    paused_containers,
+    paused_containers_memory_bytes,
+    containers_memory_reclaimed_bytes_total,
+)
+
+# Docker filters
+CODE_SERVER_FILTERS = {"ancestor": [CODE_SERVER_IMAGE]}
+
+IDLE_OFFSET = timedelta(minutes=5)
+
+# Monitor scheduling
+MONITOR_WORKERS = int(os.environ.get("MONITOR_WORKERS", 5))
+# containers are listed at least this often to pick up new ones
+MONITOR_LIST_INTERVAL_SECONDS = 60
+MONITOR_MIN_SLEEP_SECONDS = 1
+# recheck after a failed check
+MONITOR_RETRY_SECONDS = 60
+MONITOR_STARTED_AT = datetime.now(timezone.utc).timestamp()
+
+# Idle containers are paused(port and mapping kept) and only stopped after this long paused,
+# 0 stops them right away
+PAUSED_TTL_SECONDS = int(os.environ.get("PAUSED_TTL_SECONDS", 60 * 60))
+# paused containers are stopped oldest first while available memory is under this
+PAUSED_MIN_AVAILABLE_MEMORY_MB = int(os.environ.get("PAUSED_MIN_AVAILABLE_MEMORY_MB", 1024))
 
 # Static assest container port
 STATIC_ASSET_PORT = 3000
+USER_LABEL = "codespaces.user"
 
-async def get_container_starting_time(container_id):
-    try:
-        timestamp = await run_command(GET_STARTED_AT_COMMAND(container_id))
-        if timestamp:
-            started_at = datetime.strptime(timestamp[:26], STARTED_AT_FORMAT).replace(tzinfo=timezone.utc).astimezone()
-            return started_at.time()
-    except Exception as e:
-        print(f"Unexpected error in get_container_starting_time: {e}")
-    return None
-
-async def get_container_ids():
+async def get_code_server_containers():
+    """
+    A single list call gives the id, published ports and StartedAt of every code-server container
+    """
     try:
-        short_ids_output = await run_command(GET_ID_COMMAND)
-        short_ids = [cid.strip() for cid in short_ids_output.split('\n') if cid.strip()]
-        
-        if not short_ids:
-            return []
-
-        # Run `inspect` on each container to get full ID
-        tasks = [
-            run_command(GET_CONTAINER_INSPECT_COMMAND(cid))
-            for cid in short_ids
-        ]
-        full_ids_output = await asyncio.gather(*tasks)
-        return [cid.strip() for cid in full_ids_output if cid.strip()]
-    
+        return await get_docker_client().list_containers(CODE_SERVER_FILTERS)
     except Exception as e:
-        print(f"Unexpected error in get_container_ids: {e}")
+        print(f"Unexpected error in get_code_server_containers: {e}")
         return []
 
-
-def is_server_active(start_time, end_time, started_at):
+def is_server_active(last_seen):
     """
-    If both start and end are not present -> Container started but not used yet by the user -> More than 15 minutes -> Inactive
-    If end_time is None -> Active
-    If start_time > end_time -> Active
-    If start_time < end_time -> Active unless (current time - end_time) > 15 mins → Inactive
+    last_seen is the latest of the last traffic the proxy saw for the user(an open websocket counts at every
+    proxy flush) and the start, assignment or resume of the container, in unix seconds.
+    Active unless it is more than IDLE_OFFSET ago
     """
-    current = datetime.now().time()
-    IDLE_OFFSET = timedelta(minutes=5)
+    current = datetime.now(timezone.utc).timestamp()
+    return (current - last_seen) <= IDLE_OFFSET.total_seconds()
+
+def get_next_idle_deadline(last_seen):
+    """Earliest time an active container could be idle, no need to check it again before that"""
+    current = datetime.now(timezone.utc).timestamp()
+    return max(current, last_seen + IDLE_OFFSET.total_seconds())
 
-    started_at_datetime = datetime.combine(datetime.today(), started_at)
-    current_datetime = datetime.combine(datetime.today(), current)
+class SweepWrites:
+    """KV writes collected from the checks of a sweep, applied together once every check is done"""
 
-    if not start_time and not end_time:
-        return (current_datetime - started_at_datetime) <= IDLE_OFFSET
+    def __init__(self):
+        self.active_users: list[str] = []
+        # container_id => fields merged into its metadata
+        self.paused: dict[str, dict] = {}
+        # stopped by the teardown workers
+        self.drained: list[str] = []
 
-    if not end_time:
-        return True
+    async def apply(self):
+        with monitor_kv_write_duration_seconds.time():
+            if self.active_users:
+                await refresh_ttls(self.active_users)
+            if self.paused:
+                # kept till the monitor stops them, a little longer so the mapping can't expire first
+                await update_containers(self.paused, ttl=PAUSED_TTL_SECONDS + int(IDLE_OFFSET.total_seconds()))
+            if self.drained:
+                await teardown.drain(self.drained)
+        for container_id in self.paused:
+            outbox.publish("paused", container_id)
 
+async def monitor_container(container: dict, writes: SweepWrites):
+    """
+    Returns when the container should be checked again, None if it never needs to be
+    """
+    container_id = container["id"]
     try:
-        start = datetime.strptime(start_time, LOG_FORMAT).time() if start_time else started_at
-        end = datetime.strptime(end_time, LOG_FORMAT).time()
-        end_datetime = datetime.combine(datetime.today(), end)
+        if STATIC_ASSET_PORT in container["ports"]:
+            print(f"Static asset container with {container_id} ignored")
+            return None
+        if warm_pool.is_warm(container_id):
+            # not bound to a user yet, checked again in case it gets bound
+            return datetime.now(timezone.utc).timestamp() + IDLE_OFFSET.total_seconds()
+        metadata = await get_container_metadata(container_id)
+        now = datetime.now(timezone.utc).timestamp()
+        if metadata and metadata.get("state") == "draining":
+            # the teardown workers are stopping it
+            return None
+        if metadata and metadata.get("state") == "paused":
+            # nothing can happen in a paused container, it is only stopped once it was paused for too long
+            stop_at = float(str(metadata["paused_at"])) + PAUSED_TTL_SECONDS
+            if now < stop_at:
+                return stop_at
+            print(f"Container {container_id} paused for too long, stopping it...")
+            containers_memory_reclaimed_bytes_total.labels(reason="paused_ttl").inc(int(metadata.get("memory_bytes") or 0))
+            writes.drained.append(container_id)
+            return None
 
-        if start > end:
-            return True
+        # what the proxy saw of the user, no logs are read
+        activity = activity_reader.lookup(str(metadata["user_id"])) if metadata and "user_id" in metadata else None
+        started_at = container["started_at"].timestamp()
+        if metadata and metadata.get("assigned_at"):
+            # idle time of a warm pool container counts from when the user got it
+            started_at = max(started_at, float(str(metadata["assigned_at"])))
+        # a resumed container gets the same grace as a new one to see the client reconnect, and so does every
+        # container when the control plane starts since the proxy may not have flushed yet
+        resumed_at = float(str(metadata.get("resumed_at") or 0)) if metadata else 0
+        last_active = activity.last_active if activity else 0
+        last_seen = max(started_at, resumed_at, last_active, MONITOR_STARTED_AT)
 
-        return (current_datetime - end_datetime) <= IDLE_OFFSET
-    except ValueError as e:
-        print(f"Time parsing error: {e}")
-        return False
+        active = is_server_active(last_seen)
+
+        print(f"[{container_id}] Last active: {last_active or None}, Open websockets: {activity.websockets if activity else 0}, Started At: {started_at}")
+        print(f"[{container_id}] Active: {active}")
+
+        # Pause(or shutdown) container if inactive else update the ttl
+        if active:
+            if metadata and "user_id" in metadata:
+                writes.active_users.append(str(metadata["user_id"]))
+            return get_next_idle_deadline(last_seen)
+
+        outbox.publish("idle", container_id, user_id=metadata.get("user_id") if metadata else None)
+        idle_containers_detected_total.inc()
+        # observing user session duration
+        if last_active > started_at:
+            active_user_container_max_duration.observe(last_active - started_at)
+
+        if PAUSED_TTL_SECONDS and metadata and "user_id" in metadata:
+            print(f"Pausing container {container_id}...")
+            memory_bytes = await get_memory_usage(container_id)
+            await get_docker_client().pause(container_id)
+            writes.paused[container_id] = {"state": "paused", "paused_at": now, "memory_bytes": memory_bytes}
+            return now + PAUSED_TTL_SECONDS
+
+        print(f"Shutting down container {container_id}...")
+        # marked draining with the rest of the sweep, stopped in the background
+        writes.drained.append(container_id)
+        return None
 
-async def monitor_container(container_id):
-    try:
-        port = await run_command(GET_PORT_BY_CONTAINER_ID(container_id))
-        # output is like 0.0.0.0:3000->8080/tcp, [::]:3000->8080/tcp
-        if f"{STATIC_ASSET_PORT}" in port:
-            print(f"Static asset container with {container_id} ignored")
-            return
-        established = await run_command(GET_CONNECTION_ESTABLISHED_COMMAND(container_id))
-        timed_out = await run_command(GET_CONNECTION_CLOSED_COMMAND(container_id))
-
-        start = established.strip("[]").split('\n')[-1] if established else None
-        end = timed_out.strip("[]").split('\n')[-1] if timed_out else None
-        
-        if start and start.startswith("["):
-            start = start[1:]
-        if end and end.startswith("["):
-            end = end[1:]
-
-        started_at = await get_container_starting_time(container_id)
-
-        if started_at:
-            active = is_server_active(start, end, started_at)
-
-            print(f"[{container_id}] Start: {start}, End: {end}, Started At: {started_at}")
-            print(f"[{container_id}] Active: {active}")
-
-            # Shutdown container if inactive else update the ttl
-            if active:
-                user_id = await get_user_id_by_container(container_id)
-                await update_ttl(user_id)
-            else:
-                with container_stop_duration_seconds.time():
-                    await shutdown_container(container_id)
-                idle_containers_detected_total.inc()
-                # observing user session duration
-                try:
-                    start = datetime.strptime(start,LOG_FORMAT)
-                    end = datetime.strptime(end,LOG_FORMAT)
-                    duration = (end - start).total_seconds()
-                    if duration>0:
-                        active_user_container_max_duration.observe(duration)
-                except Exception as e:
-                    print(f"Error calculating container usage duration: {e}")
-                    
-            
     except Exception as e:
         print(f"Unexpected error in monitor_container: {e}")
+        return datetime.now(timezone.utc).timestamp() + MONITOR_RETRY_SECONDS
+
+async def get_memory_usage(container_id: str) -> int | None:
+    try:
+        return await get_docker_client().memory_usage(container_id)
+    except Exception as e:
+        print(f"Could not read the memory usage of {container_id}: {e}")
+        return None
+
+async def resume_container(container_id: str) -> bool:
+    """Unpauses a paused container, False if it wasn't paused"""
+    metadata = await get_container_metadata(container_id)
+    if not metadata or metadata.get("state") != "paused":
+        return False
+    with container_resume_duration_seconds.time():
+        await get_docker_client().unpause(container_id)
+        now = datetime.now(timezone.utc).timestamp()
+        await update_containers({container_id: {"state": "running", "resumed_at": now, "paused_at": None, "memory_bytes": None}})
+    outbox.publish("resumed", container_id, user_id=metadata.get("user_id"))
+    # it was scheduled for when the pause runs out
+    scheduler.schedule(container_id, now + IDLE_OFFSET.total_seconds())
+    print(f"Resumed container {container_id}")
+    return True
 
-async def start_container(port: int,user_id:str):
-    container_id = await run_command(START_CONTAINER_COMMAND(port))
+async def evict_paused_containers(writes: SweepWrites):
+    """Stops paused containers oldest first till enough memory would be available again"""
+    available = get_available_memory_mb()
+    if available is None or available >= PAUSED_MIN_AVAILABLE_MEMORY_MB:
+        return
+    deficit = (PAUSED_MIN_AVAILABLE_MEMORY_MB - available) * 1024 * 1024
+    containers = await get_containers()
+    paused = sorted(
+        (float(str(metadata["paused_at"])), container_id, metadata)
+        for container_id, metadata in containers.items()
+        if metadata and metadata.get("state") == "paused"
+    )
+    for _, container_id, metadata in paused:
+        if deficit <= 0:
+            break
+        print(f"Low memory, stopping paused container {container_id}")
+        memory_bytes = int(metadata.get("memory_bytes") or 0)
+        containers_memory_reclaimed_bytes_total.labels(reason="memory_pressure").inc(memory_bytes)
+        # without a known size it is re-evaluated next sweep
+        deficit -= memory_bytes or deficit
+        writes.drained.append(container_id)
+        scheduler.schedule(container_id, None)
+
+async def update_paused_metrics():
+    paused = [metadata for metadata in (await get_containers()).values() if metadata and metadata.get("state") == "paused"]
+    paused_containers.set(len(paused))
+    paused_containers_memory_bytes.set(sum(int(metadata.get("memory_bytes") or 0) for metadata in paused))
+
+async def run_container(port: int, user_id: str, volumes: dict | None = None) -> str:
+    """Runs the code-server container of the user on the port, the caller writes the mapping"""
+    args = CODE_SERVER_ARGS + VOLUME_ARGS if volumes else CODE_SERVER_ARGS
+    container_id = await get_docker_client().run(
+        CODE_SERVER_IMAGE, port, CONTAINER_NAME(port), args,
+        # the control plane finds the owner again from these if the KV loses the mapping
+        labels={USER_LABEL: user_id, **volume_set_labels(volumes)}, volumes=volume_mounts(volumes),
+        cpu_shares=workspace_capacity.cpu_shares, memory_mb=workspace_capacity.memory_mb,
+    )
     print(f"Started codermon on port {port} with container ID: {container_id}")
-    await set_user_container(container_id=container_id,user_id=user_id,port=port)
     return container_id
 
 async def start_static_assert_container():
-    is_running = await run_command(GET_CONTAINER_BY_PORT_COMMAND(STATIC_ASSET_PORT))
+    docker = get_docker_client()
+    is_running = await docker.list_containers({"publish": [str(STATIC_ASSET_PORT)]})
     if not is_running:
-        await run_command(START_CONTAINER_COMMAND(STATIC_ASSET_PORT))
+        await docker.run(CODE_SERVER_IMAGE, STATIC_ASSET_PORT, CONTAINER_NAME(STATIC_ASSET_PORT), CODE_SERVER_ARGS)
     
-async def shutdown_container(container_id):
-    try:
-        print(f"Shutting down container {container_id}...")
-        await run_command(f'docker stop {container_id}')
-        # await run_command(f'docker rm {container_id}')
-        await remove_container_by_id(container_id)
-        print(f"Container {container_id} stopped successfully.")
-    except Exception as e:
-        print(f"Error shutting down container {container_id}: {e}")
+class MonitorScheduler:
+    """
+    Min-heap of (deadline, container_id) keyed by the next time each container could go idle.
+    Only due containers are checked, through a bounded pool of workers.
+    Heap entries are invalidated lazily, `deadlines` holds the current deadline of every known container.
+    """
+
+    def __init__(self, workers: int = MONITOR_WORKERS):
+        self.workers = workers
+        self.heap: list[tuple[float, str]] = []
+        self.deadlines: dict[str, float] = {}
+        self.containers: dict[str, dict] = {}
+        self.last_listed = 0.0
+
+    def schedule(self, container_id: str, deadline: float | None):
+        if deadline is None:
+            # never due again but remembered so it isn't treated as new
+            self.deadlines[container_id] = float("inf")
+            return
+        self.deadlines[container_id] = deadline
+        heapq.heappush(self.heap, (deadline, container_id))
+        # counted once per deferred deadline, a container isn't looked at again till it is due
+        if deadline > datetime.now(timezone.utc).timestamp():
+            monitor_checks_skipped_total.inc()
+
+    async def refresh(self, now: float):
+        containers = await get_code_server_containers()
+        self.containers = {container["id"]: container for container in containers}
+        for container_id in list(self.deadlines):
+            if container_id not in self.containers:
+                del self.deadlines[container_id]
+        telemetry.track(set(self.containers))
+        # keeps the load gauges current between /report calls
+        telemetry.load()
+        for container_id, container in self.containers.items():
+            if container_id not in self.deadlines:
+                # a new container can't be idle before IDLE_OFFSET from its start
+                self.schedule(container_id, max(now, container["started_at"].timestamp() + IDLE_OFFSET.total_seconds()))
+        self.last_listed = now
+
+    def pop_due(self, now: float) -> list[str]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, container_id = heapq.heappop(self.heap)
+            # stale entry, rescheduled or removed since it was pushed
+            if self.deadlines.get(container_id) != deadline:
+                continue
+            due.append(container_id)
+        return due
+
+    async def worker(self, queue: asyncio.Queue, writes: SweepWrites):
+        while not queue.empty():
+            container_id = queue.get_nowait()
+            monitor_queue_depth.set(queue.qsize())
+            deadline = await monitor_container(self.containers[container_id], writes)
+            # stopped containers drop out on the next refresh
+            self.schedule(container_id, deadline)
+
+    async def sweep(self):
+        now = datetime.now(timezone.utc).timestamp()
+        if now - self.last_listed >= MONITOR_LIST_INTERVAL_SECONDS or (self.heap and self.heap[0][0] <= now):
+            await self.refresh(now)
+
+        writes = SweepWrites()
+        activity_reader.refresh()
+        await evict_paused_containers(writes)
+        due = [container_id for container_id in self.pop_due(now) if container_id in self.containers and container_id not in writes.drained]
+        if due:
+            queue = asyncio.Queue()
+            for container_id in due:
+                queue.put_nowait(container_id)
+            monitor_queue_depth.set(queue.qsize())
+            await asyncio.gather(*(self.worker(queue, writes) for _ in range(min(self.workers, len(due)))))
+        await writes.apply()
+        await update_paused_metrics()
+
+    def sleep_interval(self) -> float:
+        now = datetime.now(timezone.utc).timestamp()
+        until_list = MONITOR_LIST_INTERVAL_SECONDS - (now - self.last_listed)
+        until_due = self.heap[0][0] - now if self.heap else until_list
+        return max(MONITOR_MIN_SLEEP_SECONDS, min(until_list, until_due))
+
+
+scheduler = MonitorScheduler()
 
 async def monitor_containers():
     print("Starting monitoring for containers...")
-    ONE_MINUTE = 60
     while True:
         try:
-            print("searching containers.....")
-            containers = await get_container_ids()
-            if not containers:
+            with monitor_sweep_duration_seconds.time():
+                await scheduler.sweep()
+            if not scheduler.containers:
                 print("No running containers found.")
-            else:
-                await asyncio.gather(*(monitor_container(cid) for cid in containers))
         except Exception as e:
             print(f"Error during monitoring loop: {e}")
         finally:
-            await asyncio.sleep(ONE_MINUTE)
\ No newline at end of file
+            await asyncio.sleep(scheduler.sleep_interval())
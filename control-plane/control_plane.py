@@ -1,30 +1,48 @@
+import json
+import time
 import asyncio
 from fastapi import FastAPI, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from typing import Awaitable, Callable
 from pydantic import BaseModel
-from codermon import monitor_containers, start_static_assert_container
-from cache import get_containers
-from utils import get_token
+from codermon import monitor_containers
+from warmup import instance_warmup
+from reconcile import reconcile_startup
+from warm_pool import warm_pool
+from volumes import workspace_volumes
+from telemetry import telemetry, load_tag
+from capacity import workspace_capacity, InsufficientMemoryError
+from change_feed import change_feed
+from outbox import outbox
+from route_table import route_table
+from admission import start_flights, resume_flights, launch_gate, LaunchQueueFullError
+from cache import get_containers, load_cache, sweep_expired
+from routing_tokens import revocations, mint
+from teardown import teardown, TEARDOWN_REMOVE_TIMEOUT_SECONDS
+from batch_start import BatchStart, BATCH_START_MAX_USERS
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from metrics import *
 import os
 
 from cache import (
-    initialize_port_pool,
-    get_free_port,
     set_user_container,
-    get_container_id_by_user
+    get_container_id_by_user,
+    get_container_metadata
 )
-from codermon import start_container
+from ports import port_allocator
+from codermon import run_container, resume_container, CODE_SERVER_FILTERS, STATIC_ASSET_PORT
+from docker_client import get_docker_client
 
 # should be set in the .env and a secret key
 X_ORCHASTRATOR_KEY = os.environ.get("X_ORCHASTRATOR_KEY","TOKEN")
 ORCHASTRATOR_URL = os.environ.get("ORCHASTRATOR_URL")
 PROMETHEUS_URL = os.environ.get("PROMETHEUS_URL")
 PROMETHEUS_AUTHORISATION_AUTHORISATION_KEY = os.environ.get("X_ORCHASTRATOR_KEY","TOKEN")
+SSE_KEEPALIVE_SECONDS = 15
+# /start/batch runs, each outlives the request that started it
+batch_tasks: set[asyncio.Task] = set()
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
@@ -32,6 +50,11 @@ from fastapi import FastAPI
 def is_valid_orchastrator(headers:dict):
     return headers.get("X-ORCHASTRATOR_KEY") == X_ORCHASTRATOR_KEY
 
+async def prepare_instance():
+    await instance_warmup.prepare()
+    # the pool would pull the image on its own before that
+    await warm_pool.maintain()
+
 def is_valid_metrics_server(headers:dict):
     auth = headers.get("authorization")
     if not auth:
@@ -45,11 +68,28 @@ def is_valid_metrics_server(headers:dict):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     with control_plane_startup_duration_seconds.time():
-        await asyncio.gather(
-            initialize_port_pool(),
-            start_static_assert_container()
+        load_cache()
+        # images are pulled in the background meanwhile, /health says ready once they are local
+        asyncio.create_task(prepare_instance())
+        # docker is the source of truth for the mappings and ports left by the last run
+        running = await reconcile_startup()
+        containers = await get_containers()
+        change_feed.seed(containers)
+        # the proxy workers only read the route table, so it is rebuilt from the KV
+        bound = [metadata for metadata in containers.values() if metadata and "user_id" in metadata and metadata.get("state") != "draining"]
+        revocations.rebuild({container_id for container_id, metadata in containers.items() if metadata and metadata.get("state") == "paused"})
+        route_table.rebuild(
+            {str(metadata["user_id"]): int(str(metadata["port"])) for metadata in bound},
+            paused={str(metadata["user_id"]) for metadata in bound if metadata.get("state") == "paused"},
         )
+        await warm_pool.load(running)
+        asyncio.create_task(teardown.run())
+        await teardown.resume(containers)
         asyncio.create_task(monitor_containers())
+        asyncio.create_task(outbox.run())
+        # an expired mapping may still have its container running on the port
+        asyncio.create_task(sweep_expired(teardown.drain))
+        asyncio.create_task(workspace_volumes.maintain())
     yield
 control_plane = FastAPI(lifespan=lifespan)
 
@@ -75,45 +115,276 @@ control_plane.add_middleware(
 class ContainerStartModel(BaseModel):
     user_id: str
 
+class BatchStartModel(BaseModel):
+    user_ids: list[str]
+
+class DrainModel(BaseModel):
+    # none => every container of the instance
+    container_ids: list[str] | None = None
+    wait: bool = True
+    timeout_seconds: float | None = None
+
 @control_plane.get("/health")
 async def health():
+    if teardown.draining_instance:
+        return JSONResponse({"status": "draining"}, 503)
+    if not instance_warmup.ready:
+        return JSONResponse({"status": "warming", "pending_images": sorted(instance_warmup.pending)}, 503)
     return "ok"
 
 # TODO: use background_task dependency of fastapi to record metrics instead of in the controller.
 # or use yield based dependency
 
+async def launch_container(user_id: str) -> str | None:
+    """Runs once per user at a time(single flight), returns None if there is no free port"""
+    # a launch for this user may have finished just before this one started
+    container_id = await get_container_id_by_user(user_id)
+    if container_id:
+        return container_id
+
+    # a pre-started container only needs the user => container mapping, it comes with new volumes
+    # so users that have theirs already get a container with them mounted
+    if not await workspace_volumes.has_volumes(user_id):
+        warm = await warm_pool.acquire(user_id)
+        if warm:
+            containers_started_total.inc()
+            return warm[0]
+
+    # refused while a new container's memory doesn't fit, even with free ports
+    workspace_capacity.check()
+
+    async with launch_gate.slot():
+        while True:
+            # leased till the container is up, an abandoned start returns it to the pool
+            port = port_allocator.allocate(owner=user_id)
+            if not port:
+                return None
+            try:
+                started_at = time.perf_counter()
+                with port_allocator.launching(port):
+                    volumes, cold = await workspace_volumes.for_user(user_id)
+                    container_id = await run_container(port, user_id, volumes)
+                container_start_duration_seconds.labels(volumes="cold" if cold else "warm").observe(time.perf_counter() - started_at)
+            except Exception:
+                port_allocator.release(port)
+                raise
+            try:
+                port_allocator.lease(port, owner=container_id, expected_owner=user_id)
+                break
+            except ValueError:
+                # the lease was reclaimed during the launch, the port is free or someone else's now. The container
+                # goes through the teardown workers(stopped, removed, retried on failure), only a port it still
+                # owns is released with it
+                print(f"Port {port} was reclaimed while {container_id} started on it, starting another one")
+                await teardown.wait(await teardown.drain([container_id]), TEARDOWN_REMOVE_TIMEOUT_SECONDS)
+    await set_user_container(user_id, container_id, port)
+    outbox.publish("started", container_id, user_id=user_id, port=port)
+    containers_started_total.inc()
+    return container_id
+
+async def routing_url(hostname: str, user_id: str, container_id: str) -> dict | None:
+    """{url, token_expires_at} with a routing token for the container, None if it went away"""
+    metadata = await get_container_metadata(container_id)
+    if not metadata:
+        return None
+    # the proxy routes on the claims of the token, no lookup per request
+    route = route_table.lookup(user_id)
+    token, expires_at = mint(user_id, container_id, int(str(metadata["port"])), route.generation if route else 0)
+    return {"url": f"{hostname}:5000?token={token}", "token_expires_at": expires_at}
+
 @control_plane.post("/start")
 async def start(payload: ContainerStartModel, request: Request):
     with orchestrator_update_latency_seconds.time():
         # Check if the user already has an active container
         container_id = await get_container_id_by_user(payload.user_id)
-        if container_id:
-            return JSONResponse({"url": f"{request.base_url.hostname}:5000?token={get_token(payload.user_id)}"}, 200)
-
-        port = await get_free_port()
-        if not port:
+        if not container_id and teardown.draining_instance:
+            return JSONResponse({"message": "Instance is draining"}, 503)
+        if not container_id and not instance_warmup.ready:
+            return JSONResponse({"message": "Instance is warming up"}, 503, headers={"Retry-After": "10"})
+        if not container_id:
+            try:
+                container_id = await start_flights.do(payload.user_id, lambda: launch_container(payload.user_id))
+            except LaunchQueueFullError as e:
+                return JSONResponse(
+                    {"message": "Too many containers starting", "queue_position": e.position},
+                    429,
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            except InsufficientMemoryError as e:
+                start_requests_refused_total.inc()
+                return JSONResponse(
+                    {"message": "Not enough memory for another container", "available_mb": e.available_mb},
+                    503,
+                    headers={"Retry-After": "30"},
+                )
+        if not container_id:
             return JSONResponse({"message": "No free port available"}, 401)
-        with container_start_duration_seconds.time():
-            container_id = await start_container(port, payload.user_id)
-        await set_user_container(payload.user_id, container_id, port)
-        containers_started_total.inc()
-        return JSONResponse({"url": f"{request.base_url.hostname}:5000?token={get_token(payload.user_id)}"}, 200)
+        # an idle container was only paused, it is resumed instead of starting another one
+        await resume_flights.do(container_id, lambda: resume_container(container_id))
+        url = await routing_url(request.base_url.hostname, payload.user_id, container_id)
+        if not url:
+            return JSONResponse({"message": "Container went away while starting"}, 503, headers={"Retry-After": "1"})
+        return JSONResponse(url, 200)
+
+
+@control_plane.post("/start/batch")
+async def start_batch(payload: BatchStartModel, request: Request):
+    """
+    /start for many users(a classroom or a team), one json line per user as soon as its container is up:
+    {user_id, status: running|started|error, container_id, url, token_expires_at} or {user_id, status: error, message}.
+    Users that can't get a container don't fail the others
+    """
+    if teardown.draining_instance:
+        return JSONResponse({"message": "Instance is draining"}, 503)
+    if not instance_warmup.ready:
+        return JSONResponse({"message": "Instance is warming up"}, 503, headers={"Retry-After": "10"})
+    if len(payload.user_ids) > BATCH_START_MAX_USERS:
+        return JSONResponse({"message": f"At most {BATCH_START_MAX_USERS} users per batch"}, 400)
+
+    batch = BatchStart(payload.user_ids)
+    # kept till it is done, the loop only holds a weak reference to its tasks
+    task = asyncio.create_task(batch.run())
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+    hostname = request.base_url.hostname
+
+    async def stream():
+        while (result := await batch.results.get()) is not None:
+            if result["status"] != "error":
+                url = await routing_url(hostname, result["user_id"], result["container_id"])
+                result.update(url or {"status": "error", "message": "Container went away while starting"})
+            yield json.dumps(result) + "\n"
 
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@control_plane.post("/resume")
+async def resume(payload: ContainerStartModel):
+    """Called by the proxy on a request for a paused container, returns once it is running"""
+    container_id = await get_container_id_by_user(payload.user_id)
+    if not container_id:
+        return JSONResponse({"message": "No container for this user"}, 404)
+    resumed = await resume_flights.do(container_id, lambda: resume_container(container_id))
+    return JSONResponse({"container_id": container_id, "resumed": resumed}, 200)
+
+
+@control_plane.post("/drain")
+async def drain(payload: DrainModel):
+    """
+    Stops the containers(through the teardown workers), without `container_ids` every container of the instance
+    for a scale-in lifecycle hook: /start and /health answer 503 from then on and the warm pool is given back.
+    Returns once they are gone(or after `timeout_seconds` with the ones still draining), right away without `wait`
+    """
+    started = time.perf_counter()
+    container_ids = payload.container_ids
+    if container_ids is None:
+        teardown.draining_instance = True
+        await warm_pool.drain()
+        # what docker runs, a code-server container without a mapping(unknown, expired) would outlive the instance
+        running = await get_docker_client().list_containers(CODE_SERVER_FILTERS)
+        container_ids = list(dict.fromkeys([
+            *(container["id"] for container in running if STATIC_ASSET_PORT not in container["ports"]),
+            *await get_containers(),
+        ]))
+    draining = await teardown.drain(container_ids)
+    if not payload.wait:
+        return JSONResponse({"draining": draining}, 202)
+    remaining = await teardown.wait(draining, payload.timeout_seconds)
+    seconds = time.perf_counter() - started
+    if payload.container_ids is None and not remaining:
+        instance_drain_duration_seconds.set(seconds)
+    return JSONResponse({
+        "drained": [container_id for container_id in draining if container_id not in remaining],
+        "remaining": remaining,
+        "seconds": round(seconds, 3),
+    }, 200 if not remaining else 202)
+
+
+def container_report(container_id: str, container) -> dict:
+    return {
+        "user_id": container.get("user_id"),
+        "container_id": container_id,
+        "port": container.get("port"),
+        "state": container.get("state", "running"),
+    }
+
+def change_event(change) -> str:
+    version, container_id, op, data = change
+    payload = json.dumps(container_report(container_id, data))
+    return f"id: {change_feed.epoch}-{version}\nevent: {op}\ndata: {payload}\n\n"
 
 @control_plane.get("/report")
-async def report():
+async def report(request: Request, since: str | None = None):
+    """
+    Without `since` it is the full report. With the version of an earlier report it is only
+    the containers changed or removed after it, or the full report if that version is too old.
+    Both carry the current load_score, headroom and capacity. The ETag covers the containers and a coarse
+    step of the load(telemetry.load_tag) so a 304 is never sent while the load moved on.
+    """
+    # taken before reading so a concurrent change is sent again next time instead of missed
+    tag = change_feed.tag
+    load = telemetry.load()
+    etag = f'"{tag}.{load_tag(load)}"'
+    headers = {"ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    version = change_feed.parse(since)
+    changes = change_feed.since(version) if version is not None else None
+    if changes is not None:
+        return JSONResponse({
+            "version": tag,
+            "full": False,
+            "count": len(change_feed.state),
+            "containers": [container_report(container_id, data) for _, container_id, op, data in changes if op == "upsert"],
+            "removed": [container_id for _, container_id, op, _ in changes if op == "remove"],
+            **load,
+        }, headers=headers)
+
     containers:dict = await get_containers()
     count = len(containers)
-    containers_report = [{  
-                        "user_id": container.get("user"),
-                        "container_id": container_id,
-                        "port": container.get("port")
-                        } 
-                        for container_id,container in containers.items()]
+    containers_report = [container_report(container_id, container) for container_id,container in containers.items()]
     return JSONResponse({
+        "version": tag,
+        "full": True,
         "count": count,
-        "containers": containers_report
-    })
+        "containers": containers_report,
+        **load,
+    }, headers=headers)
+
+@control_plane.get("/events")
+async def events(request: Request):
+    """
+    Server sent events of container upserts/removes as they happen.
+    Reconnecting with Last-Event-ID replays what was missed, a `reset` event means fetch the full /report.
+    """
+    last_version = change_feed.parse(request.headers.get("last-event-id"))
+    # subscribed in the same step as the backlog is taken so nothing falls in between
+    queue = change_feed.subscribe()
+    backlog = change_feed.since(last_version) if last_version is not None else []
+    if request.headers.get("last-event-id") and last_version is None:
+        backlog = None
+
+    async def stream():
+        try:
+            if backlog is None:
+                yield f"id: {change_feed.tag}\nevent: reset\ndata: {{}}\n\n"
+            for change in backlog or []:
+                yield change_event(change)
+            while not await request.is_disconnected():
+                try:
+                    change = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # dropped for being too slow, the client resumes with Last-Event-ID
+                    if queue not in change_feed.subscribers:
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                yield change_event(change)
+        finally:
+            change_feed.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @control_plane.route('/metrics')
 def metrics(*args):
@@ -0,0 +1,519 @@
+import os
+import re
+import json
+import stat
+import asyncio
+from datetime import datetime, timezone
+import httpx
+from utils import run_command
+
+# Docker Engine API over the local unix socket. The control plane runs as root(see readme)
+# so it can talk to the daemon directly instead of forking the docker cli for every call.
+DOCKER_SOCKET = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+# auto -> socket if it exists else cli, api -> socket only, cli -> docker cli only
+DOCKER_BACKEND = os.environ.get("DOCKER_BACKEND", "auto")
+DOCKER_MAX_CONNECTIONS = int(os.environ.get("DOCKER_MAX_CONNECTIONS", 10))
+DOCKER_TIMEOUT_SECONDS = float(os.environ.get("DOCKER_TIMEOUT_SECONDS", 30))
+
+CODE_SERVER_IMAGE = "codercom/code-server"
+CODE_SERVER_PORT = 8080
+CODE_SERVER_ARGS = ["--auth", "none"]
+CONTAINER_NAME = lambda port: f"codermon_{port}"
+
+CLI_PORT_PATTERN = re.compile(r":(\d+)->")
+CLI_SIZE_PATTERN = re.compile(r"^([\d.]+)\s*([kKMGT]?i?B)$")
+CLI_SIZE_UNITS = {"B": 1, "kB": 1000, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4,
+                  "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4}
+CLI_CREATED_AT_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+# docker stats clears the screen before every refresh, even without a tty
+CLI_ESCAPE_PATTERN = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+CLI_REMOVE_POLL_SECONDS = 0.5
+
+
+class DockerError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+def demux_log_stream(raw: bytes) -> str:
+    """
+    Containers started without a tty send logs multiplexed as frames of
+    [stream(1) 0 0 0 size(4, big endian)] + payload.
+    Anything that doesn't look like a frame header is returned as is(tty containers).
+    """
+    if len(raw) < 8 or raw[0] not in (0, 1, 2) or raw[1:4] != b"\x00\x00\x00":
+        return raw.decode(errors="replace")
+
+    chunks = []
+    offset = 0
+    while offset + 8 <= len(raw):
+        size = int.from_bytes(raw[offset + 4:offset + 8], "big")
+        chunks.append(raw[offset + 8:offset + 8 + size])
+        offset += 8 + size
+    return b"".join(chunks).decode(errors="replace")
+
+
+def memory_usage_bytes(stats: dict) -> int | None:
+    """Memory used by a container from its stats, without the page cache(what docker stats shows)"""
+    memory = stats.get("memory_stats") or {}
+    usage = memory.get("usage")
+    if usage is None:
+        return None
+    details = memory.get("stats") or {}
+    # inactive_file on cgroup v2, total_inactive_file on v1
+    return usage - details.get("inactive_file", details.get("total_inactive_file", 0))
+
+
+def cpu_percent(stats: dict) -> float:
+    """CPU used by a container since the previous stats sample, 100 per core(what docker stats shows)"""
+    cpu = stats.get("cpu_stats") or {}
+    precpu = stats.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (precpu.get("cpu_usage") or {}).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    # the first sample of a stream has no previous one
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    cpus = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    return cpu_delta / system_delta * cpus * 100
+
+
+def parse_cli_stats(stats: dict) -> dict:
+    return {
+        "cpu_percent": float(stats.get("CPUPerc", "0").rstrip("%") or 0),
+        "memory_bytes": parse_cli_size(stats.get("MemUsage", "").split("/")[0]),
+    }
+
+
+def parse_cli_size(size: str) -> int | None:
+    """12.5MiB => bytes"""
+    match = CLI_SIZE_PATTERN.match(size.strip())
+    if not match or match.group(2) not in CLI_SIZE_UNITS:
+        return None
+    return int(float(match.group(1)) * CLI_SIZE_UNITS[match.group(2)])
+
+
+def volume_binds(volumes: dict | None) -> list[str]:
+    """volume name => mount path as `name:path` binds(the -v of docker run)"""
+    return [f"{name}:{path}" for name, path in (volumes or {}).items()]
+
+
+def resource_limits(cpu_shares: int | None, memory_mb: int | None) -> dict:
+    """HostConfig of the cgroup limits, memory without swap on top of it"""
+    limits = {}
+    if cpu_shares:
+        limits["CpuShares"] = cpu_shares
+    if memory_mb:
+        limits["Memory"] = limits["MemorySwap"] = memory_mb * 1024 ** 2
+    return limits
+
+
+def normalise_api_container(container: dict) -> dict:
+    ports = sorted({p["PublicPort"] for p in container.get("Ports") or [] if p.get("PublicPort")})
+    names = container.get("Names") or [""]
+    return {
+        "id": container["Id"],
+        "name": names[0].lstrip("/"),
+        "image": container.get("Image"),
+        "state": container.get("State"),
+        "ports": ports,
+        # containers are created and started by the same `run`, so Created is the StartedAt for us
+        "started_at": datetime.fromtimestamp(container.get("Created", 0), tz=timezone.utc),
+        "labels": container.get("Labels") or {},
+    }
+
+
+def normalise_cli_container(container: dict) -> dict:
+    labels = {}
+    for label in (container.get("Labels") or "").split(","):
+        if "=" in label:
+            key, value = label.split("=", 1)
+            labels[key] = value
+    return {
+        "id": container["ID"],
+        "name": container.get("Names", "").split(",")[0],
+        "image": container.get("Image"),
+        "state": container.get("State"),
+        "ports": sorted({int(p) for p in CLI_PORT_PATTERN.findall(container.get("Ports", ""))}),
+        "started_at": datetime.strptime(container["CreatedAt"][:25], CLI_CREATED_AT_FORMAT).astimezone(timezone.utc),
+        "labels": labels,
+    }
+
+
+class DockerAPIClient:
+    """Pooled async client for the docker engine api over the unix socket"""
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET):
+        self.socket_path = socket_path
+        self._client: httpx.AsyncClient | None = None
+        # stats streams hold their connection for the life of the container, they get their own
+        # unbounded pool so they can't starve the calls on the main one
+        self._stream_client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created lazily so it binds to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(
+                    uds=self.socket_path,
+                    limits=httpx.Limits(
+                        max_connections=DOCKER_MAX_CONNECTIONS,
+                        max_keepalive_connections=DOCKER_MAX_CONNECTIONS,
+                    ),
+                ),
+                base_url="http://docker",
+                timeout=DOCKER_TIMEOUT_SECONDS,
+            )
+        return self._client
+
+    @property
+    def stream_client(self) -> httpx.AsyncClient:
+        if self._stream_client is None:
+            self._stream_client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=self.socket_path, limits=httpx.Limits(max_connections=None)),
+                base_url="http://docker",
+                timeout=None,
+            )
+        return self._stream_client
+
+    async def _request(self, method: str, path: str, ok=(200, 201, 204), **kwargs) -> httpx.Response:
+        response = await self.client.request(method, path, **kwargs)
+        if response.status_code not in ok:
+            try:
+                message = response.json().get("message", response.text)
+            except ValueError:
+                message = response.text
+            raise DockerError(f"{method} {path} failed: {message}", response.status_code)
+        return response
+
+    async def list_containers(self, filters: dict | None = None) -> list[dict]:
+        params = {"filters": json.dumps(filters)} if filters else {}
+        response = await self._request("GET", "/containers/json", params=params)
+        return [normalise_api_container(container) for container in response.json()]
+
+    async def inspect(self, container_id: str) -> dict:
+        response = await self._request("GET", f"/containers/{container_id}/json")
+        return response.json()
+
+    async def pull(self, image: str):
+        name, _, tag = image.partition(":")
+        # the progress stream has to be consumed till the end for the pull to finish
+        async with self.client.stream("POST", "/images/create", params={"fromImage": name, "tag": tag or "latest"}) as response:
+            async for _ in response.aiter_bytes():
+                pass
+            if response.status_code != 200:
+                raise DockerError(f"pull {image} failed", response.status_code)
+
+    async def image_exists(self, image: str) -> bool:
+        response = await self._request("GET", f"/images/{image}/json", ok=(200, 404))
+        return response.status_code == 200
+
+    async def warm_up(self, image: str):
+        """Creates and removes a container of the image, its layers are read into the page cache on the way"""
+        container_id = await self.create({"Image": image})
+        await self._request("DELETE", f"/containers/{container_id}", ok=(204, 404), params={"force": "true"})
+
+    async def create(self, body: dict, name: str | None = None) -> str:
+        params = {"name": name} if name else {}
+        try:
+            response = await self._request("POST", "/containers/create", params=params, json=body)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+            # same as `docker run`, pull the image if it is not present locally
+            await self.pull(body["Image"])
+            response = await self._request("POST", "/containers/create", params=params, json=body)
+        return response.json()["Id"]
+
+    async def run(self, image: str, port: int, name: str, args: list[str] | None = None,
+                  labels: dict | None = None, auto_remove: bool = True, volumes: dict | None = None,
+                  cpu_shares: int | None = None, memory_mb: int | None = None) -> str:
+        body = {
+            "Image": image,
+            "Cmd": args or [],
+            "Labels": labels or {},
+            "ExposedPorts": {f"{CODE_SERVER_PORT}/tcp": {}},
+            "HostConfig": {
+                "PortBindings": {f"{CODE_SERVER_PORT}/tcp": [{"HostPort": str(port)}]},
+                "AutoRemove": auto_remove,
+                "Binds": volume_binds(volumes),
+                **resource_limits(cpu_shares, memory_mb),
+            },
+        }
+        container_id = await self.create(body, name)
+        await self._request("POST", f"/containers/{container_id}/start")
+        return container_id
+
+    async def run_once(self, image: str, command: list[str], volumes: dict | None = None, user: str | None = None):
+        """Runs command(entrypoint first) in a throwaway container and waits for it, raises if it exits non zero"""
+        body = {
+            "Image": image,
+            "Entrypoint": command[:1],
+            "Cmd": command[1:],
+            "User": user or "",
+            "HostConfig": {"Binds": volume_binds(volumes)},
+        }
+        container_id = await self.create(body)
+        try:
+            await self._request("POST", f"/containers/{container_id}/start")
+            response = await self._request("POST", f"/containers/{container_id}/wait", timeout=None)
+            status = response.json().get("StatusCode")
+            if status != 0:
+                raise DockerError(f"{' '.join(command)} exited with {status}", status)
+        finally:
+            await self._request("DELETE", f"/containers/{container_id}", ok=(204, 404), params={"force": "true"})
+
+    async def create_volume(self, name: str, labels: dict | None = None):
+        await self._request("POST", "/volumes/create", json={"Name": name, "Labels": labels or {}})
+
+    async def remove_volume(self, name: str):
+        # 404 -> already removed, 409(in use) is raised
+        await self._request("DELETE", f"/volumes/{name}", ok=(204, 404))
+
+    async def list_volumes(self, filters: dict | None = None) -> list[dict]:
+        params = {"filters": json.dumps(filters)} if filters else {}
+        response = await self._request("GET", "/volumes", params=params)
+        return [
+            {"name": volume["Name"], "labels": volume.get("Labels") or {}}
+            for volume in response.json().get("Volumes") or []
+        ]
+
+    async def volume_sizes(self) -> dict[str, int]:
+        """volume name => bytes used, walks every volume on the daemon so it is slow on big ones"""
+        response = await self._request("GET", "/system/df", params={"type": "volume"}, timeout=None)
+        return {
+            volume["Name"]: max(0, (volume.get("UsageData") or {}).get("Size", 0))
+            for volume in response.json().get("Volumes") or []
+        }
+
+    async def stop(self, container_id: str, timeout: int | None = None):
+        params = {"t": timeout} if timeout is not None else {}
+        # 304 -> already stopped, 404 -> already removed(--rm)
+        await self._request("POST", f"/containers/{container_id}/stop", ok=(204, 304, 404), params=params,
+                            timeout=DOCKER_TIMEOUT_SECONDS + (timeout or 10))
+
+    async def remove(self, container_id: str):
+        # 404 -> already removed, 409 -> --rm is already removing it
+        await self._request("DELETE", f"/containers/{container_id}", ok=(204, 404, 409), params={"force": "true"})
+
+    async def wait_removed(self, container_id: str, timeout: float):
+        """Returns once the daemon has removed the container, 404 -> it already had"""
+        await self._request("POST", f"/containers/{container_id}/wait", ok=(200, 404), params={"condition": "removed"},
+                            timeout=timeout)
+
+    async def pause(self, container_id: str):
+        await self._request("POST", f"/containers/{container_id}/pause", ok=(204,))
+
+    async def unpause(self, container_id: str):
+        await self._request("POST", f"/containers/{container_id}/unpause", ok=(204,))
+
+    async def memory_usage(self, container_id: str) -> int | None:
+        response = await self._request("GET", f"/containers/{container_id}/stats", params={"stream": "false", "one-shot": "true"})
+        return memory_usage_bytes(response.json())
+
+    async def stream_stats(self, container_id: str):
+        """Yields {cpu_percent, memory_bytes} about once a second over one long lived request, till the container is gone"""
+        async with self.stream_client.stream("GET", f"/containers/{container_id}/stats", params={"stream": "true"}) as response:
+            if response.status_code != 200:
+                raise DockerError(f"stats of {container_id} failed", response.status_code)
+            async for line in response.aiter_lines():
+                if line.strip():
+                    stats = json.loads(line)
+                    yield {"cpu_percent": cpu_percent(stats), "memory_bytes": memory_usage_bytes(stats)}
+
+    async def logs(self, container_id: str, since: float | None = None, timestamps: bool = False,
+                   stdout: bool = True, stderr: bool = False) -> str:
+        params = {
+            "stdout": int(stdout),
+            "stderr": int(stderr),
+            "timestamps": int(timestamps),
+        }
+        if since is not None:
+            params["since"] = since
+        response = await self._request("GET", f"/containers/{container_id}/logs", params=params)
+        return demux_log_stream(response.content)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._stream_client is not None:
+            await self._stream_client.aclose()
+            self._stream_client = None
+
+
+class DockerCLIClient:
+    """Fallback with the same interface as DockerAPIClient for hosts without socket access"""
+
+    @staticmethod
+    def _filter_args(filters: dict | None) -> list[str]:
+        return [
+            arg
+            for key, values in (filters or {}).items()
+            for value in values
+            for arg in ("--filter", f"{key}={value}")
+        ]
+
+    async def list_containers(self, filters: dict | None = None) -> list[dict]:
+        output = await run_command(["docker", "ps", "--no-trunc", *self._filter_args(filters), "--format", "{{json .}}"])
+        return [normalise_cli_container(json.loads(line)) for line in output.split("\n") if line.strip()]
+
+    async def inspect(self, container_id: str) -> dict:
+        output = await run_command(["docker", "inspect", container_id])
+        return json.loads(output)[0]
+
+    async def pull(self, image: str):
+        await run_command(["docker", "pull", image])
+
+    async def image_exists(self, image: str) -> bool:
+        try:
+            await run_command(["docker", "image", "inspect", image])
+            return True
+        except Exception:
+            return False
+
+    async def warm_up(self, image: str):
+        container_id = await run_command(["docker", "create", image])
+        await run_command(["docker", "rm", "-f", container_id])
+
+    async def run(self, image: str, port: int, name: str, args: list[str] | None = None,
+                  labels: dict | None = None, auto_remove: bool = True, volumes: dict | None = None,
+                  cpu_shares: int | None = None, memory_mb: int | None = None) -> str:
+        command = [
+            "docker", "run", "-d",
+            "-p", f"{port}:{CODE_SERVER_PORT}",
+            "--name", name,
+        ]
+        if auto_remove:
+            command.append("--rm")
+        for key, value in (labels or {}).items():
+            command += ["--label", f"{key}={value}"]
+        for bind in volume_binds(volumes):
+            command += ["-v", bind]
+        if cpu_shares:
+            command += ["--cpu-shares", str(cpu_shares)]
+        if memory_mb:
+            # no swap on top of the limit
+            command += ["--memory", f"{memory_mb}m", "--memory-swap", f"{memory_mb}m"]
+        command += [image, *(args or [])]
+        return await run_command(command)
+
+    async def run_once(self, image: str, command: list[str], volumes: dict | None = None, user: str | None = None):
+        args = ["docker", "run", "--rm", "--entrypoint", command[0]]
+        if user:
+            args += ["--user", user]
+        for bind in volume_binds(volumes):
+            args += ["-v", bind]
+        args += [image, *command[1:]]
+        await run_command(args)
+
+    async def create_volume(self, name: str, labels: dict | None = None):
+        label_args = [arg for key, value in (labels or {}).items() for arg in ("--label", f"{key}={value}")]
+        await run_command(["docker", "volume", "create", *label_args, name])
+
+    async def remove_volume(self, name: str):
+        await run_command(["docker", "volume", "rm", name])
+
+    async def list_volumes(self, filters: dict | None = None) -> list[dict]:
+        output = await run_command(["docker", "volume", "ls", *self._filter_args(filters), "--format", "{{json .}}"])
+        volumes = []
+        for line in output.split("\n"):
+            if not line.strip():
+                continue
+            volume = json.loads(line)
+            labels = dict(label.split("=", 1) for label in (volume.get("Labels") or "").split(",") if "=" in label)
+            volumes.append({"name": volume["Name"], "labels": labels})
+        return volumes
+
+    async def volume_sizes(self) -> dict[str, int]:
+        output = await run_command(["docker", "system", "df", "-v", "--format", "{{json .Volumes}}"])
+        return {volume["Name"]: parse_cli_size(volume.get("Size", "")) or 0 for volume in json.loads(output or "[]")}
+
+    async def stop(self, container_id: str, timeout: int | None = None):
+        timeout_args = ["-t", str(timeout)] if timeout is not None else []
+        try:
+            await run_command(["docker", "stop", *timeout_args, container_id])
+        except Exception as e:
+            # already removed(--rm)
+            if "No such container" not in str(e):
+                raise
+
+    async def remove(self, container_id: str):
+        try:
+            await run_command(["docker", "rm", "-f", container_id])
+        except Exception as e:
+            # already removed, or --rm is removing it
+            if "No such container" not in str(e) and "already in progress" not in str(e):
+                raise
+
+    async def wait_removed(self, container_id: str, timeout: float):
+        # `docker wait` has no --condition, inspect fails once the container is gone
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            try:
+                await run_command(["docker", "inspect", container_id])
+            except Exception:
+                return
+            if asyncio.get_running_loop().time() >= deadline:
+                raise DockerError(f"{container_id} still not removed after {timeout}s")
+            await asyncio.sleep(CLI_REMOVE_POLL_SECONDS)
+
+    async def pause(self, container_id: str):
+        await run_command(["docker", "pause", container_id])
+
+    async def unpause(self, container_id: str):
+        await run_command(["docker", "unpause", container_id])
+
+    async def memory_usage(self, container_id: str) -> int | None:
+        output = await run_command(["docker", "stats", "--no-stream", "--format", "{{json .}}", container_id])
+        usage = json.loads(output).get("MemUsage", "").split("/")[0]
+        return parse_cli_size(usage)
+
+    async def stream_stats(self, container_id: str):
+        # one `docker stats` process for the life of the container instead of one per poll
+        process = await asyncio.create_subprocess_exec(
+            "docker", "stats", "--format", "{{json .}}", container_id,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            async for line in process.stdout:
+                line = CLI_ESCAPE_PATTERN.sub("", line.decode()).strip()
+                if line:
+                    yield parse_cli_stats(json.loads(line))
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def logs(self, container_id: str, since: float | None = None, timestamps: bool = False,
+                   stdout: bool = True, stderr: bool = False) -> str:
+        args = ["docker", "logs"]
+        if since is not None:
+            args += ["--since", str(since)]
+        if timestamps:
+            args.append("--timestamps")
+        return await run_command([*args, container_id], stdout=stdout, stderr=stderr)
+
+    async def close(self):
+        pass
+
+
+def is_socket_available(socket_path: str = DOCKER_SOCKET) -> bool:
+    try:
+        return stat.S_ISSOCK(os.stat(socket_path).st_mode)
+    except OSError:
+        return False
+
+
+_docker_client = None
+
+def get_docker_client() -> DockerAPIClient | DockerCLIClient:
+    global _docker_client
+    if _docker_client is None:
+        if DOCKER_BACKEND == "cli" or (DOCKER_BACKEND == "auto" and not is_socket_available()):
+            print("Docker socket not available, falling back to the docker cli")
+            _docker_client = DockerCLIClient()
+        else:
+            _docker_client = DockerAPIClient()
+    return _docker_client
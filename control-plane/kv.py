@@ -0,0 +1,168 @@
+import json
+import time
+import heapq
+import sqlite3
+from contextlib import contextmanager
+
+
+class KV:
+    """
+    Key value tables in SQLite with an in memory tier in front of them.
+    The control plane owns the tables: after load() every read is served from memory and writes go
+    through to SQLite. Other processes(the proxy) don't load and read SQLite directly, WAL mode
+    lets them read while the control plane writes.
+    Expiry is its own indexed column(and a heap in memory), so refreshing a TTL only updates a timestamp.
+    """
+
+    def __init__(self, db_path: str, tables: list[str]):
+        self.db_path = db_path
+        self.tables = tables
+        self._conn: sqlite3.Connection | None = None
+        # table => key => (value, expires_at), None until loaded
+        self.memory: dict[str, dict[str, tuple[object, float | None]]] | None = None
+        # (expires_at, table, key), entries are checked against memory when popped
+        self.expiry: list[tuple[float, str, str]] = []
+        self.depth = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # autocommit, batch() opens the transactions
+            conn = sqlite3.connect(self.db_path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for table in self.tables:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)")
+            self._conn = conn
+        return self._conn
+
+    @property
+    def loaded(self) -> bool:
+        return self.memory is not None
+
+    def load(self):
+        """Reads every live entry into memory, from then on this process is the only writer"""
+        now = time.time()
+        memory = {}
+        self.expiry = []
+        for table in self.tables:
+            rows = self.conn.execute(
+                f"SELECT key, value, expires_at FROM {table} WHERE expires_at IS NULL OR expires_at > ?", (now,)
+            ).fetchall()
+            memory[table] = {key: (json.loads(value), expires_at) for key, value, expires_at in rows}
+            self.expiry += [(expires_at, table, key) for key, _, expires_at in rows if expires_at is not None]
+        heapq.heapify(self.expiry)
+        self.memory = memory
+
+    @contextmanager
+    def batch(self):
+        """Every write in the block goes to SQLite in one transaction, nested blocks join the outer one"""
+        self.depth += 1
+        if self.depth == 1:
+            self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            if self.depth == 1:
+                self.conn.execute("ROLLBACK")
+                # memory was written as the block went
+                if self.loaded:
+                    self.load()
+            raise
+        else:
+            if self.depth == 1:
+                self.conn.execute("COMMIT")
+        finally:
+            self.depth -= 1
+
+    @staticmethod
+    def expires_at(ttl: int | None) -> float | None:
+        return time.time() + ttl if ttl is not None else None
+
+    @staticmethod
+    def live(expires_at: float | None, now: float) -> bool:
+        return expires_at is None or expires_at > now
+
+    def get(self, table: str, key: str):
+        now = time.time()
+        if self.loaded:
+            entry = self.memory[table].get(key)
+            return entry[0] if entry and self.live(entry[1], now) else None
+        row = self.conn.execute(f"SELECT value, expires_at FROM {table} WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row and self.live(row[1], now) else None
+
+    def get_many(self, table: str, keys: list[str]) -> dict:
+        values = {key: self.get(table, key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    def items(self, table: str) -> dict:
+        now = time.time()
+        if self.loaded:
+            return {key: value for key, (value, expires_at) in self.memory[table].items() if self.live(expires_at, now)}
+        rows = self.conn.execute(
+            f"SELECT key, value FROM {table} WHERE expires_at IS NULL OR expires_at > ?", (now,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, table: str, key: str, value, ttl: int | None = None):
+        expires_at = self.expires_at(ttl)
+        with self.batch():
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            if self.loaded:
+                self.memory[table][key] = (value, expires_at)
+                self._index(expires_at, table, key)
+
+    def expire(self, table: str, key: str, ttl: int | None) -> bool:
+        """Moves the expiry of a live entry, the value isn't rewritten. False if there is no such entry"""
+        if self.get(table, key) is None:
+            return False
+        expires_at = self.expires_at(ttl)
+        with self.batch():
+            self.conn.execute(f"UPDATE {table} SET expires_at = ? WHERE key = ?", (expires_at, key))
+            if self.loaded:
+                self.memory[table][key] = (self.memory[table][key][0], expires_at)
+                self._index(expires_at, table, key)
+        return True
+
+    def delete(self, table: str, key: str):
+        with self.batch():
+            self.conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            if self.loaded:
+                self.memory[table].pop(key, None)
+
+    def _index(self, expires_at: float | None, table: str, key: str):
+        if expires_at is not None:
+            heapq.heappush(self.expiry, (expires_at, table, key))
+
+    def sweep(self) -> dict[str, dict]:
+        """Deletes every expired entry in one transaction, returns table => {key: value} of what expired"""
+        now = time.time()
+        expired = {table: {} for table in self.tables}
+        if self.loaded:
+            while self.expiry and self.expiry[0][0] <= now:
+                expires_at, table, key = heapq.heappop(self.expiry)
+                entry = self.memory[table].get(key)
+                # stale index entry, refreshed or deleted since
+                if entry is None or entry[1] != expires_at:
+                    continue
+                expired[table][key] = entry[0]
+        else:
+            for table in self.tables:
+                rows = self.conn.execute(f"SELECT key, value FROM {table} WHERE expires_at <= ?", (now,)).fetchall()
+                expired[table] = {key: json.loads(value) for key, value in rows}
+
+        if not any(expired.values()):
+            return expired
+        with self.batch():
+            for table, entries in expired.items():
+                if not entries:
+                    continue
+                self.conn.execute(f"DELETE FROM {table} WHERE expires_at <= ?", (now,))
+                if self.loaded:
+                    for key in entries:
+                        del self.memory[table][key]
+        return expired
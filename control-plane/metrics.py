@@ -4,6 +4,7 @@
 from prometheus_client import (
     CollectorRegistry,
     Counter,
+    Gauge,
     Histogram
 )
 
@@ -18,10 +19,19 @@ containers_started_total = Counter(
 container_start_duration_seconds = Histogram(
     'container_start_duration_seconds',
     'Histogram of container start durations in seconds',
+    # cold -> the workspace volumes were created for this start, warm -> existing ones were mounted
+    ['volumes'],
     buckets=[0.1, 0.5, 1, 2.5, 5, 10],
     registry=registry
 )
 
+batch_start_containers_per_second = Histogram(
+    'batch_start_containers_per_second',
+    'Histogram of the containers started per second by each POST /start/batch',
+    buckets=[0.5, 1, 2, 5, 10, 20, 50, 100],
+    registry=registry
+)
+
 idle_containers_detected_total = Counter(
     'idle_containers_detected_total',
     'Total number of idle containers detected',
@@ -35,6 +45,25 @@ container_stop_duration_seconds = Histogram(
     registry=registry
 )
 
+container_drain_duration_seconds = Histogram(
+    'container_drain_duration_seconds',
+    'Histogram of the time from a container being marked draining to docker confirming it is removed and its port released',
+    buckets=[0.5, 1, 2.5, 5, 10, 20, 30, 60, 120],
+    registry=registry
+)
+
+containers_draining = Gauge(
+    'containers_draining',
+    'Number of containers queued or being stopped by the teardown workers',
+    registry=registry
+)
+
+instance_drain_duration_seconds = Gauge(
+    'instance_drain_duration_seconds',
+    'Seconds the last drain of the whole instance(POST /drain) took',
+    registry=registry
+)
+
 
 orchestrator_update_latency_seconds = Histogram(
     'orchestrator_update_latency_seconds',
@@ -43,6 +72,25 @@ orchestrator_update_latency_seconds = Histogram(
     registry=registry
 )
 
+start_queue_depth = Gauge(
+    'start_queue_depth',
+    'Number of /start requests waiting for a container launch slot',
+    registry=registry
+)
+
+start_queue_wait_seconds = Histogram(
+    'start_queue_wait_seconds',
+    'Histogram of the time /start requests waited for a container launch slot in seconds',
+    buckets=[0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30],
+    registry=registry
+)
+
+start_requests_rejected_total = Counter(
+    'start_requests_rejected_total',
+    'Total number of /start requests rejected with 429 since the launch queue was full',
+    registry=registry
+)
+
 active_user_container_max_duration = Histogram(
     'active_user_container_max_duration',
     'Histogram of time spend by user',
@@ -56,4 +104,261 @@ control_plane_startup_duration_seconds = Histogram(
     'Histogram of control plane startup durations in seconds',
     buckets=[1, 2, 5, 10, 15, 30, 60, 120, 180],
     registry=registry
+)
+
+image_pull_duration_seconds = Histogram(
+    'image_pull_duration_seconds',
+    'Histogram of image pre-pull durations on instance boot in seconds',
+    ['image'],
+    buckets=[1, 5, 10, 30, 60, 120, 300, 600],
+    registry=registry
+)
+
+instance_ready = Gauge(
+    'instance_ready',
+    '1 once the images are local and the instance takes /start requests',
+    registry=registry
+)
+
+control_plane_startup_repairs_total = Counter(
+    'control_plane_startup_repairs_total',
+    'Total number of KV and port table entries repaired against the running containers on startup',
+    ['kind'],
+    registry=registry
+)
+
+monitor_sweep_duration_seconds = Histogram(
+    'monitor_sweep_duration_seconds',
+    'Histogram of idle monitor sweep durations in seconds',
+    buckets=[0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30],
+    registry=registry
+)
+
+monitor_queue_depth = Gauge(
+    'monitor_queue_depth',
+    'Number of due containers waiting for a monitor worker',
+    registry=registry
+)
+
+monitor_checks_skipped_total = Counter(
+    'monitor_checks_skipped_total',
+    'Total number of container checks deferred to a later deadline since the container could not be idle yet',
+    registry=registry
+)
+
+monitor_kv_write_duration_seconds = Histogram(
+    'monitor_kv_write_duration_seconds',
+    'Histogram of the time spent writing the KV changes of a monitor sweep in seconds',
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1],
+    registry=registry
+)
+
+container_resume_duration_seconds = Histogram(
+    'container_resume_duration_seconds',
+    'Histogram of paused container resume durations in seconds',
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5],
+    registry=registry
+)
+
+paused_containers = Gauge(
+    'paused_containers',
+    'Number of idle containers kept paused',
+    registry=registry
+)
+
+paused_containers_memory_bytes = Gauge(
+    'paused_containers_memory_bytes',
+    'Memory held by the paused containers when they were paused, in bytes',
+    registry=registry
+)
+
+containers_memory_reclaimed_bytes_total = Counter(
+    'containers_memory_reclaimed_bytes_total',
+    'Total memory given back by stopping paused containers in bytes',
+    ['reason'],
+    registry=registry
+)
+
+container_cpu_percent = Gauge(
+    'container_cpu_percent',
+    'Rolling average CPU use of a container, 100 per core',
+    ['container_id'],
+    registry=registry
+)
+
+container_memory_bytes = Gauge(
+    'container_memory_bytes',
+    'Rolling average memory use of a container(without page cache) in bytes',
+    ['container_id'],
+    registry=registry
+)
+
+instance_load_score = Gauge(
+    'instance_load_score',
+    'Load of the instance from 0 to 1, the higher of its CPU and memory pressure',
+    registry=registry
+)
+
+instance_headroom_containers = Gauge(
+    'instance_headroom_containers',
+    'Estimated number of containers the instance can still take',
+    registry=registry
+)
+
+instance_capacity_containers = Gauge(
+    'instance_capacity_containers',
+    'Workspace containers the instance takes, configured(port pool) and effective(with the memory available now)',
+    ['kind'],
+    registry=registry
+)
+
+start_requests_refused_total = Counter(
+    'start_requests_refused_total',
+    'Total number of /start requests refused with 503 since there was not enough memory for another container',
+    registry=registry
+)
+
+workspace_volumes_bytes = Gauge(
+    'workspace_volumes_bytes',
+    'Disk used by the persistent workspace volumes in bytes',
+    registry=registry
+)
+
+workspace_volumes_removed_total = Counter(
+    'workspace_volumes_removed_total',
+    'Total number of workspace volumes garbage collected',
+    ['reason'],
+    registry=registry
+)
+
+warm_pool_size = Gauge(
+    'warm_pool_size',
+    'Number of pre-started containers waiting for a user',
+    registry=registry
+)
+
+warm_pool_requests_total = Counter(
+    'warm_pool_requests_total',
+    'Total number of /start requests by whether a warm container was available(hit) or not(miss)',
+    ['result'],
+    registry=registry
+)
+
+warm_pool_refill_duration_seconds = Histogram(
+    'warm_pool_refill_duration_seconds',
+    'Histogram of the time taken to start one warm pool container in seconds',
+    buckets=[0.1, 0.5, 1, 2.5, 5, 10, 30],
+    registry=registry
+)
+
+outbox_batch_size = Histogram(
+    'outbox_batch_size',
+    'Histogram of the number of lifecycle events sent to the orchestrator per batch',
+    buckets=[1, 2, 5, 10, 25, 50, 100],
+    registry=registry
+)
+
+outbox_delivery_lag_seconds = Histogram(
+    'outbox_delivery_lag_seconds',
+    'Histogram of the time between a lifecycle event and its delivery to the orchestrator in seconds',
+    buckets=[0.5, 1, 2.5, 5, 10, 30, 60, 300, 900],
+    registry=registry
+)
+
+outbox_retries_total = Counter(
+    'outbox_retries_total',
+    'Total number of failed lifecycle event batch deliveries that were retried',
+    registry=registry
+)
+
+outbox_pending_events = Gauge(
+    'outbox_pending_events',
+    'Number of lifecycle events waiting to be delivered to the orchestrator',
+    registry=registry
+)
+
+routing_tokens_revoked_total = Counter(
+    'routing_tokens_revoked_total',
+    'Total number of containers whose routing tokens were revoked before they expired',
+    registry=registry
+)
+
+# Proxy metrics, the proxy is a separate process so it gets its own registry served on PROXY_METRICS_PORT.
+# With several workers(proxy_launcher.py) prometheus_client runs in multiprocess mode and the launcher serves the sum.
+proxy_registry = CollectorRegistry()
+
+proxy_requests_total = Counter(
+    'proxy_requests_total',
+    'Total number of requests handled by each proxy worker',
+    ['worker'],
+    registry=proxy_registry
+)
+
+proxy_open_connections = Gauge(
+    'proxy_open_connections',
+    'Number of open client connections of each proxy worker',
+    ['worker'],
+    multiprocess_mode='livesum',
+    registry=proxy_registry
+)
+
+proxy_open_websockets = Gauge(
+    'proxy_open_websockets',
+    'Number of websockets spliced to the containers by each proxy worker',
+    ['worker'],
+    multiprocess_mode='livesum',
+    registry=proxy_registry
+)
+
+route_cache_hits_total = Counter(
+    'route_cache_hits_total',
+    'Total number of proxy route lookups served from the route cache',
+    registry=proxy_registry
+)
+
+route_cache_misses_total = Counter(
+    'route_cache_misses_total',
+    'Total number of proxy route lookups that had to decode the token',
+    registry=proxy_registry
+)
+
+routing_token_checks_total = Counter(
+    'routing_token_checks_total',
+    'Total number of routing tokens checked by the proxy by result(memoized, verified, invalid, revoked, stale)',
+    ['result'],
+    registry=proxy_registry
+)
+
+route_lookup_duration_seconds = Histogram(
+    'route_lookup_duration_seconds',
+    'Histogram of proxy route lookup durations in seconds',
+    ['result'],
+    buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1],
+    registry=proxy_registry
+)
+
+asset_cache_requests_total = Counter(
+    'asset_cache_requests_total',
+    'Total number of static asset requests by cache result(hit, not_modified, miss)',
+    ['result'],
+    registry=proxy_registry
+)
+
+asset_cache_bytes_saved_total = Counter(
+    'asset_cache_bytes_saved_total',
+    'Total bytes of static assets served by the proxy without going to the container',
+    registry=proxy_registry
+)
+
+asset_cache_size_bytes = Gauge(
+    'asset_cache_size_bytes',
+    'Bytes held by the static asset cache per tier',
+    ['tier'],
+    registry=proxy_registry
+)
+
+asset_cache_evictions_total = Counter(
+    'asset_cache_evictions_total',
+    'Total number of static assets dropped from the cache(out of the disk tier)',
+    registry=proxy_registry
 )
\ No newline at end of file
@@ -0,0 +1,173 @@
+import os
+import mmap
+import struct
+import hashlib
+
+# Base of the memory mapped tables shared between processes(route_table.py, activity.py): open addressing on a
+# 64 bit key over fixed-size records, a seqlock per record and a single writer process per file.
+
+EMPTY, USED, DELETED = 0, 1, 2
+MAX_READ_RETRIES = 100
+# used + deleted records over this share of the slots => compacted
+MAX_LOAD = 0.7
+
+
+def user_hash(user_id: str) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(user_id.encode(), digest_size=8).digest(), "little") or 1
+
+
+class MmapTable:
+    """
+    Open addressing hash table of fixed-size records in a memory mapped file.
+    Every record has a seqlock: the writer makes seq odd, writes, then makes it even again.
+    A reader retries while seq is odd or changed under it, so reads never block the writer.
+    A new table is written next to the old one and renamed over it, a reader never has the file truncated under it.
+    Subclasses give the layout: HEADER starts with magic and slots, RECORD with seq and key, STATE_FIELD is the
+    index of the state in a record without its seq.
+    """
+
+    NAME = "table"
+    MAGIC: bytes
+    HEADER: struct.Struct
+    RECORD: struct.Struct
+    # bytes a record takes in the file, RECORD.size unless it is padded
+    RECORD_SIZE: int | None = None
+    STATE_FIELD: int
+    # states of the records that hold an entry
+    LIVE_STATES = (USED,)
+    # offset of a u32 in the header set on the old file once a new one is renamed over it, None if readers
+    # notice the swap otherwise
+    RETIRED_OFFSET: int | None = None
+
+    def __init__(self, path: str, slots: int):
+        self.record_size = self.RECORD_SIZE or self.RECORD.size
+        self.path = path
+        self.slots = slots
+        self._map: mmap.mmap | None = None
+        self.writable = False
+        # writer only
+        self.used = 0
+        self.tombstones = 0
+
+    @property
+    def size(self) -> int:
+        return self.HEADER.size + self.record_size * self.slots
+
+    def _offset(self, slot: int) -> int:
+        return self.HEADER.size + slot * self.record_size
+
+    def _map_writable(self):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.writable = True
+
+    def map_readonly(self, fd: int) -> bool:
+        """Maps the open file read only if it holds a whole table, the slots are taken from its header"""
+        size = os.fstat(fd).st_size
+        if size < self.HEADER.size:
+            return False
+        table = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        magic, slots = self.HEADER.unpack_from(table, 0)[:2]
+        if magic != self.MAGIC or size != self.HEADER.size + self.record_size * slots:
+            table.close()
+            return False
+        self.close()
+        self._map = table
+        self.slots = slots
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.writable = False
+
+    def _write_table(self, records: list[tuple], header: tuple):
+        """Writes a new table with the records(every field but seq) and renames it over the old one"""
+        data = bytearray(self.size)
+        self.HEADER.pack_into(data, 0, self.MAGIC, self.slots, *header)
+        mask = self.slots - 1
+        for record in records:
+            slot = record[0] & mask
+            while self.RECORD.unpack_from(data, self._offset(slot))[self.STATE_FIELD + 1] != EMPTY:
+                slot = (slot + 1) & mask
+            self.RECORD.pack_into(data, self._offset(slot), 0, *record)
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.chmod(tmp_path, 0o644)
+        old_fd = None
+        if self.RETIRED_OFFSET is not None:
+            try:
+                old_fd = os.open(self.path, os.O_RDWR)
+            except OSError:
+                pass
+        os.replace(tmp_path, self.path)
+        if old_fd is not None:
+            # readers keep the old file mapped(truncating it under them would crash them) until they see this
+            try:
+                if os.fstat(old_fd).st_size >= self.HEADER.size:
+                    os.pwrite(old_fd, struct.pack("<I", 1), self.RETIRED_OFFSET)
+            finally:
+                os.close(old_fd)
+        self.close()
+        self._map_writable()
+        self.used = len(records)
+        self.tombstones = 0
+
+    def _read_record(self, slot: int) -> tuple:
+        """Every field but seq, read consistently"""
+        offset = self._offset(slot)
+        for _ in range(MAX_READ_RETRIES):
+            seq, *record = self.RECORD.unpack_from(self._map, offset)
+            if seq & 1:
+                continue
+            if struct.unpack_from("<I", self._map, offset)[0] == seq:
+                return tuple(record)
+        raise TimeoutError(f"{self.NAME} record kept changing")
+
+    def _write_record(self, slot: int, *record):
+        offset = self._offset(slot)
+        seq = struct.unpack_from("<I", self._map, offset)[0]
+        struct.pack_into("<I", self._map, offset, (seq + 1) & 0xFFFFFFFF)
+        self.RECORD.pack_into(self._map, offset, (seq + 1) & 0xFFFFFFFF, *record)
+        struct.pack_into("<I", self._map, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def _find(self, key: int) -> tuple[int | None, int | None]:
+        """(slot holding key, first free slot on the probe path)"""
+        mask = self.slots - 1
+        free = None
+        slot = key & mask
+        for _ in range(self.slots):
+            record = self._read_record(slot)
+            state = record[self.STATE_FIELD]
+            if state == EMPTY:
+                return None, free if free is not None else slot
+            if state == DELETED:
+                if free is None:
+                    free = slot
+            elif record[0] == key:
+                return slot, free
+            slot = (slot + 1) & mask
+        return None, free
+
+    def _live_records(self) -> list[tuple]:
+        records = []
+        for slot in range(self.slots):
+            record = self._read_record(slot)
+            if record[self.STATE_FIELD] in self.LIVE_STATES:
+                records.append(record)
+        return records
+
+    def _count(self):
+        """used and tombstones of a table mapped for writing as it is"""
+        self.used = self.tombstones = 0
+        for slot in range(self.slots):
+            state = self._read_record(slot)[self.STATE_FIELD]
+            self.used += state in self.LIVE_STATES
+            self.tombstones += state == DELETED
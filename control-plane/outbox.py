@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import httpx
+from ports import DB_PATH
+from metrics import outbox_batch_size, outbox_delivery_lag_seconds, outbox_retries_total, outbox_pending_events
+
+ORCHASTRATOR_URL = os.environ.get("ORCHASTRATOR_URL")
+X_ORCHASTRATOR_KEY = os.environ.get("X_ORCHASTRATOR_KEY","TOKEN")
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 100))
+# longest wait for more events before sending what is there
+OUTBOX_FLUSH_INTERVAL_SECONDS = 2
+OUTBOX_LINGER_SECONDS = 0.5
+OUTBOX_MAX_BACKOFF_SECONDS = 5 * 60
+OUTBOX_TIMEOUT_SECONDS = 10
+
+
+class Outbox:
+    """
+    Lifecycle events(started, idle, stopped) for the orchestrator, written to containers.db first
+    and sent in batches by a background sender. A row is deleted only after the orchestrator
+    acknowledged it so events survive restarts and are delivered at least once.
+    """
+
+    def __init__(self, url: str | None = ORCHASTRATOR_URL, db_path: str = DB_PATH):
+        self.url = f"{url.rstrip('/')}/events" if url else None
+        self.db_path = db_path
+        self._conn: sqlite3.Connection | None = None
+        self.wakeup = asyncio.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.url is not None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, container_id TEXT, payload TEXT, created_at REAL)"
+            )
+        return self._conn
+
+    def publish(self, event: str, container_id: str, **data):
+        if not self.enabled:
+            return
+        now = time.time()
+        payload = json.dumps({"event": event, "container_id": container_id, "at": now, **data})
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (container_id, payload, created_at) VALUES (?, ?, ?)",
+                (container_id, payload, now),
+            )
+        self.wakeup.set()
+
+    def next_batch(self) -> list[tuple[int, str, str, float]]:
+        return self.conn.execute(
+            "SELECT id, container_id, payload, created_at FROM outbox ORDER BY id LIMIT ?", (OUTBOX_BATCH_SIZE,)
+        ).fetchall()
+
+    def pending(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    @staticmethod
+    def coalesce(rows) -> list[dict]:
+        """Only the latest event of each container in a batch is sent, in the order they happened"""
+        latest = {}
+        for _, container_id, payload, _ in rows:
+            latest.pop(container_id, None)
+            latest[container_id] = json.loads(payload)
+        return list(latest.values())
+
+    async def send(self, client: httpx.AsyncClient, rows) -> bool:
+        events = self.coalesce(rows)
+        try:
+            response = await client.post(
+                self.url,
+                json={"events": events},
+                headers={"X-ORCHASTRATOR_KEY": X_ORCHASTRATOR_KEY},
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"Error sending {len(events)} events to the orchestrator: {e}")
+            return False
+
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1][0],))
+        outbox_batch_size.observe(len(events))
+        now = time.time()
+        for _, _, _, created_at in rows:
+            outbox_delivery_lag_seconds.observe(now - created_at)
+        return True
+
+    async def run(self):
+        if not self.enabled:
+            print("ORCHASTRATOR_URL not set, lifecycle events won't be sent")
+            return
+        print(f"Sending lifecycle events to {self.url}...")
+        attempt = 0
+        async with httpx.AsyncClient(timeout=OUTBOX_TIMEOUT_SECONDS) as client:
+            while True:
+                rows = self.next_batch()
+                outbox_pending_events.set(self.pending())
+                if not rows:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), OUTBOX_FLUSH_INTERVAL_SECONDS)
+                        # let the rest of the burst(mass idle out, login storm) land in the same batch
+                        await asyncio.sleep(OUTBOX_LINGER_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if await self.send(client, rows):
+                    attempt = 0
+                    continue
+
+                attempt += 1
+                outbox_retries_total.inc()
+                backoff = min(OUTBOX_MAX_BACKOFF_SECONDS, 2 ** attempt)
+                await asyncio.sleep(backoff / 2 + random.uniform(0, backoff / 2))
+
+
+outbox = Outbox()
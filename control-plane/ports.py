@@ -0,0 +1,274 @@
+import os
+import time
+import heapq
+import socket
+import sqlite3
+from collections import deque
+from contextlib import contextmanager
+from docker_client import CODE_SERVER_IMAGE
+from capacity import workspace_capacity
+
+DB_PATH = "containers.db"
+
+# port pool, 3001.. (3000 is the static asset container)
+PORT_POOL_START = int(os.environ.get("PORT_POOL_START", 3001))
+# 0 -> sized on startup from the host and the workspace profile(capacity.py)
+PORT_POOL_SIZE = int(os.environ.get("PORT_POOL_SIZE", 0))
+# a port allocated for a /start that never confirms it goes back to the pool after this
+START_LEASE_SECONDS = 5 * 60
+
+
+class PortAllocator:
+    """
+    O(1) allocate/release over a fixed port range.
+    In memory a bitmap says which ports are taken and a free-list hands out the next one,
+    every change is a single row insert/update/delete in containers.db done in one transaction.
+    Free ports have no row, so nothing is ever rewritten in bulk.
+    """
+
+    def __init__(self, start: int = PORT_POOL_START, size: int = PORT_POOL_SIZE, db_path: str = DB_PATH):
+        self.start = start
+        self.size = size
+        self.db_path = db_path
+        self.taken = bytearray(size)
+        self.allocated = 0
+        self.free: deque[int] = deque()
+        # port => leased until(unix seconds), only for ports that are not confirmed yet
+        self.leases: dict[int, float] = {}
+        self.lease_heap: list[tuple[float, int]] = []
+        # ports a container is being launched on, their leases are renewed instead of reclaimed
+        self.launching_ports: set[int] = set()
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS port_allocations ("
+                "port INTEGER PRIMARY KEY, owner TEXT, leased_until REAL)"
+            )
+        return self._conn
+
+    def _index(self, port: int) -> int | None:
+        index = port - self.start
+        return index if 0 <= index < self.size else None
+
+    def is_allocated(self, port: int) -> bool:
+        index = self._index(port)
+        return index is not None and bool(self.taken[index])
+
+    def reconcile(self, bound_ports: set[int], owners: dict[int, str] | None = None, conn: sqlite3.Connection | None = None):
+        """
+        Rebuilds the pool from the ports that are actually bound instead of resetting it.
+        Persisted allocations for ports nobody is bound to anymore are dropped.
+        With `conn` the rows are rewritten in the transaction the caller has open on it.
+        """
+        owners = owners or {}
+        self.taken = bytearray(self.size)
+        self.allocated = 0
+        self.free.clear()
+        self.leases.clear()
+        self.lease_heap.clear()
+
+        rows = []
+        for port in range(self.start, self.start + self.size):
+            if port in bound_ports:
+                self.taken[port - self.start] = 1
+                self.allocated += 1
+                rows.append((port, owners.get(port)))
+            else:
+                self.free.append(port)
+        if conn is not None:
+            self._rewrite(conn, rows)
+            return
+        with self.conn:
+            self._rewrite(self.conn, rows)
+
+    def _rewrite(self, conn: sqlite3.Connection, rows: list[tuple[int, str | None]]):
+        # the table may not exist yet if the caller's connection is another one
+        conn.execute("CREATE TABLE IF NOT EXISTS port_allocations (port INTEGER PRIMARY KEY, owner TEXT, leased_until REAL)")
+        persisted = dict(conn.execute("SELECT port, owner FROM port_allocations").fetchall())
+        conn.execute("DELETE FROM port_allocations")
+        conn.executemany(
+            "INSERT INTO port_allocations (port, owner, leased_until) VALUES (?, ?, ?)",
+            [(port, owner or persisted.get(port), None) for port, owner in rows],
+        )
+
+    def _reclaim_expired_leases(self, now: float):
+        while self.lease_heap and self.lease_heap[0][0] <= now:
+            leased_until, port = heapq.heappop(self.lease_heap)
+            # stale entry, confirmed or released since
+            if self.leases.get(port) != leased_until:
+                continue
+            if port in self.launching_ports:
+                # a slow launch(image pull, cold volumes) is still using it
+                self.leases[port] = now + START_LEASE_SECONDS
+                heapq.heappush(self.lease_heap, (self.leases[port], port))
+                continue
+            print(f"Lease on port {port} expired, returning it to the pool")
+            self.release(port)
+
+    def allocate(self, owner: str | None = None, lease_seconds: float | None = START_LEASE_SECONDS) -> int | None:
+        now = time.time()
+        self._reclaim_expired_leases(now)
+        while self.free:
+            port = self.free.popleft()
+            index = port - self.start
+            if self.taken[index]:
+                continue
+            leased_until = now + lease_seconds if lease_seconds else None
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO port_allocations (port, owner, leased_until) VALUES (?, ?, ?)",
+                    (port, owner, leased_until),
+                )
+            self.taken[index] = 1
+            self.allocated += 1
+            if leased_until:
+                self.leases[port] = leased_until
+                heapq.heappush(self.lease_heap, (leased_until, port))
+            return port
+        return None
+
+    def allocate_many(self, owners: list[str], lease_seconds: float | None = START_LEASE_SECONDS) -> list[int]:
+        """allocate() for each owner in one transaction, fewer ports than owners if the pool runs out"""
+        now = time.time()
+        self._reclaim_expired_leases(now)
+        leased_until = now + lease_seconds if lease_seconds else None
+        ports = []
+        while self.free and len(ports) < len(owners):
+            port = self.free.popleft()
+            if not self.taken[port - self.start]:
+                self.taken[port - self.start] = 1
+                ports.append(port)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO port_allocations (port, owner, leased_until) VALUES (?, ?, ?)",
+                [(port, owner, leased_until) for port, owner in zip(ports, owners)],
+            )
+        self.allocated += len(ports)
+        if leased_until:
+            for port in ports:
+                self.leases[port] = leased_until
+                heapq.heappush(self.lease_heap, (leased_until, port))
+        return ports
+
+    @contextmanager
+    def launching(self, port: int):
+        """The lease of the port isn't reclaimed while a container is launched on it"""
+        self.launching_ports.add(port)
+        try:
+            yield
+        finally:
+            self.launching_ports.discard(port)
+
+    def lease(self, port: int, owner: str | None = None, lease_seconds: float | None = None,
+              expected_owner: str | None = None):
+        """
+        Updates the owner of an allocated port. Without lease_seconds the port is held till released.
+        With expected_owner it raises ValueError unless the port is still allocated to it, a lease that was
+        reclaimed and handed to someone else is never taken over.
+        """
+        if not self.is_allocated(port):
+            raise ValueError(f"port {port} is not allocated")
+        leased_until = time.time() + lease_seconds if lease_seconds else None
+        with self.conn:
+            updated = self.conn.execute(
+                "UPDATE port_allocations SET owner = COALESCE(?, owner), leased_until = ? WHERE port = ? AND (? IS NULL OR owner = ?)",
+                (owner, leased_until, port, expected_owner, expected_owner),
+            ).rowcount
+        if not updated:
+            raise ValueError(f"port {port} is not allocated to {expected_owner}")
+        if leased_until:
+            self.leases[port] = leased_until
+            heapq.heappush(self.lease_heap, (leased_until, port))
+        else:
+            self.leases.pop(port, None)
+
+    def lease_many(self, owners: dict[int, str]):
+        """lease() for several allocated ports in one transaction, held till released"""
+        ports = {port: owner for port, owner in owners.items() if self.is_allocated(port)}
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE port_allocations SET owner = ?, leased_until = NULL WHERE port = ?",
+                [(owner, port) for port, owner in ports.items()],
+            )
+        for port in ports:
+            self.leases.pop(port, None)
+
+    def release(self, port: int):
+        index = self._index(port)
+        if index is None or not self.taken[index]:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM port_allocations WHERE port = ?", (port,))
+        self.taken[index] = 0
+        self.allocated -= 1
+        self.leases.pop(port, None)
+        self.free.append(port)
+
+    def release_many(self, ports: list[int]):
+        """release() for several ports in one transaction"""
+        ports = [port for port in ports if self._index(port) is not None and self.taken[self._index(port)]]
+        if not ports:
+            return
+        with self.conn:
+            self.conn.executemany("DELETE FROM port_allocations WHERE port = ?", [(port,) for port in ports])
+        for port in ports:
+            self.taken[self._index(port)] = 0
+            self.allocated -= 1
+            self.leases.pop(port, None)
+            self.free.append(port)
+
+    def release_owned(self, owners: list[str], ports: list[int] = ()) -> list[int]:
+        """
+        Releases the given ports and every port allocated to the owners(container ids), even the ones nothing
+        else remembers. Returns the released ports
+        """
+        owned = []
+        if owners:
+            owned = [port for port, in self.conn.execute(
+                f"SELECT port FROM port_allocations WHERE owner IN ({','.join('?' * len(owners))})", list(owners)
+            ).fetchall()]
+        released = list(dict.fromkeys([*ports, *owned]))
+        self.release_many(released)
+        return released
+
+    def free_count(self) -> int:
+        return self.size - self.allocated
+
+
+def is_port_bound(port: int, host: str = "0.0.0.0") -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind((host, port))
+            return False
+        except OSError:
+            return True
+
+
+port_allocator = PortAllocator()
+
+def is_code_server(container: dict) -> bool:
+    return (container["image"] or "").startswith(CODE_SERVER_IMAGE)
+
+def prepare_port_pool(containers: list[dict]) -> tuple[set[int], dict[int, str]]:
+    """
+    Sizes the pool and returns the ports in it that are taken, with the container_id of the ones published by `containers`.
+    Ports published by running containers stay allocated to them,
+    ports in the range held by anything else on the host are skipped.
+    """
+    owners = {port: container["id"] for container in containers for port in container["ports"]}
+    bound_ports = set(owners)
+    # code-server containers of a run with a bigger pool keep their ports
+    workspace_ports = [
+        port for container in containers if is_code_server(container)
+        for port in container["ports"] if port >= port_allocator.start
+    ]
+    size = PORT_POOL_SIZE or workspace_capacity.containers()
+    port_allocator.size = max([size, *(port - port_allocator.start + 1 for port in workspace_ports)])
+    for port in range(port_allocator.start, port_allocator.start + port_allocator.size):
+        if port not in bound_ports and is_port_bound(port):
+            bound_ports.add(port)
+    return bound_ports, owners
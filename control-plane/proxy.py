@@ -1,90 +1,132 @@
+import asyncio
 from mitmproxy import http
-from urllib.parse import parse_qs, urlparse, urlencode, urlunparse
-from utils import get_user_id_from_token
-from cache import get_container_id_by_user, get_container_metadata
-
-# will be always localhost as the codermon is running in the localhost only
-TARGET_HOST = "localhost"
-STATIC_ASSET_PORT = 3000
-
-def get_token_from_query(url):
-    parsed = urlparse(url)
-    query_params = parse_qs(parsed.query)
-    token_list = query_params.get("token", [])
-    return token_list[0] if token_list else None
-
-def get_folder_from_url(url):
-    parsed = urlparse(url)
-    query_params = parse_qs(parsed.query)
-    folder_list = query_params.get("folder", [])
-    return folder_list[0] if folder_list else None
-
-def append_token_if_missing(url, token):
-    parsed = urlparse(url)
-    query = parse_qs(parsed.query)
-
-    if "token" not in query:
-        query["token"] = [token]
-        new_query = urlencode(query, doseq=True)
-        return urlunparse(parsed._replace(query=new_query))
-    return url
-
-def is_static_path(path):
-    return (
-        path.startswith("/_static") or
-        path.startswith("/stable-") or
-        path.endswith("/manifest.json") or
-        path.endswith(".css") or
-        path.endswith(".js")
+from prometheus_client import start_http_server
+from metrics import proxy_registry, proxy_open_websockets
+from activity import ActivityRecorder, ActivityTable, worker_path
+from routing import (
+    TARGET_HOST,
+    STATIC_ASSET_PORT,
+    PROXY_METRICS_PORT,
+    STRIPPED_REQUEST_HEADERS,
+    get_token_from_query,
+    is_static_path,
+    resolve_route,
+    ContainerUnavailableError,
+    get_cached_asset,
+    store_asset,
+    upstream_headers,
+)
+
+# mitmproxy addon, the debug engine(mitmweb gives a ui over the flows). proxy_server.py is the default engine.
+
+activity = ActivityRecorder(ActivityTable(worker_path("mitm")))
+open_websockets = proxy_open_websockets.labels(worker="mitm")
+flush_task: asyncio.Task | None = None
+
+def serve_cached_asset(flow: http.HTTPFlow) -> bool:
+    """Answers a static asset request from the asset cache, True if it was"""
+    cached = get_cached_asset(
+        flow.request.method, flow.request.path, flow.request.headers.get("If-None-Match"), flow.request.headers.get("Accept-Encoding")
     )
-
+    if cached is None:
+        return False
+
+    status, asset = cached
+    headers = asset.response_headers()
+    if status == 304:
+        flow.response = http.Response.make(304, b"", {"ETag": asset.etag, "Cache-Control": headers["Cache-Control"]})
+        return True
+
+    flow.response = http.Response.make(200, b"", headers)
+    # body is stored as received(possibly compressed), so it is set raw
+    flow.response.raw_content = asset.body
+    flow.response.headers["Content-Length"] = str(asset.size)
+    return True
+
+def running():
+    global flush_task
+    start_http_server(PROXY_METRICS_PORT, registry=proxy_registry)
+    flush_task = asyncio.get_running_loop().create_task(activity.run())
 
 async def request(flow: http.HTTPFlow):
     if flow.request.path == "/start":
         flow.response = http.Response.make(401, b"not working")
         return
 
-    token = get_token_from_query(flow.request.url)
-    user_id = get_user_id_from_token(token)
-
     try:
         if is_static_path(flow.request.path):
+            if serve_cached_asset(flow):
+                return
             # master server incase of getting the assets
             port = STATIC_ASSET_PORT
         else:
-            container_id = await get_container_id_by_user(user_id)
-            if not container_id:
-                flow.response = http.Response.make(401, b"Unauthorized: Invalid or missing token")
-                return
-
-            container_metadata = await get_container_metadata(container_id)
-            if not container_metadata:
-                flow.response = http.Response.make(401, b"Unauthorized: Invalid or missing token")
+            # the token is already in the query here so nothing has to be appended to the path
+            try:
+                route = await resolve_route(get_token_from_query(flow.request.url))
+            except ContainerUnavailableError as e:
+                print(f"Error routing to a paused container: {e}")
+                flow.response = http.Response.make(503, b"Container is resuming, retry", {"Retry-After": "1"})
                 return
-
-            port = container_metadata['port']
-            if not token or not port:
+            if not route:
                 flow.response = http.Response.make(401, b"Unauthorized: Invalid or missing token")
                 return
-            flow.request.path = append_token_if_missing(flow.request.path, token)
+            port = route.port
+            # only requests routed to a user's container count as its activity
+            flow.metadata["user_id"] = route.user_id
+            activity.touch(route.user_id)
+            activity.received(route.user_id, len(flow.request.raw_content or b""))
 
         # Update target host and port
         flow.request.host = TARGET_HOST
         flow.request.port = port
 
-        # Force reload
-        flow.request.headers.pop("If-Modified-Since", None)
-        flow.request.headers.pop("If-None-Match", None)
-        flow.request.headers["Cache-Control"] = "no-cache"
-        flow.request.headers["Origin"] = f"http://{TARGET_HOST}:{port}"
-        flow.request.headers["Host"] = f"{TARGET_HOST}:{port}"
-        flow.request.headers["Referer"] = f"http://{TARGET_HOST}:{port}/"
+        for header in STRIPPED_REQUEST_HEADERS:
+            flow.request.headers.pop(header, None)
+        for header, value in upstream_headers(port).items():
+            flow.request.headers[header] = value
 
     except Exception as e:
         flow.response = http.Response.make(500, f"Internal Error: {str(e)}".encode())
 
+def response(flow: http.HTTPFlow):
+    user_id = flow.metadata.get("user_id")
+    if user_id:
+        activity.touch(user_id)
+        activity.sent(user_id, len(flow.response.raw_content or b""))
+
+    if (
+        flow.request.method == "GET"
+        and flow.response.status_code == 200
+        and flow.request.port == STATIC_ASSET_PORT
+        and is_static_path(flow.request.path)
+    ):
+        store_asset(
+            flow.request.path,
+            flow.response.raw_content or b"",
+            list(flow.response.headers.items()),
+            flow.response.headers.get("ETag"),
+        )
+
 async def websocket_handshake(flow: http.HTTPFlow):
-    request(flow)
+    await request(flow)
+
+def websocket_start(flow: http.HTTPFlow):
+    user_id = flow.metadata.get("user_id")
+    if user_id:
+        activity.websocket_opened(user_id)
+        open_websockets.inc()
+
+def websocket_message(flow: http.HTTPFlow):
+    user_id = flow.metadata.get("user_id")
+    if user_id:
+        message = flow.websocket.messages[-1]
+        if message.from_client:
+            activity.received(user_id, len(message.content))
+        else:
+            activity.sent(user_id, len(message.content))
 
-async def websocket_message(flow):
-    pass
+def websocket_end(flow: http.HTTPFlow):
+    user_id = flow.metadata.get("user_id")
+    if user_id:
+        open_websockets.dec()
+        activity.websocket_closed(user_id)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import asyncio
+import argparse
+
+# Runs proxy_server.py on every core: forks PROXY_WORKERS workers that each bind the proxy port with
+# SO_REUSEPORT so the kernel spreads the connections between them. Routes come from the shared
+# mmap route table(route_table.py) so workers don't share anything else.
+# Nothing from prometheus_client may be imported before the multiprocess dir is set and the proxy modules
+# are only imported in the workers(after fork) since they read their per worker settings on import.
+
+PROXY_HOST = os.environ.get("PROXY_HOST", "0.0.0.0")
+PROXY_PORT = int(os.environ.get("PROXY_PORT", 5000))
+PROXY_METRICS_PORT = int(os.environ.get("PROXY_METRICS_PORT", 5002))
+PROXY_WORKERS = int(os.environ.get("PROXY_WORKERS", 0)) or os.cpu_count() or 1
+PROXY_METRICS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "/tmp/codespaces-proxy-metrics")
+RESPAWN_DELAY_SECONDS = 1
+
+
+def run_worker(worker_id: int, workers: int, host: str, port: int):
+    os.environ["PROXY_WORKER_ID"] = str(worker_id)
+    # every worker has its own asset cache, the memory budget is split between them
+    asset_cache_dir = os.environ.get("ASSET_CACHE_DIR", ".asset-cache")
+    os.environ["ASSET_CACHE_DIR"] = os.path.join(asset_cache_dir, f"worker-{worker_id}")
+    memory_mb = int(os.environ.get("ASSET_CACHE_MEMORY_MB", 256))
+    os.environ["ASSET_CACHE_MEMORY_MB"] = str(max(1, memory_mb // workers))
+
+    from proxy_server import serve
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(serve(host, port, reuse_port=True))
+
+
+def spawn(worker_id: int, workers: int, host: str, port: int) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        run_worker(worker_id, workers, host, port)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Proxy worker {worker_id} crashed: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+
+def start_metrics_server(metrics_port: int):
+    from prometheus_client import CollectorRegistry, start_http_server, multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(metrics_port, registry=registry)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a proxy worker per core on the same port")
+    parser.add_argument("--host", default=PROXY_HOST)
+    parser.add_argument("--port", type=int, default=PROXY_PORT)
+    parser.add_argument("--metrics-port", type=int, default=PROXY_METRICS_PORT)
+    parser.add_argument("--workers", type=int, default=PROXY_WORKERS)
+    args = parser.parse_args()
+
+    prepare_metrics_dir()
+    start_metrics_server(args.metrics_port)
+    # workers => pid
+    workers = {worker_id: spawn(worker_id, args.workers, args.host, args.port) for worker_id in range(args.workers)}
+    print(f"Started {args.workers} proxy workers on {args.host}:{args.port}")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    from prometheus_client import multiprocess
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        multiprocess.mark_process_dead(pid)
+        worker_id = next((worker_id for worker_id, worker_pid in workers.items() if worker_pid == pid), None)
+        if worker_id is None:
+            continue
+        del workers[worker_id]
+        if stopping:
+            continue
+        print(f"Proxy worker {worker_id} exited with {os.waitstatus_to_exitcode(status)}, restarting it")
+        time.sleep(RESPAWN_DELAY_SECONDS)
+        workers[worker_id] = spawn(worker_id, args.workers, args.host, args.port)
+
+
+def prepare_metrics_dir():
+    # files of an earlier run would be summed in
+    shutil.rmtree(PROXY_METRICS_DIR, ignore_errors=True)
+    os.makedirs(PROXY_METRICS_DIR)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = PROXY_METRICS_DIR
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+import os
+import time
+import asyncio
+import argparse
+from functools import partial
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+from prometheus_client import start_http_server
+from metrics import proxy_registry, proxy_requests_total, proxy_open_connections, proxy_open_websockets
+from asset_cache import ASSET_CACHE_MAX_ENTRY_BYTES
+from activity import ActivityRecorder, ActivityTable, worker_path
+from routing import (
+    TARGET_HOST,
+    STATIC_ASSET_PORT,
+    PROXY_METRICS_PORT,
+    STRIPPED_REQUEST_HEADERS,
+    get_token_from_query,
+    is_static_path,
+    resolve_route,
+    ContainerUnavailableError,
+    get_cached_asset,
+    store_asset,
+    upstream_headers,
+)
+
+# Reverse proxy engine for the data path. Same routing as the mitmproxy addon(proxy.py) but it
+# only parses request/response heads: bodies are streamed through in chunks, upstream connections
+# are kept alive and pooled per container port and websockets are spliced byte for byte after the handshake.
+
+PROXY_HOST = os.environ.get("PROXY_HOST", "0.0.0.0")
+PROXY_PORT = int(os.environ.get("PROXY_PORT", 5000))
+# idle keep-alive connections kept per container port
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 32))
+UPSTREAM_IDLE_SECONDS = 30
+# a container that doesn't accept or answer in time gets a 504 instead of holding the client and the connection
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT_SECONDS", 5))
+UPSTREAM_RESPONSE_TIMEOUT_SECONDS = float(os.environ.get("UPSTREAM_RESPONSE_TIMEOUT_SECONDS", 60))
+CLIENT_IDLE_SECONDS = 120
+# set by proxy_launcher.py for each forked worker
+PROXY_WORKER_ID = os.environ.get("PROXY_WORKER_ID", "0")
+MAX_HEAD_BYTES = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "te", "trailer", "upgrade"}
+STRIPPED_REQUEST_HEADER_NAMES = {header.lower() for header in STRIPPED_REQUEST_HEADERS}
+
+
+class BadMessageError(Exception):
+    pass
+
+
+class UpstreamTimeoutError(Exception):
+    pass
+
+
+class ResponseStartedError(Exception):
+    """A message went bad after part of the response was written, the client can only be disconnected"""
+
+
+class Message:
+    """Start line and headers of a request or response, the body is never held"""
+
+    def __init__(self, start_line: str, headers: list[tuple[str, str]]):
+        self.start_line = start_line
+        self.headers = headers
+
+    def get(self, name: str) -> str | None:
+        name = name.lower()
+        for header, value in self.headers:
+            if header.lower() == name:
+                return value
+        return None
+
+    def tokens(self, name: str) -> set[str]:
+        value = self.get(name)
+        return {token.strip().lower() for token in value.split(",")} if value else set()
+
+    def framing(self) -> tuple[str, int]:
+        """How the body is delimited: (chunked, 0), (length, n) or (none, 0)"""
+        if "chunked" in self.tokens("transfer-encoding"):
+            return "chunked", 0
+        length = self.get("content-length")
+        if length is not None:
+            if not length.strip().isdigit():
+                raise BadMessageError(f"invalid content-length {length}")
+            return "length", int(length)
+        return "none", 0
+
+
+async def read_head(reader: asyncio.StreamReader) -> Message | None:
+    try:
+        data = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise BadMessageError("connection closed in the middle of a message head")
+    except asyncio.LimitOverrunError:
+        raise BadMessageError("message head too large")
+
+    lines = data.decode("latin-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise BadMessageError(f"invalid header line {line!r}")
+        headers.append((name.strip(), value.strip()))
+    return Message(lines[0], headers)
+
+
+def serialise_head(start_line: str, headers: list[tuple[str, str]]) -> bytes:
+    lines = [start_line, *(f"{name}: {value}" for name, value in headers), "", ""]
+    return "\r\n".join(lines).encode("latin-1")
+
+
+class Tee:
+    """Keeps a copy of a streamed body for the asset cache while it fits"""
+
+    def __init__(self, limit: int = ASSET_CACHE_MAX_ENTRY_BYTES):
+        self.limit = limit
+        self.chunks: list[bytes] | None = []
+        self.size = 0
+
+    def append(self, chunk: bytes):
+        if self.chunks is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.limit:
+            self.chunks = None
+            return
+        self.chunks.append(chunk)
+
+    @property
+    def body(self) -> bytes | None:
+        return b"".join(self.chunks) if self.chunks is not None else None
+
+
+async def copy_length(reader, writer, length: int, tee: Tee | None = None, count=None):
+    while length > 0:
+        chunk = await reader.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            raise ConnectionError("connection closed in the middle of a body")
+        length -= len(chunk)
+        writer.write(chunk)
+        if tee is not None:
+            tee.append(chunk)
+        if count is not None:
+            count(len(chunk))
+        await writer.drain()
+
+
+async def copy_chunked(reader, writer, tee: Tee | None = None, count=None):
+    """Passes the chunked framing through as is, the tee gets the decoded payload"""
+    while True:
+        size_line = await reader.readuntil(b"\r\n")
+        writer.write(size_line)
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise BadMessageError(f"invalid chunk size {size_line!r}")
+        if size == 0:
+            # trailers till the empty line
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                writer.write(line)
+                if line == b"\r\n":
+                    break
+            await writer.drain()
+            return
+        await copy_length(reader, writer, size, tee, count)
+        writer.write(await reader.readexactly(2))
+
+
+async def copy_until_close(reader, writer, tee: Tee | None = None, count=None):
+    while chunk := await reader.read(CHUNK_SIZE):
+        writer.write(chunk)
+        if tee is not None:
+            tee.append(chunk)
+        if count is not None:
+            count(len(chunk))
+        await writer.drain()
+
+
+async def copy_body(framing: tuple[str, int], reader, writer, tee: Tee | None = None, count=None):
+    """count(size) is called with the size of every chunk of the payload"""
+    kind, length = framing
+    if kind == "chunked":
+        await copy_chunked(reader, writer, tee, count)
+    elif kind == "length":
+        await copy_length(reader, writer, length, tee, count)
+    elif kind == "close":
+        await copy_until_close(reader, writer, tee, count)
+
+
+async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, count=None):
+    try:
+        while chunk := await reader.read(CHUNK_SIZE):
+            writer.write(chunk)
+            if count is not None:
+                count(len(chunk))
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def splice(client_reader, client_writer, upstream_reader, upstream_writer, received=None, sent=None):
+    """Both directions copied byte for byte till either side closes(websockets after the 101)"""
+    tasks = [
+        asyncio.create_task(pipe(client_reader, upstream_writer, received)),
+        asyncio.create_task(pipe(upstream_reader, client_writer, sent)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        upstream_writer.close()
+
+
+class UpstreamPool:
+    """Idle keep-alive connections to the containers, per port, most recently used first"""
+
+    def __init__(self, size: int = UPSTREAM_POOL_SIZE):
+        self.size = size
+        self.idle: dict[int, deque] = defaultdict(deque)
+
+    async def acquire(self, port: int) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """(reader, writer, reused)"""
+        idle = self.idle[port]
+        now = time.monotonic()
+        while idle:
+            reader, writer, idle_since = idle.pop()
+            if reader.at_eof() or writer.is_closing() or now - idle_since > UPSTREAM_IDLE_SECONDS:
+                writer.close()
+                continue
+            return reader, writer, True
+        reader, writer = await asyncio.open_connection(TARGET_HOST, port, limit=MAX_HEAD_BYTES)
+        return reader, writer, False
+
+    def release(self, port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        idle = self.idle[port]
+        if len(idle) >= self.size or reader.at_eof():
+            writer.close()
+            return
+        idle.append((reader, writer, time.monotonic()))
+
+
+class ProxyServer:
+    def __init__(self, pool: UpstreamPool | None = None, worker: str = PROXY_WORKER_ID):
+        self.pool = pool or UpstreamPool()
+        self.requests = proxy_requests_total.labels(worker=worker)
+        self.open_connections = proxy_open_connections.labels(worker=worker)
+        self.open_websockets = proxy_open_websockets.labels(worker=worker)
+        self.activity = ActivityRecorder(ActivityTable(worker_path(worker)))
+        # flushes the activity to the worker's table, set by serve()
+        self.activity_task: asyncio.Task | None = None
+
+    @staticmethod
+    def respond(writer, status: int, reason: str, body: bytes = b"", headers: dict | None = None, keep_alive: bool = True):
+        headers = {**(headers or {}), "Connection": "keep-alive" if keep_alive else "close"}
+        if "Content-Length" not in headers:
+            headers["Content-Length"] = str(len(body))
+        writer.write(serialise_head(f"HTTP/1.1 {status} {reason}", list(headers.items())) + body)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.open_connections.inc()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_head(reader), CLIENT_IDLE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+                self.requests.inc()
+                if not await self.handle_request(request, reader, writer):
+                    break
+        except BadMessageError as e:
+            print(f"Bad request: {e}")
+            self.respond(writer, 400, "Bad Request", str(e).encode(), keep_alive=False)
+        except ResponseStartedError as e:
+            print(f"Error in the middle of a response: {e}")
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception as e:
+            print(f"Unexpected error in the proxy: {e}")
+        finally:
+            self.open_connections.dec()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def handle_request(self, request: Message, client_reader, client_writer) -> bool:
+        """Proxies one request, returns whether the client connection can take another one"""
+        try:
+            method, target, version = request.start_line.split(" ", 2)
+        except ValueError:
+            raise BadMessageError(f"invalid request line {request.start_line!r}")
+        if "://" in target:
+            # absolute-form when used as a regular(forward) proxy like mitmproxy
+            parsed = urlparse(target)
+            target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        path = target.split("?", 1)[0]
+
+        connection = request.tokens("connection")
+        keep_alive = "close" not in connection if version == "HTTP/1.1" else "keep-alive" in connection
+        request_framing = request.framing()
+        # nothing read from a body we answer locally, so the connection can't be reused then
+        local_keep_alive = keep_alive and request_framing[0] == "none"
+
+        if path == "/start":
+            self.respond(client_writer, 401, "Unauthorized", b"not working", keep_alive=local_keep_alive)
+            return local_keep_alive
+
+        # only requests routed to a user's container count as its activity
+        user_id = None
+        if is_static_path(path):
+            cached = get_cached_asset(method, target, request.get("if-none-match"), request.get("accept-encoding"))
+            if cached is not None:
+                status, asset = cached
+                headers = asset.response_headers()
+                if status == 304:
+                    self.respond(client_writer, 304, "Not Modified", headers={"ETag": asset.etag, "Cache-Control": headers["Cache-Control"]}, keep_alive=local_keep_alive)
+                else:
+                    self.respond(client_writer, 200, "OK", asset.body, headers, keep_alive=local_keep_alive)
+                await client_writer.drain()
+                return local_keep_alive
+            # master server incase of getting the assets
+            port = STATIC_ASSET_PORT
+        else:
+            # the token is already in the query here so nothing has to be appended to the path
+            try:
+                route = await resolve_route(get_token_from_query(target))
+            except ContainerUnavailableError as e:
+                print(f"Error routing to a paused container: {e}")
+                self.respond(client_writer, 503, "Service Unavailable", b"Container is resuming, retry", {"Retry-After": "1"}, keep_alive=local_keep_alive)
+                return local_keep_alive
+            if not route:
+                self.respond(client_writer, 401, "Unauthorized", b"Unauthorized: Invalid or missing token", keep_alive=local_keep_alive)
+                return local_keep_alive
+            port = route.port
+            user_id = route.user_id
+            self.activity.touch(user_id)
+        received = partial(self.activity.received, user_id) if user_id else None
+        sent = partial(self.activity.sent, user_id) if user_id else None
+
+        upgrade = "upgrade" in connection and request.get("upgrade")
+        dropped = HOP_BY_HOP_HEADERS | STRIPPED_REQUEST_HEADER_NAMES | connection
+        rewritten = upstream_headers(port)
+        rewritten_names = {name.lower() for name in rewritten}
+        headers = [
+            (name, value) for name, value in request.headers
+            if name.lower() not in dropped and name.lower() not in rewritten_names
+        ]
+        headers += list(rewritten.items())
+        if upgrade:
+            headers += [("Connection", "Upgrade"), ("Upgrade", upgrade)]
+        head = serialise_head(f"{method} {target} HTTP/1.1", headers)
+
+        try:
+            response, upstream_reader, upstream_writer = await self.send_upstream(port, head, request_framing, client_reader, received)
+        except UpstreamTimeoutError as e:
+            print(f"Error proxying to port {port}: {e}")
+            self.respond(client_writer, 504, "Gateway Timeout", b"Container not responding", keep_alive=False)
+            return False
+        if response is None:
+            self.respond(client_writer, 502, "Bad Gateway", b"Container not reachable", keep_alive=False)
+            return False
+
+        try:
+            status = int(response.start_line.split(" ", 2)[1])
+            # informational responses(100 continue) are passed on and the real one follows
+            while 100 <= status < 200 and status != 101:
+                client_writer.write(serialise_head(response.start_line, response.headers))
+                response = await asyncio.wait_for(read_head(upstream_reader), UPSTREAM_RESPONSE_TIMEOUT_SECONDS)
+                if response is None:
+                    raise ConnectionError("upstream closed after an informational response")
+                status = int(response.start_line.split(" ", 2)[1])
+
+            if status == 101 and upgrade:
+                client_writer.write(serialise_head(response.start_line, response.headers))
+                await client_writer.drain()
+                if not user_id:
+                    await splice(client_reader, client_writer, upstream_reader, upstream_writer)
+                    return False
+                self.activity.websocket_opened(user_id)
+                self.open_websockets.inc()
+                try:
+                    await splice(client_reader, client_writer, upstream_reader, upstream_writer, received, sent)
+                finally:
+                    self.open_websockets.dec()
+                    self.activity.websocket_closed(user_id)
+                return False
+
+            if method == "HEAD" or status in (204, 304):
+                response_framing = ("none", 0)
+            else:
+                response_framing = response.framing()
+                if response_framing[0] == "none":
+                    # no length, the body ends when the container closes the connection
+                    response_framing = ("close", 0)
+            upstream_reusable = (
+                response_framing[0] != "close"
+                and "close" not in response.tokens("connection")
+                and response.start_line.startswith("HTTP/1.1")
+            )
+            keep_alive = keep_alive and response_framing[0] != "close"
+
+            response_dropped = HOP_BY_HOP_HEADERS | response.tokens("connection")
+            response_headers = [(name, value) for name, value in response.headers if name.lower() not in response_dropped]
+            response_headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+            client_writer.write(serialise_head(response.start_line, response_headers))
+
+            tee = None
+            if port == STATIC_ASSET_PORT and method == "GET" and status == 200 and response_framing[0] != "close":
+                tee = Tee()
+            await copy_body(response_framing, upstream_reader, client_writer, tee, sent)
+            await client_writer.drain()
+        except (BadMessageError, asyncio.TimeoutError) as e:
+            upstream_writer.close()
+            raise ResponseStartedError(str(e) or "upstream timed out") from e
+        except BaseException:
+            upstream_writer.close()
+            raise
+
+        if upstream_reusable:
+            self.pool.release(port, upstream_reader, upstream_writer)
+        else:
+            upstream_writer.close()
+
+        if tee is not None and tee.body is not None:
+            store_asset(target, tee.body, response.headers, response.get("etag"))
+        if user_id:
+            # a long download is activity till it ends
+            self.activity.touch(user_id)
+        return keep_alive
+
+    async def send_upstream(self, port: int, head: bytes, framing: tuple[str, int], client_reader, received=None):
+        """
+        Writes the request to a pooled connection and reads the response head.
+        A pooled connection the container already closed is retried once on a new one if the body wasn't sent yet.
+        Raises UpstreamTimeoutError if the container doesn't accept the connection or send the head in time.
+        """
+        for attempt in range(2):
+            try:
+                upstream_reader, upstream_writer, reused = await asyncio.wait_for(self.pool.acquire(port), UPSTREAM_CONNECT_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                raise UpstreamTimeoutError(f"no connection after {UPSTREAM_CONNECT_TIMEOUT_SECONDS}s")
+            except OSError as e:
+                print(f"Could not connect to the container on port {port}: {e}")
+                return None, None, None
+            try:
+                upstream_writer.write(head)
+                await copy_body(framing, client_reader, upstream_writer, count=received)
+                await upstream_writer.drain()
+                response = await asyncio.wait_for(read_head(upstream_reader), UPSTREAM_RESPONSE_TIMEOUT_SECONDS)
+                if response is None:
+                    raise ConnectionError("upstream closed the connection")
+                return response, upstream_reader, upstream_writer
+            except asyncio.TimeoutError:
+                upstream_writer.close()
+                raise UpstreamTimeoutError(f"no response after {UPSTREAM_RESPONSE_TIMEOUT_SECONDS}s")
+            except (ConnectionError, BadMessageError) as e:
+                upstream_writer.close()
+                if reused and attempt == 0 and framing[0] == "none":
+                    continue
+                print(f"Error proxying to port {port}: {e}")
+                return None, None, None
+        return None, None, None
+
+
+async def serve(host: str = PROXY_HOST, port: int = PROXY_PORT, **server_options):
+    proxy = ProxyServer()
+    # kept on the server, the loop only holds a weak reference to its tasks
+    proxy.activity_task = asyncio.create_task(proxy.activity.run())
+    server = await asyncio.start_server(proxy.handle_client, host, port, limit=MAX_HEAD_BYTES, **server_options)
+    print(f"Proxy listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reverse proxy for the code-server containers")
+    parser.add_argument("--host", default=PROXY_HOST)
+    parser.add_argument("--port", type=int, default=PROXY_PORT)
+    parser.add_argument("--metrics-port", type=int, default=PROXY_METRICS_PORT)
+    args = parser.parse_args()
+
+    start_http_server(args.metrics_port, registry=proxy_registry)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
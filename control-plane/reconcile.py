@@ -0,0 +1,128 @@
+import time
+from collections import Counter
+from docker_client import get_docker_client
+from ports import port_allocator, prepare_port_pool, is_code_server
+from cache import kv, USERS, CONTAINERS, WARM_POOL, VOLUMES, DEFAULT_TTL_SECONDS, touch_volumes
+from codermon import USER_LABEL, STATIC_ASSET_PORT, PAUSED_TTL_SECONDS, IDLE_OFFSET
+from volumes import VOLUME_SET_LABEL, volume_set_id
+from outbox import outbox
+from routing_tokens import revocations
+from metrics import control_plane_startup_repairs_total
+
+
+async def reconcile_startup() -> set[str]:
+    """
+    Makes the user, container and port tables agree with what docker runs before the control plane takes traffic.
+    One listing of every container, then all repairs in one transaction:
+    * dead_mapping / dead_warm: entries of containers that aren't running anymore are dropped
+    * user_mapping: a user => container entry missing for a running mapped container, or pointing at another one
+    * adopted: a running code-server container without a mapping is bound again to the user of its label(or of its volumes)
+    * port_mismatch / state_mismatch: metadata follows the port the container publishes and whether it is paused
+    * the port allocations are rebuilt from the published ports
+    The routing tokens of dead containers are revoked before that, of moved ones the tokens handed out so far.
+    Containers that can't be adopted(unknown_container) keep their port, the monitor stops them once idle.
+    Running containers left draining keep their metadata and port, they are queued for teardown again.
+    Returns the ids of the running code-server containers.
+    """
+    containers = await get_docker_client().list_containers()
+    bound_ports, owners = prepare_port_pool(containers)
+    running = {
+        container["id"]: container for container in containers
+        if is_code_server(container) and STATIC_ASSET_PORT not in container["ports"]
+    }
+    mappings = kv.items(CONTAINERS)
+    users = kv.items(USERS)
+    warm = kv.items(WARM_POOL)
+    volume_owners = {volume_set_id(record["volumes"]): user_id for user_id, record in kv.items(VOLUMES).items()}
+    now = time.time()
+    paused_ttl = int(PAUSED_TTL_SECONDS + IDLE_OFFSET.total_seconds())
+    repairs = Counter()
+    # (event, container_id, fields) for the orchestrator
+    events = []
+    # containers the routing tokens handed out before can't reach anymore
+    revoked = []
+    # containers on another port now, only the tokens handed out before are revoked
+    moved = []
+
+    with kv.batch():
+        for container_id, metadata in list(mappings.items()):
+            if container_id in running:
+                continue
+            user_id = str(metadata["user_id"]) if metadata and "user_id" in metadata else None
+            if user_id and users.get(user_id) == container_id:
+                kv.delete(USERS, user_id)
+                users.pop(user_id)
+                touch_volumes(user_id)
+            kv.delete(CONTAINERS, container_id)
+            del mappings[container_id]
+            revoked.append(container_id)
+            events.append(("stopped", container_id, {"user_id": user_id}))
+            repairs["dead_mapping"] += 1
+
+        for container_id in warm:
+            if container_id not in running or container_id in mappings:
+                kv.delete(WARM_POOL, container_id)
+                repairs["dead_warm"] += 1
+
+        for container_id, metadata in mappings.items():
+            # unbound already, the teardown workers pick it up again
+            if not metadata or "user_id" not in metadata or metadata.get("state") == "draining":
+                continue
+            user_id = str(metadata["user_id"])
+            container = running[container_id]
+            paused = container["state"] == "paused"
+            ttl = paused_ttl if paused else DEFAULT_TTL_SECONDS
+            if users.get(user_id) != container_id:
+                kv.set(USERS, user_id, container_id, ttl)
+                users[user_id] = container_id
+                repairs["user_mapping"] += 1
+            fields = {}
+            if container["ports"] and int(str(metadata["port"])) not in container["ports"]:
+                fields["port"] = container["ports"][0]
+                moved.append(container_id)
+                repairs["port_mismatch"] += 1
+            if paused != (metadata.get("state") == "paused"):
+                fields.update({"state": "paused", "paused_at": now} if paused else {"state": "running", "paused_at": None})
+                repairs["state_mismatch"] += 1
+            if fields:
+                kv.set(CONTAINERS, container_id, {**metadata, **fields}, ttl)
+
+        for user_id, container_id in list(users.items()):
+            if container_id not in mappings:
+                kv.delete(USERS, user_id)
+                del users[user_id]
+                repairs["user_mapping"] += 1
+
+        for container_id, container in running.items():
+            if container_id in mappings or container_id in warm:
+                continue
+            labels = container["labels"]
+            user_id = labels.get(USER_LABEL) or volume_owners.get(labels.get(VOLUME_SET_LABEL))
+            if not user_id or not container["ports"] or user_id in users:
+                repairs["unknown_container"] += 1
+                continue
+            paused = container["state"] == "paused"
+            ttl = paused_ttl if paused else DEFAULT_TTL_SECONDS
+            port = container["ports"][0]
+            kv.set(USERS, user_id, container_id, ttl)
+            kv.set(CONTAINERS, container_id, {
+                "user_id": user_id,
+                "port": port,
+                "assigned_at": now,
+                **({"state": "paused", "paused_at": now} if paused else {}),
+            }, ttl)
+            users[user_id] = container_id
+            events.append(("started", container_id, {"user_id": user_id, "port": port}))
+            repairs["adopted"] += 1
+
+        revocations.update(revoked=revoked, moved=moved)
+        # same transaction, the port table is in the same database
+        port_allocator.reconcile(bound_ports, owners, conn=kv.conn)
+
+    for event, container_id, fields in events:
+        outbox.publish(event, container_id, **fields)
+    for kind, count in repairs.items():
+        control_plane_startup_repairs_total.labels(kind=kind).inc(count)
+    print(f"Reconciled {len(running)} running containers, repairs: {dict(repairs) or 'none'}")
+    print(f"Port pool ready, {port_allocator.free_count()}/{port_allocator.size} ports free")
+    return set(running)
@@ -0,0 +1,50 @@
+import os
+import time
+from collections import OrderedDict
+
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", 1024))
+ROUTE_CACHE_TTL_SECONDS = float(os.environ.get("ROUTE_CACHE_TTL_SECONDS", 10))
+# how often the proxy checks the routes version written by the control plane
+ROUTE_VERSION_POLL_SECONDS = float(os.environ.get("ROUTE_VERSION_POLL_SECONDS", 0.5))
+
+
+class RouteCache:
+    """
+    Bounded LRU of token => (user_id, container_id, port) for the proxy.
+    An entry lives for the ttl or till the jwt expires, whichever is first.
+    The whole cache is dropped when the routes version changes(a container was removed or restarted).
+    """
+
+    def __init__(self, max_size: int = ROUTE_CACHE_SIZE, ttl: float = ROUTE_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, tuple]] = OrderedDict()
+        self.version = None
+
+    def get(self, token: str):
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        expires_at, route = entry
+        if expires_at <= time.time():
+            del self.entries[token]
+            return None
+        self.entries.move_to_end(token)
+        return route
+
+    def set(self, token: str, route: tuple, token_expires_at: float | None = None):
+        expires_at = time.time() + self.ttl
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        self.entries[token] = (expires_at, route)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def sync_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def clear(self):
+        self.entries.clear()
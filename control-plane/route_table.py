@@ -0,0 +1,146 @@
+import os
+import struct
+from collections import namedtuple
+from mmap_table import MmapTable, user_hash, USED, DELETED, MAX_LOAD
+
+# Shared user => port table for the proxy workers. The control plane writes it next to the local KV
+# and the proxy workers read it through mmap, no locks and no SQLite on the request path.
+ROUTE_TABLE_PATH = os.environ.get("ROUTE_TABLE_PATH", "routes.bin")
+# power of two, a few times the number of containers an instance can run
+ROUTE_TABLE_SLOTS = int(os.environ.get("ROUTE_TABLE_SLOTS", 4096))
+
+# PAUSED is a used record whose container is paused, the proxy has the control plane resume it first
+PAUSED = 3
+
+Route = namedtuple("Route", ["user_id", "port", "generation", "paused"], defaults=[False])
+
+
+class RouteTable(MmapTable):
+    """
+    user hash => (generation, port, state) records(mmap_table.py). There is a single writer(the control plane),
+    the proxy workers remap once the table they have is retired.
+    """
+
+    NAME = "route table"
+    MAGIC = b"CSRT"
+    # magic, slots, retired, generation
+    HEADER = struct.Struct("<4sIIQ")
+    RETIRED_OFFSET = 8
+    # seq, user hash, generation, port, state
+    RECORD = struct.Struct("<IQIHH")
+    RECORD_SIZE = 24
+    STATE_FIELD = 3
+    LIVE_STATES = (USED, PAUSED)
+
+    def __init__(self, path: str = ROUTE_TABLE_PATH, slots: int = ROUTE_TABLE_SLOTS):
+        super().__init__(path, slots)
+
+    def open_writer(self):
+        """Maps the table for writing, creating it if needed. There must be only one writer process"""
+        if self.writable:
+            return
+        try:
+            current_size = os.path.getsize(self.path)
+        except OSError:
+            current_size = None
+        if current_size != self.size:
+            self._swap_in([], 0)
+        else:
+            self._map_writable()
+            self._count()
+
+    def _swap_in(self, records: list[tuple[int, int, int, int]], generation: int):
+        """Writes a new table with the (user hash, generation, port, state) records and renames it over the old one"""
+        if len(records) >= self.slots:
+            raise MemoryError("route table is full, increase ROUTE_TABLE_SLOTS")
+        self._write_table(records, (0, generation))
+
+    def open_reader(self) -> bool:
+        if self._map is not None:
+            if self.writable or not self._retired():
+                return True
+            # the writer swapped a new table in
+            self.close()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            return self.map_readonly(fd)
+        finally:
+            os.close(fd)
+
+    def _retired(self) -> bool:
+        return struct.unpack_from("<I", self._map, self.RETIRED_OFFSET)[0] != 0
+
+    def _generation(self) -> int:
+        return self.HEADER.unpack_from(self._map, 0)[3]
+
+    def generation(self) -> int:
+        """Bumped by every change to the table, readers check it to notice one without scanning"""
+        return self._generation() if self.open_reader() else 0
+
+    def _next_generation(self) -> int:
+        generation = self._generation() + 1
+        struct.pack_into("<Q", self._map, self.RETIRED_OFFSET + 4, generation)
+        return generation & 0xFFFFFFFF
+
+    def lookup(self, user_id: str) -> Route | None:
+        if not self.open_reader():
+            return None
+        key = user_hash(user_id)
+        slot, _ = self._find(key)
+        if slot is None:
+            return None
+        found, generation, port, state = self._read_record(slot)
+        if state not in (USED, PAUSED) or found != key:
+            return None
+        return Route(user_id, port, generation, state == PAUSED)
+
+    def set(self, user_id: str, port: int, paused: bool = False) -> int:
+        """Returns the generation of the new route"""
+        self.open_writer()
+        key = user_hash(user_id)
+        slot, free = self._find(key)
+        if slot is None:
+            if free is None:
+                raise MemoryError("route table is full, increase ROUTE_TABLE_SLOTS")
+            slot = free
+            self.tombstones -= self._read_record(slot)[3] == DELETED
+            self.used += 1
+        generation = self._next_generation()
+        self._write_record(slot, key, generation, port, PAUSED if paused else USED)
+        if self.used + self.tombstones > self.slots * MAX_LOAD:
+            self.compact()
+        return generation
+
+    def remove(self, user_id: str):
+        self.open_writer()
+        key = user_hash(user_id)
+        slot, _ = self._find(key)
+        if slot is not None:
+            self._write_record(slot, key, self._next_generation(), 0, DELETED)
+            self.used -= 1
+            self.tombstones += 1
+
+    def compact(self):
+        """Drops the deleted records, misses have to probe past every one of them"""
+        records = self._live_records()
+        if len(records) > self.slots * MAX_LOAD:
+            print(f"Route table has {len(records)} routes in {self.slots} slots, increase ROUTE_TABLE_SLOTS")
+            return
+        self._swap_in(records, self._generation())
+
+    def rebuild(self, routes: dict[str, int], paused: "set[str] | None" = None):
+        """user_id => port, replaces everything in the table"""
+        self.open_writer()
+        generation = self._generation()
+        records = []
+        for user_id, port in routes.items():
+            generation += 1
+            state = PAUSED if paused and user_id in paused else USED
+            records.append((user_hash(user_id), generation & 0xFFFFFFFF, port, state))
+        self._swap_in(records, generation)
+
+
+route_table = RouteTable()
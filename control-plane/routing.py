@@ -0,0 +1,226 @@
+import os
+import time
+import httpx
+from urllib.parse import parse_qs, urlparse
+from utils import decode_token
+from cache import get_container_id_by_user, get_container_metadata, get_routes_version
+from route_cache import RouteCache, ROUTE_VERSION_POLL_SECONDS
+from route_table import route_table, Route
+from routing_tokens import revocations, routing_kid, verify, RoutingClaims, ROUTING_TOKEN_TTL_SECONDS
+from asset_cache import AssetCache, CachedAsset, cache_key, accepted_encodings
+from admission import SingleFlight
+from metrics import (
+    route_cache_hits_total,
+    route_cache_misses_total,
+    routing_token_checks_total,
+    route_lookup_duration_seconds,
+    asset_cache_requests_total,
+    asset_cache_bytes_saved_total,
+    asset_cache_size_bytes,
+    asset_cache_evictions_total,
+)
+
+# Routing shared by the proxy engines(proxy_server.py and the mitmproxy addon proxy.py)
+
+# will be always localhost as the codermon is running in the localhost only
+TARGET_HOST = "localhost"
+STATIC_ASSET_PORT = 3000
+PROXY_METRICS_PORT = int(os.environ.get("PROXY_METRICS_PORT", 5002))
+# the proxy runs without docker access, the control plane resumes paused containers for it
+CONTROL_PLANE_URL = os.environ.get("CONTROL_PLANE_URL", "http://localhost:8000")
+X_ORCHASTRATOR_KEY = os.environ.get("X_ORCHASTRATOR_KEY", "TOKEN")
+RESUME_TIMEOUT_SECONDS = 30
+
+route_cache = RouteCache()
+# routing token => verified claims till it expires, the revocations are checked on every request
+token_memo = RouteCache(ttl=ROUTING_TOKEN_TTL_SECONDS)
+asset_cache = AssetCache()
+resume_flights = SingleFlight()
+control_plane_client: httpx.AsyncClient | None = None
+reported_asset_evictions = 0
+last_version_check = 0.0
+
+def get_token_from_query(url):
+    parsed = urlparse(url)
+    query_params = parse_qs(parsed.query)
+    token_list = query_params.get("token", [])
+    return token_list[0] if token_list else None
+
+def is_static_path(path):
+    return (
+        path.startswith("/_static") or
+        path.startswith("/stable-") or
+        path.endswith("/manifest.json") or
+        path.endswith(".css") or
+        path.endswith(".js")
+    )
+
+
+async def sync_routes_version():
+    """Drops the route cache if the control plane removed or restarted a container, checked at most every poll interval"""
+    global last_version_check
+    now = time.monotonic()
+    if now - last_version_check < ROUTE_VERSION_POLL_SECONDS:
+        return
+    last_version_check = now
+    route_cache.sync_version(await get_routes_version())
+
+async def lookup_route(user_id: str) -> Route | None:
+    """user_id => Route from the shared route table, or the local KV if the control plane hasn't created the table"""
+    if route_table.open_reader():
+        return route_table.lookup(user_id)
+    container_id = await get_container_id_by_user(user_id)
+    container_metadata = await get_container_metadata(container_id) if container_id else None
+    port = container_metadata.get("port") if container_metadata else None
+    return Route(user_id, int(str(port)), 0, container_metadata.get("state") == "paused") if port else None
+
+class ContainerUnavailableError(Exception):
+    pass
+
+async def request_resume(user_id: str):
+    global control_plane_client
+    if control_plane_client is None:
+        control_plane_client = httpx.AsyncClient(base_url=CONTROL_PLANE_URL, timeout=RESUME_TIMEOUT_SECONDS)
+    try:
+        response = await control_plane_client.post(
+            "/resume", json={"user_id": user_id}, headers={"X-ORCHASTRATOR_KEY": X_ORCHASTRATOR_KEY}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise ContainerUnavailableError(f"could not resume the container of {user_id}: {e}")
+
+async def resume_route(route: Route) -> Route:
+    """Has the control plane unpause the user's container, every request waiting on it shares one call"""
+    await resume_flights.do(route.user_id, lambda: request_resume(route.user_id))
+    resumed = await lookup_route(route.user_id)
+    if not resumed or resumed.paused:
+        raise ContainerUnavailableError(f"container of {route.user_id} is still paused")
+    return resumed
+
+async def resolve_route(token):
+    """
+    token => Route(user_id, port, generation) or None.
+    A paused container is resumed first, ContainerUnavailableError if that fails
+    """
+    route = await find_route(token)
+    if route and route.paused:
+        return await resume_route(route)
+    return route
+
+def claims_route(claims: RoutingClaims) -> Route | None:
+    revocations.refresh()
+    if revocations.is_revoked(claims.container_id, claims.generation):
+        routing_token_checks_total.labels(result="revoked").inc()
+        return None
+    if not route_table.open_reader():
+        return Route(claims.user_id, claims.port, claims.generation, revocations.is_paused(claims.container_id))
+    # the port must still be the user's route, a stale token would reach whoever has the port now.
+    # the table read is lock free, a route only gets newer generations
+    route = route_table.lookup(claims.user_id)
+    if route is None or route.port != claims.port or route.generation < claims.generation:
+        routing_token_checks_total.labels(result="stale").inc()
+        return None
+    return route
+
+def verify_route(token: str, kid: str, started: float) -> Route | None:
+    verified = verify(token, kid)
+    route_lookup_duration_seconds.labels(result="token").observe(time.perf_counter() - started)
+    if not verified:
+        routing_token_checks_total.labels(result="invalid").inc()
+        return None
+    claims, expires_at = verified
+    routing_token_checks_total.labels(result="verified").inc()
+    token_memo.set(token, claims, expires_at)
+    return claims_route(claims)
+
+async def find_route(token):
+    """
+    Routing tokens(minted by /start) route on their claims, the signature is checked once per token.
+    The orchestrator's user tokens are still looked up in the route table
+    """
+    if not token:
+        return None
+    started = time.perf_counter()
+    claims = token_memo.get(token)
+    if claims:
+        routing_token_checks_total.labels(result="memoized").inc()
+        route = claims_route(claims)
+        route_lookup_duration_seconds.labels(result="token").observe(time.perf_counter() - started)
+        return route
+
+    if route_table.open_reader():
+        cached = route_cache.get(token)
+        if cached:
+            # the token is still decoded once per ttl, the table read is lock free so the port is always current
+            route_cache_hits_total.inc()
+            route = route_table.lookup(cached.user_id)
+            route_lookup_duration_seconds.labels(result="hit").observe(time.perf_counter() - started)
+            return route
+    else:
+        await sync_routes_version()
+        route = route_cache.get(token)
+        if route:
+            route_cache_hits_total.inc()
+            route_lookup_duration_seconds.labels(result="hit").observe(time.perf_counter() - started)
+            return route
+
+    kid = routing_kid(token)
+    if kid:
+        return verify_route(token, kid, started)
+
+    route_cache_misses_total.inc()
+    claims = decode_token(token)
+    user_id = claims.get("userId") if claims else None
+    route = await lookup_route(user_id) if user_id else None
+    route_lookup_duration_seconds.labels(result="miss").observe(time.perf_counter() - started)
+    if not route:
+        return None
+
+    route_cache.set(token, route, claims.get("exp"))
+    return route
+
+def update_asset_cache_metrics():
+    global reported_asset_evictions
+    asset_cache_size_bytes.labels(tier="memory").set(asset_cache.memory_used)
+    asset_cache_size_bytes.labels(tier="disk").set(asset_cache.disk_used)
+    asset_cache_evictions_total.inc(asset_cache.evictions - reported_asset_evictions)
+    reported_asset_evictions = asset_cache.evictions
+
+def get_cached_asset(method: str, path: str, if_none_match: str | None, accept_encoding: str | None) -> tuple[int, CachedAsset] | None:
+    """(status, asset) to answer a static asset request with, None if it has to go to the container"""
+    if method != "GET":
+        return None
+    # the first cached encoding the client takes, it is only ever sent a body it can decode
+    asset = None
+    for encoding in accepted_encodings(accept_encoding):
+        asset = asset_cache.get(cache_key(path, encoding))
+        if asset is not None:
+            break
+    if asset is None:
+        asset_cache_requests_total.labels(result="miss").inc()
+        return None
+
+    asset_cache_bytes_saved_total.inc(asset.size)
+    if asset.matches(if_none_match):
+        asset_cache_requests_total.labels(result="not_modified").inc()
+        return 304, asset
+    asset_cache_requests_total.labels(result="hit").inc()
+    return 200, asset
+
+def store_asset(path: str, body: bytes, headers: list[tuple[str, str]], etag: str | None):
+    encoding = next((value for name, value in headers if name.lower() == "content-encoding"), "identity")
+    asset_cache.put(cache_key(path, encoding), body, headers, etag)
+    update_asset_cache_metrics()
+
+def upstream_headers(port: int) -> dict:
+    """Headers rewritten on every proxied request"""
+    return {
+        # Force reload
+        "Cache-Control": "no-cache",
+        "Origin": f"http://{TARGET_HOST}:{port}",
+        "Host": f"{TARGET_HOST}:{port}",
+        "Referer": f"http://{TARGET_HOST}:{port}/",
+    }
+
+# conditional headers are dropped so the container always answers with a full body(the asset cache does the 304s)
+STRIPPED_REQUEST_HEADERS = ("If-Modified-Since", "If-None-Match")
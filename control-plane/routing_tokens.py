@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import secrets
+import jwt
+from collections import namedtuple
+from route_cache import ROUTE_VERSION_POLL_SECONDS
+from route_table import route_table
+from metrics import routing_tokens_revoked_total
+
+# Routing tokens: /start hands out a short lived jwt signed with a secret only this instance has, carrying the
+# container's port, id and route generation, so the proxy routes a request from the verified claims alone.
+# Containers stopped, moved or paused before their tokens expire are listed in a small revocation file, the proxy
+# rereads it whenever the route table's generation moves(every change to it comes with one).
+ROUTING_KEYS_PATH = os.environ.get("ROUTING_KEYS_PATH", "routing_keys.json")
+ROUTING_REVOCATIONS_PATH = os.environ.get("ROUTING_REVOCATIONS_PATH", "routing_revocations.json")
+# the client gets a new one from /start(answered right away for a user with a container) before it runs out,
+# so revocations and retired keys are only kept this long
+ROUTING_TOKEN_TTL_SECONDS = int(os.environ.get("ROUTING_TOKEN_TTL_SECONDS", 15 * 60))
+# a new signing key every day, the old ones still verify the tokens they signed till those expire
+ROUTING_KEY_ROTATION_SECONDS = int(os.environ.get("ROUTING_KEY_ROTATION_SECONDS", 24 * 60 * 60))
+ALGORITHM = "HS256"
+
+RoutingClaims = namedtuple("RoutingClaims", ["user_id", "container_id", "port", "generation"])
+
+
+def write_json(path: str, data: dict, mode: int):
+    """Written next to the file and renamed over it, a reader never sees half of it"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+    os.chmod(tmp_path, mode)
+    try:
+        # the proxy runs as the user owning the checkout, not as root like the control plane
+        os.chown(tmp_path, -1, os.stat(os.path.dirname(os.path.abspath(path))).st_gid)
+    except OSError:
+        pass
+    os.replace(tmp_path, path)
+
+
+class KeyRing:
+    """
+    kid => secret of the routing keys. The control plane creates and rotates them, the proxy rereads the
+    file when a token names a kid it doesn't know yet.
+    """
+
+    def __init__(self, path: str = ROUTING_KEYS_PATH):
+        self.path = path
+        self.active: str | None = None
+        # kid => {secret, created_at}
+        self.keys: dict[str, dict] = {}
+        self.mtime_ns: int | None = None
+
+    def load(self) -> bool:
+        """Rereads the file if it changed, False if there is none(yet)"""
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime_ns == self.mtime_ns:
+            return True
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the routing keys {self.path}: {e}")
+            return False
+        self.active = data.get("active")
+        self.keys = data.get("keys", {})
+        self.mtime_ns = mtime_ns
+        return True
+
+    def signing_key(self) -> tuple[str, str]:
+        """(kid, secret) to sign with, control plane only"""
+        if self.mtime_ns is None:
+            self.load()
+        key = self.keys.get(self.active) if self.active else None
+        if key is None or time.time() - key["created_at"] >= ROUTING_KEY_ROTATION_SECONDS:
+            self.rotate()
+        return self.active, self.keys[self.active]["secret"]
+
+    def rotate(self):
+        now = time.time()
+        # a key signs for ROUTING_KEY_ROTATION_SECONDS, the last tokens it signed expire ROUTING_TOKEN_TTL_SECONDS later
+        oldest = now - ROUTING_KEY_ROTATION_SECONDS - ROUTING_TOKEN_TTL_SECONDS
+        keys = {kid: key for kid, key in self.keys.items() if key["created_at"] > oldest}
+        kid = secrets.token_hex(8)
+        keys[kid] = {"secret": secrets.token_hex(32), "created_at": now}
+        write_json(self.path, {"active": kid, "keys": keys}, 0o640)
+        self.active, self.keys = kid, keys
+        self.mtime_ns = os.stat(self.path).st_mtime_ns
+        print(f"Rotated the routing key, {len(keys)} keys can verify tokens")
+
+    def verification_key(self, kid: str) -> str | None:
+        key = self.keys.get(kid)
+        if key is None and self.load():
+            key = self.keys.get(kid)
+        return key["secret"] if key else None
+
+
+class Revocations:
+    """
+    The containers whose tokens must not route anymore and the paused ones(the proxy has the control plane resume
+    them first). A revocation is container_id => [generation, when the last token it covers expires]: tokens of
+    the container minted at a route generation below it are revoked, every token of a container that went away
+    (generation None). The control plane writes the whole file on every change, it only holds the revocations
+    made within ROUTING_TOKEN_TTL_SECONDS.
+    """
+
+    def __init__(self, path: str = ROUTING_REVOCATIONS_PATH):
+        self.path = path
+        self.revoked: dict[str, list] = {}
+        self.paused: set[str] = set()
+        self.loaded = False
+        # proxy only: route table generation(or file mtime without a table) the file was read at
+        self.version = None
+        self.last_check = 0.0
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, ValueError) as e:
+            print(f"Could not read the routing revocations {self.path}: {e}")
+            return
+        self.revoked = {
+            # a file of the previous format only has the expiry, the containers went away
+            container_id: revocation if isinstance(revocation, list) else [None, revocation]
+            for container_id, revocation in data.get("revoked", {}).items()
+        }
+        self.paused = set(data.get("paused", []))
+        self.loaded = True
+
+    def _write(self):
+        now = time.time()
+        self.revoked = {container_id: revocation for container_id, revocation in self.revoked.items() if revocation[1] > now}
+        write_json(self.path, {"revoked": self.revoked, "paused": sorted(self.paused)}, 0o644)
+
+    def update(self, revoked: list[str] | None = None, paused: dict[str, bool] | None = None, moved: list[str] | None = None):
+        """
+        Control plane: revokes every token of the containers that go away, the tokens minted so far of the ones
+        that `moved`(to another port, the next route generation is theirs) and marks which are paused, one write.
+        Called before the route table changes and before their ports are released.
+        """
+        if not self.loaded:
+            self.load()
+        changed = False
+        expires_at = time.time() + ROUTING_TOKEN_TTL_SECONDS
+        if revoked:
+            for container_id in revoked:
+                self.revoked[container_id] = [None, expires_at]
+                self.paused.discard(container_id)
+            routing_tokens_revoked_total.inc(len(revoked))
+            changed = True
+        if moved:
+            # every token minted till now carries a generation up to the table's current one
+            generation = (route_table.generation() + 1) & 0xFFFFFFFF
+            for container_id in moved:
+                if self.revoked.get(container_id, [0])[0] is not None:
+                    self.revoked[container_id] = [generation, expires_at]
+            routing_tokens_revoked_total.inc(len(moved))
+            changed = True
+        for container_id, is_paused in (paused or {}).items():
+            if is_paused and container_id not in self.paused:
+                self.paused.add(container_id)
+                changed = True
+            elif not is_paused and container_id in self.paused:
+                self.paused.discard(container_id)
+                changed = True
+        if changed:
+            self._write()
+
+    def rebuild(self, paused: set[str]):
+        """Control plane startup: the paused containers are taken from the KV, the revocations are kept"""
+        self.load()
+        self.paused = set(paused)
+        self._write()
+
+    def refresh(self):
+        """Proxy: rereads the file if the route table changed, a lock free read of its header"""
+        if route_table.open_reader():
+            version = route_table.generation()
+        else:
+            now = time.monotonic()
+            if now - self.last_check < ROUTE_VERSION_POLL_SECONDS:
+                return
+            self.last_check = now
+            try:
+                version = os.stat(self.path).st_mtime_ns
+            except OSError:
+                version = None
+        if version != self.version:
+            self.version = version
+            self.load()
+
+    def is_revoked(self, container_id: str, generation: int) -> bool:
+        revocation = self.revoked.get(container_id)
+        return revocation is not None and (revocation[0] is None or generation < revocation[0])
+
+    def is_paused(self, container_id: str) -> bool:
+        return container_id in self.paused
+
+
+key_ring = KeyRing()
+revocations = Revocations()
+
+
+def mint(user_id: str, container_id: str, port: int, generation: int) -> tuple[str, int]:
+    """(routing token, when it expires) for the container of the user"""
+    kid, secret = key_ring.signing_key()
+    now = int(time.time())
+    expires_at = now + ROUTING_TOKEN_TTL_SECONDS
+    claims = {"userId": user_id, "cid": container_id, "port": port, "gen": generation, "iat": now, "exp": expires_at}
+    return jwt.encode(claims, secret, algorithm=ALGORITHM, headers={"kid": kid}), expires_at
+
+
+def routing_kid(token: str) -> str | None:
+    """kid of a routing token, None for the orchestrator's user tokens"""
+    try:
+        return jwt.get_unverified_header(token).get("kid")
+    except jwt.InvalidTokenError:
+        return None
+
+
+def verify(token: str, kid: str) -> tuple[RoutingClaims, float] | None:
+    """(claims, expiry) of a valid routing token, None if it is forged, expired or signed by an unknown key"""
+    secret = key_ring.verification_key(kid)
+    if secret is None:
+        return None
+    try:
+        claims = jwt.decode(token, secret, algorithms=[ALGORITHM], options={"require": ["exp"]})
+        return RoutingClaims(str(claims["userId"]), str(claims["cid"]), int(claims["port"]), int(claims.get("gen", 0))), claims["exp"]
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+        return None
@@ -2,6 +2,7 @@
 
 start_control_plane=false
 start_proxy=false
+use_mitm=false
 
 # Parse command-line arguments
 for arg in "$@"
@@ -17,9 +18,12 @@ do
       start_control_plane=true
       start_proxy=true
       ;;
+    --mitm)
+      use_mitm=true
+      ;;
     *)
       echo "Unknown argument: $arg"
-      echo "Usage: ./start.sh [--control-plane] [--proxy] [--all]"
+      echo "Usage: ./start.sh [--control-plane] [--proxy] [--all] [--mitm]"
       exit 1
       ;;
   esac
@@ -36,8 +40,8 @@ if $start_control_plane; then
   fi
 fi
 
-# Start mitmweb proxy
-if $start_proxy; then
+# Start the proxy, mitmweb gives a ui over the flows for debugging
+if $start_proxy && $use_mitm; then
   echo "Starting mitmweb proxy..."
   mitmweb -s proxy.py \
     --mode regular \
@@ -45,4 +49,7 @@ if $start_proxy; then
     --listen-port 5000 \
     --set web_port=5001 \
     --set block_global=false
+elif $start_proxy; then
+  echo "Starting proxy..."
+  python proxy_launcher.py --host 0.0.0.0 --port 5000
 fi
@@ -7,6 +7,8 @@ cd "$SCRIPT_DIR"
 APP_USER=$(whoami)
 PYTHON_BIN="/usr/bin/python3.12"
 UV_BIN="/root/.local/bin/uv"
+# native -> proxy_launcher.py(default, a proxy_server.py worker per core), mitm -> mitmweb with proxy.py for debugging the flows
+PROXY_MODE="${PROXY_MODE:-native}"
 
 if [  ! -f "$UV_BIN" ]; then
   echo "Installing uv..."
@@ -25,17 +27,23 @@ fi
 source "$SCRIPT_DIR/.venv/bin/activate"
 $UV_BIN pip install -r requirements.txt
 
+if [ "$PROXY_MODE" = "mitm" ]; then
+  PROXY_EXEC="$SCRIPT_DIR/.venv/bin/mitmweb -s proxy.py --mode regular --listen-host 0.0.0.0 --listen-port 5000 --set web_port=5001 --set block_global=false"
+else
+  PROXY_EXEC="$SCRIPT_DIR/.venv/bin/python proxy_launcher.py --host 0.0.0.0 --port 5000"
+fi
+
 # --- Create systemd service: proxy.service ---
 sudo tee /etc/systemd/system/proxy.service > /dev/null <<EOF
 [Unit]
-Description=MITM Proxy Service
+Description=Proxy Service
 After=network.target
 
 [Service]
 Type=simple
 User=$APP_USER
 WorkingDirectory=$SCRIPT_DIR
-ExecStart=$SCRIPT_DIR/.venv/bin/mitmweb -s proxy.py --mode regular --listen-host 0.0.0.0 --listen-port 5000 --set web_port=5001 --set block_global=false
+ExecStart=$PROXY_EXEC
 Restart=always
 RestartSec=5
 
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+from docker_client import get_docker_client, DOCKER_MAX_CONNECTIONS
+from cache import mark_draining, remove_containers, get_container_metadata
+from outbox import outbox
+from metrics import container_stop_duration_seconds, container_drain_duration_seconds, containers_draining
+
+# SIGTERM to SIGKILL, code-server exits well within it
+TEARDOWN_GRACE_SECONDS = int(os.environ.get("TEARDOWN_GRACE_SECONDS", 5))
+# every stop holds a docker connection for up to the grace period, half of them are left for everything else
+TEARDOWN_WORKERS = int(os.environ.get("TEARDOWN_WORKERS", max(1, DOCKER_MAX_CONNECTIONS // 2)))
+TEARDOWN_REMOVE_TIMEOUT_SECONDS = 60
+# a failed teardown keeps the port and is tried again after this long
+TEARDOWN_RETRY_SECONDS = 30
+
+
+class Teardown:
+    """
+    Stops containers through a bounded pool of workers instead of one at a time in the monitor.
+    A container is marked draining as soon as it is queued(unbound from its user, so the proxy stops routing to it),
+    its metadata and port are only released once docker confirms it is removed.
+    """
+
+    def __init__(self, workers: int = TEARDOWN_WORKERS):
+        self.workers = workers
+        # (container_id, queued at)
+        self.queue: asyncio.Queue[tuple[str, float]] = asyncio.Queue()
+        # container_id => resolved once it is gone
+        self.pending: dict[str, asyncio.Future] = {}
+        # set by a drain of the whole instance, no new containers from then on
+        self.draining_instance = False
+
+    async def drain(self, container_ids: list[str]) -> list[str]:
+        """Queues the containers that aren't queued yet, returns every one of them that is draining"""
+        new = [container_id for container_id in dict.fromkeys(container_ids) if container_id not in self.pending]
+        marked = await mark_draining(new)
+        now = time.time()
+        loop = asyncio.get_running_loop()
+        for container_id in new:
+            self.pending[container_id] = loop.create_future()
+            self.queue.put_nowait((container_id, float(str(marked[container_id]["draining_at"])) if container_id in marked else now))
+        containers_draining.set(len(self.pending))
+        return [container_id for container_id in dict.fromkeys(container_ids) if container_id in self.pending]
+
+    async def resume(self, containers: dict[str, dict]):
+        """Queues the containers left draining by the last run, reconciliation already dropped the ones that are gone"""
+        await self.drain([
+            container_id for container_id, metadata in containers.items()
+            if metadata and metadata.get("state") == "draining"
+        ])
+
+    async def wait(self, container_ids: list[str], timeout: float | None = None) -> list[str]:
+        """Waits till the containers are gone, returns the ones still draining after the timeout"""
+        futures = [self.pending[container_id] for container_id in container_ids if container_id in self.pending]
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+        return [container_id for container_id in container_ids if container_id in self.pending]
+
+    async def stop(self, container_id: str, queued_at: float):
+        docker = get_docker_client()
+        metadata = await get_container_metadata(container_id)
+        if metadata and metadata.get("paused_at"):
+            # a frozen process can't handle SIGTERM, so it is thawed first
+            try:
+                await docker.unpause(container_id)
+            except Exception as e:
+                print(f"Could not unpause {container_id} before stopping it: {e}")
+        with container_stop_duration_seconds.time():
+            await docker.stop(container_id, timeout=TEARDOWN_GRACE_SECONDS)
+        # --rm removes it on its own, containers adopted without it are removed here
+        await docker.remove(container_id)
+        await docker.wait_removed(container_id, TEARDOWN_REMOVE_TIMEOUT_SECONDS)
+
+        removed = await remove_containers([container_id])
+        outbox.publish("stopped", container_id, user_id=removed.get(container_id))
+        container_drain_duration_seconds.observe(time.time() - queued_at)
+        print(f"Container {container_id} stopped successfully.")
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            container_id, queued_at = await self.queue.get()
+            try:
+                await self.stop(container_id, queued_at)
+            except Exception as e:
+                print(f"Error stopping container {container_id}, retrying in {TEARDOWN_RETRY_SECONDS}s: {e}")
+                loop.call_later(TEARDOWN_RETRY_SECONDS, self.queue.put_nowait, (container_id, queued_at))
+                continue
+            future = self.pending.pop(container_id, None)
+            if future and not future.done():
+                future.set_result(None)
+            containers_draining.set(len(self.pending))
+
+    async def run(self):
+        print(f"Starting {self.workers} teardown workers...")
+        await asyncio.gather(*(self.worker() for _ in range(self.workers)))
+
+
+teardown = Teardown()
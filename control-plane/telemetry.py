@@ -0,0 +1,148 @@
+import os
+import asyncio
+from docker_client import get_docker_client
+from utils import get_meminfo_mb
+from ports import port_allocator
+from capacity import workspace_capacity
+from metrics import container_cpu_percent, container_memory_bytes, instance_load_score, instance_headroom_containers
+
+# docker sends a stats sample about once a second, so this is the averaging window in seconds
+TELEMETRY_WINDOW_SAMPLES = int(os.environ.get("TELEMETRY_WINDOW_SAMPLES", 30))
+TELEMETRY_RETRY_SECONDS = 5
+# what a container is expected to take before there are any to measure, and the least it is counted as
+# since an idle code-server is close to 0% cpu
+CONTAINER_MEMORY_ESTIMATE_MB = int(os.environ.get("CONTAINER_MEMORY_ESTIMATE_MB", 512))
+CONTAINER_CPU_ESTIMATE_PERCENT = float(os.environ.get("CONTAINER_CPU_ESTIMATE_PERCENT", 10))
+# width of the load_score steps the /report ETag follows, a smaller move doesn't invalidate cached reports
+REPORT_LOAD_BUCKET = float(os.environ.get("REPORT_LOAD_BUCKET", 0.05))
+
+
+class RollingAverage:
+    """Average of the last `size` samples, kept in a fixed size ring buffer with a running total"""
+
+    def __init__(self, size: int = TELEMETRY_WINDOW_SAMPLES):
+        self.samples = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        if self.count == len(self.samples):
+            self.total -= self.samples[self.index]
+        else:
+            self.count += 1
+        self.samples[self.index] = value
+        self.total += value
+        self.index = (self.index + 1) % len(self.samples)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class ContainerTelemetry:
+    def __init__(self):
+        self.cpu_percent = RollingAverage()
+        self.memory_bytes = RollingAverage()
+
+
+class Telemetry:
+    """
+    One streaming stats subscription per running code-server container(instead of a `docker stats` per poll),
+    rolled into per container averages. The load score and headroom of /report are computed from them.
+    """
+
+    def __init__(self):
+        # container_id => task following its stats stream
+        self.streams: dict[str, asyncio.Task] = {}
+        self.containers: dict[str, ContainerTelemetry] = {}
+
+    def track(self, container_ids: set[str]):
+        """Follows the containers that are new and drops the ones that are gone"""
+        for container_id in container_ids - self.streams.keys():
+            self.containers[container_id] = ContainerTelemetry()
+            self.streams[container_id] = asyncio.create_task(self.follow(container_id))
+        for container_id in self.streams.keys() - container_ids:
+            self.forget(container_id)
+
+    def forget(self, container_id: str):
+        task = self.streams.pop(container_id, None)
+        if task:
+            task.cancel()
+        if self.containers.pop(container_id, None):
+            for gauge in (container_cpu_percent, container_memory_bytes):
+                try:
+                    gauge.remove(container_id)
+                except KeyError:
+                    pass
+
+    async def follow(self, container_id: str):
+        while container_id in self.streams:
+            try:
+                async for sample in get_docker_client().stream_stats(container_id):
+                    self.record(container_id, sample)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error streaming stats of container {container_id}: {e}")
+            # the stream ends with the container, it is forgotten on the next listing if it is gone
+            await asyncio.sleep(TELEMETRY_RETRY_SECONDS)
+
+    def record(self, container_id: str, sample: dict):
+        container = self.containers.get(container_id)
+        if container is None:
+            return
+        container.cpu_percent.add(sample["cpu_percent"])
+        if sample["memory_bytes"] is not None:
+            container.memory_bytes.add(sample["memory_bytes"])
+        container_cpu_percent.labels(container_id=container_id).set(container.cpu_percent.average)
+        container_memory_bytes.labels(container_id=container_id).set(container.memory_bytes.average)
+
+    def load(self) -> dict:
+        """
+        load_score: the higher of the cpu use of the containers over all cores and the memory in use on the host, 0 to 1.
+        headroom: what is left of both and how many more containers of the current average size fit in it.
+        capacity: configured and effective container capacity(capacity.py)
+        """
+        cores = os.cpu_count() or 1
+        cpu_used = sum(container.cpu_percent.average for container in self.containers.values())
+        cpu_free = max(0.0, cores * 100 - cpu_used)
+        memory_total_mb = get_meminfo_mb("MemTotal")
+        memory_available_mb = get_meminfo_mb("MemAvailable")
+        memory_pressure = 1 - memory_available_mb / memory_total_mb if memory_total_mb and memory_available_mb is not None else 0.0
+
+        measured = [container for container in self.containers.values() if container.memory_bytes.count]
+        if measured:
+            container_cpu = sum(container.cpu_percent.average for container in measured) / len(measured)
+            container_memory_mb = sum(container.memory_bytes.average for container in measured) / len(measured) / 1024 ** 2
+        else:
+            container_cpu, container_memory_mb = 0.0, CONTAINER_MEMORY_ESTIMATE_MB
+        containers = int(cpu_free // max(container_cpu, CONTAINER_CPU_ESTIMATE_PERCENT))
+        if memory_available_mb is not None:
+            containers = min(containers, int(memory_available_mb // max(container_memory_mb, 1)))
+        # never more than the port pool and the memory limits of the containers allow
+        capacity = workspace_capacity.report(port_allocator.size, port_allocator.allocated)
+        containers = max(0, min(containers, capacity["effective"] - capacity["allocated"]))
+
+        load_score = round(max(min(1.0, cpu_used / (cores * 100)), memory_pressure), 3)
+        instance_load_score.set(load_score)
+        instance_headroom_containers.set(containers)
+        return {
+            "load_score": load_score,
+            "headroom": {
+                "containers": containers,
+                "cpu_percent": round(cpu_free, 1),
+                "memory_mb": memory_available_mb,
+            },
+            "capacity": capacity,
+        }
+
+
+def load_tag(load: dict) -> str:
+    """Part of the /report ETag for the load fields: the load_score bucket and the headroom and capacity counts"""
+    bucket = int(load["load_score"] / REPORT_LOAD_BUCKET)
+    capacity = load["capacity"]
+    return f"{bucket}.{load['headroom']['containers']}.{capacity['effective']}.{capacity['allocated']}"
+
+
+telemetry = Telemetry()
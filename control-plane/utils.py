@@ -1,34 +1,59 @@
 import jwt
+import shlex
 import asyncio
 
+MEMINFO_PATH = "/proc/meminfo"
+
 # Must be same as the orchestrator
 SECRET_KEY = "your-secret-key"
 
-def get_user_id_from_token(token):
+def decode_token(token):
     try:
-        decoded = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        user_id = decoded.get("userId")
-        print(f"userId: {user_id}")
-        return user_id
+        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
     except jwt.ExpiredSignatureError:
         print("Token has expired")
     except jwt.InvalidTokenError:
         print("Invalid token")
-    
+
     return None
 
+def get_user_id_from_token(token):
+    decoded = decode_token(token)
+    if not decoded:
+        return None
+    user_id = decoded.get("userId")
+    print(f"userId: {user_id}")
+    return user_id
+
 def get_token(user_id):
     return jwt.encode({"userId": user_id}, SECRET_KEY, algorithm="HS256")
 
-async def run_command(command):
-    """Run shell command asynchronously and return stdout as string."""
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+async def run_command(args: list[str], stdout: bool = True, stderr: bool = False) -> str:
+    """
+    Runs a command asynchronously without a shell(no argument is ever interpreted) and returns as string what it
+    wrote to stdout, stderr or both interleaved. A failure raises with stderr.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE if stdout else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.STDOUT if stdout and stderr else asyncio.subprocess.PIPE,
     )
-    stdout, stderr = await process.communicate()
+    out, err = await process.communicate()
     if process.returncode == 0:
-        return stdout.decode().strip()
+        return (out if stdout else err).decode().strip()
     else:
-        raise Exception(f"Command failed: {command}\n{stderr.decode().strip()}")
\ No newline at end of file
+        raise Exception(f"Command failed: {shlex.join(args)}\n{(err if err is not None else out).decode().strip()}")
+
+def get_meminfo_mb(field: str) -> int | None:
+    """Reads a field like MemAvailable or MemTotal from /proc/meminfo in MB"""
+    try:
+        with open(MEMINFO_PATH) as meminfo:
+            for line in meminfo:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) // 1024
+    except OSError as e:
+        print(f"Could not read {MEMINFO_PATH}: {e}")
+    return None
+
+def get_available_memory_mb() -> int | None:
+    return get_meminfo_mb("MemAvailable")
@@ -0,0 +1,154 @@
+import os
+import time
+import uuid
+import asyncio
+from docker_client import get_docker_client, CODE_SERVER_IMAGE
+from admission import start_flights
+from cache import (
+    get_containers,
+    get_warm_containers,
+    get_user_volumes,
+    set_user_volumes,
+    remove_user_volumes,
+    get_all_user_volumes,
+)
+from metrics import workspace_volumes_bytes, workspace_volumes_removed_total
+
+# kind => mount path, both right under the home of the coder user so docker doesn't create root owned parents
+VOLUME_MOUNTS = {
+    "workspace": "/home/coder/project",
+    # settings and extensions
+    "data": "/home/coder/.code-server",
+}
+VOLUME_ARGS = [
+    "--user-data-dir", "/home/coder/.code-server/data",
+    "--extensions-dir", "/home/coder/.code-server/extensions",
+]
+# coder in the code-server image, new volumes are owned by root
+VOLUME_OWNER = "1000:1000"
+VOLUME_LABELS = {"codespaces.volume": "workspace"}
+VOLUME_NAME = lambda kind, volume_set_id: f"codespaces_{kind}_{volume_set_id}"
+# on the containers, so the set they mount is known without the KV
+VOLUME_SET_LABEL = "codespaces.volume_set"
+
+VOLUME_RETENTION_DAYS = float(os.environ.get("VOLUME_RETENTION_DAYS", 14))
+VOLUME_DISK_QUOTA_GB = float(os.environ.get("VOLUME_DISK_QUOTA_GB", 50))
+VOLUME_GC_INTERVAL_SECONDS = int(os.environ.get("VOLUME_GC_INTERVAL_SECONDS", 60 * 60))
+
+
+def volume_mounts(volumes: dict[str, str] | None) -> dict[str, str] | None:
+    """kind => volume name to volume name => mount path(what docker run takes)"""
+    if not volumes:
+        return None
+    return {name: VOLUME_MOUNTS[kind] for kind, name in volumes.items()}
+
+
+def volume_set_id(volumes: dict[str, str]) -> str:
+    return next(iter(volumes.values())).rsplit("_", 1)[1]
+
+
+def volume_set_labels(volumes: dict[str, str] | None) -> dict[str, str]:
+    return {VOLUME_SET_LABEL: volume_set_id(volumes)} if volumes else {}
+
+
+class WorkspaceVolumes:
+    """
+    A set of named volumes per user(the workspace and the code-server data), created on the first /start
+    and mounted again on every later one. Sets of users without a container are garbage collected once
+    unused for longer than the retention window, or least recently used first while over the disk quota.
+    """
+
+    def __init__(self):
+        # unreferenced volumes of the last collection, only removed if they still are on the next one
+        # so a set that is being created isn't taken for an orphan
+        self.orphans: set[str] = set()
+
+    async def create(self) -> dict[str, str]:
+        """A fresh volume set, kind => volume name"""
+        volume_set_id = uuid.uuid4().hex[:12]
+        volumes = {kind: VOLUME_NAME(kind, volume_set_id) for kind in VOLUME_MOUNTS}
+        docker = get_docker_client()
+        for name in volumes.values():
+            await docker.create_volume(name, labels=VOLUME_LABELS)
+        await docker.run_once(
+            CODE_SERVER_IMAGE, ["chown", VOLUME_OWNER, *VOLUME_MOUNTS.values()], volume_mounts(volumes), user="root"
+        )
+        return volumes
+
+    async def for_user(self, user_id: str) -> tuple[dict[str, str], bool]:
+        """The volume set of the user and if it was just created(a cold start)"""
+        record = await get_user_volumes(user_id)
+        if record:
+            await set_user_volumes(user_id, record["volumes"])
+            return record["volumes"], False
+        volumes = await self.create()
+        await set_user_volumes(user_id, volumes)
+        return volumes, True
+
+    async def has_volumes(self, user_id: str) -> bool:
+        return await get_user_volumes(user_id) is not None
+
+    async def assign(self, user_id: str, volumes: dict[str, str]):
+        """The set a warm pool container was started with becomes the set of its first user"""
+        await set_user_volumes(user_id, volumes)
+
+    async def remove(self, volumes: list[str]) -> list[str]:
+        removed = []
+        for name in volumes:
+            try:
+                await get_docker_client().remove_volume(name)
+                removed.append(name)
+            except Exception as e:
+                # 409 -> still mounted by a container, picked up as an orphan later
+                print(f"Could not remove volume {name}: {e}")
+        return removed
+
+    async def collect(self):
+        records = await get_all_user_volumes()
+        bound = {str(metadata["user_id"]) for metadata in (await get_containers()).values() if metadata and "user_id" in metadata}
+        referenced = {name for record in records.values() for name in record["volumes"].values()}
+        referenced |= {name for warm in (await get_warm_containers()).values() for name in (warm["volumes"] or {}).values()}
+
+        docker = get_docker_client()
+        names = {volume["name"] for volume in await docker.list_volumes({"label": [f"{key}={value}" for key, value in VOLUME_LABELS.items()]})}
+        sizes = await docker.volume_sizes()
+        total = sum(sizes.get(name, 0) for name in names)
+
+        orphans = names - referenced
+        removed = await self.remove(list(orphans & self.orphans))
+        for name in removed:
+            total -= sizes.get(name, 0)
+            workspace_volumes_removed_total.labels(reason="orphan").inc()
+        self.orphans = orphans - set(removed)
+
+        retention_cutoff = time.time() - VOLUME_RETENTION_DAYS * 24 * 60 * 60
+        quota = VOLUME_DISK_QUOTA_GB * 1000 ** 3
+        unused = sorted((record["last_used"], user_id) for user_id, record in records.items() if user_id not in bound)
+        for last_used, user_id in unused:
+            if last_used < retention_cutoff:
+                reason = "retention"
+            elif total > quota:
+                reason = "quota"
+            else:
+                break
+            # checked again since the listing, a start in flight reads the record
+            if await get_user_volumes(user_id) != records[user_id] or user_id in start_flights.calls:
+                continue
+            # the record goes first so a start from now on creates a new set, volumes that fail to go become orphans
+            await remove_user_volumes(user_id)
+            print(f"Removing the workspace volumes of user {user_id} ({reason})")
+            for name in await self.remove(list(records[user_id]["volumes"].values())):
+                total -= sizes.get(name, 0)
+                workspace_volumes_removed_total.labels(reason=reason).inc()
+        workspace_volumes_bytes.set(total)
+
+    async def maintain(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as e:
+                print(f"Error collecting workspace volumes: {e}")
+            await asyncio.sleep(VOLUME_GC_INTERVAL_SECONDS)
+
+
+workspace_volumes = WorkspaceVolumes()
@@ -0,0 +1,162 @@
+import os
+import asyncio
+from docker_client import get_docker_client, CODE_SERVER_IMAGE, CODE_SERVER_ARGS, CONTAINER_NAME
+from ports import port_allocator
+from cache import set_user_container, add_warm_container, remove_warm_container, get_warm_containers
+from volumes import workspace_volumes, volume_mounts, volume_set_labels, VOLUME_ARGS
+from capacity import workspace_capacity
+from utils import get_available_memory_mb
+from outbox import outbox
+from teardown import teardown
+from metrics import warm_pool_size, warm_pool_requests_total, warm_pool_refill_duration_seconds
+
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", 2))
+# below this much available memory the pool gives back one container per check instead of refilling
+WARM_POOL_MIN_AVAILABLE_MEMORY_MB = int(os.environ.get("WARM_POOL_MIN_AVAILABLE_MEMORY_MB", 1024))
+WARM_POOL_CHECK_INTERVAL_SECONDS = 30
+WARM_POOL_OWNER = "warm-pool"
+WARM_POOL_LABELS = {"codespaces.pool": "warm"}
+
+
+class WarmPool:
+    """
+    Code-server containers started ahead of time on their own ports and not bound to any user.
+    /start binds one to the user by only writing the user => container mapping,
+    the pool is refilled in the background.
+    Each one is started with a fresh volume set that becomes the set of its user, so only users
+    without volumes yet are served from the pool.
+    """
+
+    def __init__(self, size: int = WARM_POOL_SIZE):
+        self.size = size
+        # container_id => port
+        self.containers: dict[str, int] = {}
+        # container_id => volume set it was started with
+        self.volumes: dict[str, dict[str, str]] = {}
+        self.refill_lock = asyncio.Lock()
+        # the refill scheduled by acquire, kept since the loop only holds a weak reference to its tasks
+        self.refill_task: asyncio.Task | None = None
+
+    def is_warm(self, container_id: str) -> bool:
+        return container_id in self.containers
+
+    def update_size_metric(self):
+        warm_pool_size.set(len(self.containers))
+
+    async def load(self, running_container_ids: set[str]):
+        """Picks up the warm containers of the last run that are still running"""
+        for container_id, warm in (await get_warm_containers()).items():
+            # containers of before the volumes can't be handed to a user
+            if container_id in running_container_ids and warm["volumes"]:
+                self.containers[container_id] = warm["port"]
+                self.volumes[container_id] = warm["volumes"]
+            else:
+                await remove_warm_container(container_id)
+        self.update_size_metric()
+
+    async def acquire(self, user_id: str) -> tuple[str, int] | None:
+        if not self.containers:
+            warm_pool_requests_total.labels(result="miss").inc()
+            self.schedule_refill()
+            return None
+
+        container_id, port = self.containers.popitem()
+        volumes = self.volumes.pop(container_id)
+        self.update_size_metric()
+        await workspace_volumes.assign(user_id, volumes)
+        await remove_warm_container(container_id)
+        await set_user_container(user_id, container_id, port)
+        outbox.publish("started", container_id, user_id=user_id, port=port)
+        warm_pool_requests_total.labels(result="hit").inc()
+        self.schedule_refill()
+        return container_id, port
+
+    def schedule_refill(self):
+        # a refill that is running already tops the pool up to its size, another one would only queue on the lock
+        if self.refill_task is not None and not self.refill_task.done():
+            return
+        self.refill_task = asyncio.create_task(self.refill())
+        self.refill_task.add_done_callback(self.refill_done)
+
+    @staticmethod
+    def refill_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            print(f"Error refilling warm pool: {task.exception()}")
+
+    def is_memory_low(self) -> bool:
+        available = get_available_memory_mb()
+        return available is not None and available < WARM_POOL_MIN_AVAILABLE_MEMORY_MB
+
+    async def start_one(self):
+        port = port_allocator.allocate(owner=WARM_POOL_OWNER)
+        if not port:
+            return False
+        try:
+            with warm_pool_refill_duration_seconds.time(), port_allocator.launching(port):
+                volumes = await workspace_volumes.create()
+                container_id = await get_docker_client().run(
+                    CODE_SERVER_IMAGE, port, CONTAINER_NAME(port), CODE_SERVER_ARGS + VOLUME_ARGS,
+                    labels={**WARM_POOL_LABELS, **volume_set_labels(volumes)}, volumes=volume_mounts(volumes),
+                    cpu_shares=workspace_capacity.cpu_shares, memory_mb=workspace_capacity.memory_mb,
+                )
+        except Exception as e:
+            print(f"Error starting warm pool container on port {port}: {e}")
+            port_allocator.release(port)
+            return False
+        try:
+            port_allocator.lease(port, owner=container_id, expected_owner=WARM_POOL_OWNER)
+        except ValueError:
+            print(f"Port {port} was reclaimed while warm pool container {container_id} started on it")
+            # stopped and removed with retries, only a port it still owns is released with it
+            await teardown.drain([container_id])
+            return False
+        await add_warm_container(container_id, port, volumes)
+        self.containers[container_id] = port
+        self.volumes[container_id] = volumes
+        self.update_size_metric()
+        print(f"Warm pool container {container_id} ready on port {port}")
+        return True
+
+    async def shrink_one(self):
+        container_id, port = self.containers.popitem()
+        # never used, the volume collector removes them as orphans
+        self.volumes.pop(container_id, None)
+        self.update_size_metric()
+        print(f"Stopping warm pool container {container_id}")
+        await remove_warm_container(container_id)
+        try:
+            await get_docker_client().stop(container_id)
+        finally:
+            port_allocator.release(port)
+
+    async def refill(self):
+        async with self.refill_lock:
+            if self.is_memory_low():
+                if self.containers:
+                    print("Low memory, giving back a warm pool container")
+                    await self.shrink_one()
+                return
+            while len(self.containers) < self.size:
+                # the memory a user container would need isn't taken by the pool
+                if workspace_capacity.admissible() == 0:
+                    return
+                if not await self.start_one():
+                    return
+
+    async def drain(self):
+        """Stops every warm container and the refills, the instance is scaling in"""
+        self.size = 0
+        async with self.refill_lock:
+            await asyncio.gather(*(self.shrink_one() for _ in range(len(self.containers))), return_exceptions=True)
+
+    async def maintain(self):
+        print(f"Starting warm pool of {self.size} containers...")
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                print(f"Error maintaining warm pool: {e}")
+            await asyncio.sleep(WARM_POOL_CHECK_INTERVAL_SECONDS)
+
+
+warm_pool = WarmPool()
@@ -0,0 +1,59 @@
+import os
+import time
+import asyncio
+from docker_client import get_docker_client, CODE_SERVER_IMAGE
+from codermon import start_static_assert_container
+from metrics import image_pull_duration_seconds, instance_ready
+
+# images every instance needs locally before it takes traffic, comma separated
+PREPULL_IMAGES = [image.strip() for image in os.environ.get("PREPULL_IMAGES", CODE_SERVER_IMAGE).split(",") if image.strip()]
+PREPULL_RETRY_SECONDS = 10
+
+
+class InstanceWarmup:
+    """
+    On boot the images are pulled in parallel(only the ones that aren't local yet) and a throwaway container
+    of each is created and removed so its layers are in the page cache, then the static asset container is started.
+    /health reports the instance as not ready till then, so the first /start doesn't pay for the pull.
+    """
+
+    def __init__(self, images: list[str] = PREPULL_IMAGES):
+        self.images = images
+        self.pending: set[str] = set(images)
+        self.ready = False
+
+    async def pull(self, image: str):
+        docker = get_docker_client()
+        while True:
+            try:
+                if not await docker.image_exists(image):
+                    print(f"Pulling {image}...")
+                    started_at = time.perf_counter()
+                    await docker.pull(image)
+                    image_pull_duration_seconds.labels(image=image).observe(time.perf_counter() - started_at)
+                break
+            except Exception as e:
+                print(f"Error pulling {image}, retrying: {e}")
+                await asyncio.sleep(PREPULL_RETRY_SECONDS)
+        try:
+            await docker.warm_up(image)
+        except Exception as e:
+            # only the page cache misses out
+            print(f"Error warming up {image}: {e}")
+        self.pending.discard(image)
+
+    async def prepare(self):
+        await asyncio.gather(*(self.pull(image) for image in self.images))
+        while True:
+            try:
+                await start_static_assert_container()
+                break
+            except Exception as e:
+                print(f"Error starting the static asset container, retrying: {e}")
+                await asyncio.sleep(PREPULL_RETRY_SECONDS)
+        self.ready = True
+        instance_ready.set(1)
+        print("Images ready, taking traffic")
+
+
+instance_warmup = InstanceWarmup()
@@ -2,10 +2,43 @@ export interface Container {
   user_id: string;
   container_id: string;
   port: number;
+  // paused containers are resumed by the proxy on the next request
+  state?: "running" | "paused";
+}
+/**
+ * Lifecycle event pushed by a control plane's outbox(at least once, latest per container)
+ */
+export interface ContainerEvent {
+  event: "started" | "idle" | "paused" | "resumed" | "stopped";
+  container_id: string;
+  user_id?: string | null;
+  port?: number;
+  at: number;
+}
+/**
+ * What is left on an instance, measured by the control plane
+ */
+export interface Headroom {
+  // how many more containers of the current average size fit
+  containers: number;
+  cpu_percent: number;
+  memory_mb: number | null;
+}
+export interface Capacity {
+  // size of the port pool, from the host and the workspace profile
+  configured: number;
+  // what can be reached with the memory available now
+  effective: number;
+  allocated: number;
+  profile: { name: string; cpus: number; memory_mb: number };
 }
 export interface ContainerReport {
   count: number;
   containers: Container[];
+  // 0 to 1, the higher of cpu and memory pressure(older control planes don't send it)
+  load_score?: number;
+  headroom?: Headroom;
+  capacity?: Capacity;
 }
 
 /**
@@ -18,6 +51,14 @@ export class ControlPlaneInstance {
     this.controlPlaneURL = `http://${ip}:8000`;
   }
 
+  /**
+   * Not ready while a new instance is still pulling images
+   */
+  public async isReady(): Promise<boolean> {
+    const res = await fetch(`${this.controlPlaneURL}/health`);
+    return res.ok;
+  }
+
   public async getReport(): Promise<ContainerReport> {
     const res = await fetch(`${this.controlPlaneURL}/report`, {
       headers: { "X-ORCHASTRATOR_KEY": `${ControlPlane.getToken()}` },
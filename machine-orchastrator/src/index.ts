@@ -4,7 +4,7 @@ import { html } from "hono/html";
 import getCache from "./cache.js";
 import { ASG } from "./asg.js";
 import { getToken, verifyToken, type User } from "./auth.js";
-import { ControlPlane, getControlPlane } from "./controlPlane.js";
+import { ControlPlane, getControlPlane, type ContainerEvent } from "./controlPlane.js";
 import { Orchastrator } from "./orchastrator.js";
 import "dotenv/config";
 import { cors } from "hono/cors";
@@ -116,6 +116,22 @@ app.get("/server", async (c) => {
   return c.text(serverUrl);
 });
 
+// lifecycle events from the control planes, delivered at least once so handling has to be idempotent
+app.post("/events", async (c) => {
+  if (c.req.header("X-ORCHASTRATOR_KEY") !== ORCHASTRATOR_TOKEN) {
+    c.status(403);
+    return c.json({ message: "Not control plane" });
+  }
+  const { events } = (await c.req.json()) as { events: ContainerEvent[] };
+  const cache = await getCache();
+  await Promise.all(
+    events
+      .filter((event) => event.event === "stopped" && event.user_id)
+      .map((event) => cache.del(`user:${event.user_id}`))
+  );
+  return c.json({ received: events.length });
+});
+
 serve(
   {
     fetch: app.fetch,
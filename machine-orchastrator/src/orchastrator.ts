@@ -11,6 +11,8 @@ interface CacheInstanceDetails {
   ip: string;
   count: string;
   metric: string;
+  // containers that still fit, -1 when the control plane doesn't report it
+  headroom: string;
 }
 
 const FIVE_MINUTES_SECONDS_SECONDS = 5 * 60;
@@ -32,12 +34,15 @@ export class Orchastrator {
       asgReport.map(async (asgInstance) => {
         try {
           const controlPlane = this.controlPlaneManager.get(asgInstance.ip);
+          // kept out of the pool till it is ready
+          if (!(await controlPlane.isReady())) {
+            throw new Error("instance is warming up");
+          }
           const containerReport = await controlPlane.getReport();
           // HACK: using this load we can use the redis sorted set and zrange to get the lowest load instance
-          const load = this.getLoadOfInstance(
-            containerReport.count,
-            asgInstance.metric || 0
-          );
+          const load =
+            containerReport.load_score ??
+            this.getLoadOfInstance(containerReport.count, asgInstance.metric || 0);
           return {
             ...asgInstance,
             ...containerReport,
@@ -104,8 +109,11 @@ export class Orchastrator {
         continue;
       }
   
-      const { count } = fetchedInstance;
-      if (parseInt(count) >= MAX_EXPECTED_CONTAINER) {
+      const { count, headroom } = fetchedInstance;
+      const hasHeadroom = headroom && parseInt(headroom) >= 0
+        ? parseInt(headroom) > 0
+        : parseInt(count) < MAX_EXPECTED_CONTAINER;
+      if (!hasHeadroom) {
         console.warn("Instance is full, retrying...");
         retries++;
         continue;
@@ -129,6 +137,7 @@ export class Orchastrator {
           ip: instance.ip,
           count: instance.count.toString(),
           metric: (instance.metric || -1).toString(),
+          headroom: (instance.headroom?.containers ?? -1).toString(),
         } satisfies CacheInstanceDetails);
         atomicCacheOperation.zAdd("instancePool", {
           score: instance.load,